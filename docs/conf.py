@@ -241,5 +241,7 @@ rcdocs += summarize_rcdocs([
     'polyphemus.githubstat',
     'polyphemus.github',
     'polyphemus.apache2',    
+    'polyphemus.journal',
+    'polyphemus.dashboard',
     ])
 newoverwrite(rcdocs, 'rcdocs.rst')
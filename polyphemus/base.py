@@ -55,10 +55,20 @@ class PolyphemusPlugin(Plugin):
         bash_completion=True,
         host='0.0.0.0',
         port=80,
+        threaded=True,
         appname="polyphemus",
         server_url=NotSpecified,
         ssh_key_file='~/.ssh/id_rsa', 
         flask_kwargs={'static_url_path': '/static'},
+        dispatch_workers=2,
+        dispatch_build_limit=1,
+        dispatch_coalesce_window=0.0,
+        dispatch_max_queue=100,
+        dispatch_retry_after=30,
+        dispatch_batch_size=20,
+        dispatch_repo_limit=0,
+        metrics_route='/metrics',
+        process_pool_size=0,
         )
 
     rcdocs = {
@@ -74,6 +84,7 @@ class PolyphemusPlugin(Plugin):
         'host': ("Which urls to host to, ie '0.0.0.0' for everyone or "
                  "'localhost' for yourself"),
         'port': "The port to run the application on.",
+        'threaded': "Handles each web request in its own thread.",
         'appname': "The name of the flask application.",
         'server_url': ("The URL of the server without a trailing slash or port "
                        "number, eg 'http://pynesim.org'. If not provided, it will "
@@ -82,6 +93,42 @@ class PolyphemusPlugin(Plugin):
                          "defaults to '~/.ssh/id_rsa'. If this file does not exist "
                          "a key will be generated at this location."),
         'flask_kwargs': "keyword argumnets submitted to Flask() constructor.",
+        'dispatch_workers': ("The number of background threads that run the plugin "
+                             "pipeline for events generated by web requests. Each "
+                             "event is executed with its own run control overlay, "
+                             "so events may run concurrently. If zero, events are "
+                             "executed before the response is returned."),
+        'dispatch_build_limit': ("The maximum number of build events, such as "
+                                 "BaTLab submissions, that are executed at the "
+                                 "same time. This should be less than "
+                                 "dispatch_workers so that status events are "
+                                 "never stuck behind builds."),
+        'dispatch_coalesce_window': ("The number of seconds that pull request "
+                                     "events are held for before being executed. "
+                                     "Newer events for the same pull request "
+                                     "that arrive in this window replace the "
+                                     "held event. By default, events are not "
+                                     "held, though a newer event still cancels "
+                                     "an older one that is queued or executing."),
+        'dispatch_max_queue': ("The maximum number of events that may be waiting "
+                               "to execute. Once reached, web requests that "
+                               "would add events are answered with HTTP 503. "
+                               "Zero means no limit."),
+        'dispatch_retry_after': ("The number of seconds given in the Retry-After "
+                                 "header of HTTP 503 responses."),
+        'dispatch_batch_size': ("The maximum number of events with the same name "
+                                "that are executed together by plugins which "
+                                "handle events in batches."),
+        'dispatch_repo_limit': ("The maximum number of events for a single "
+                                "repository that are executed at the same time, "
+                                "so that a busy repository can not starve the "
+                                "others. Zero means no limit."),
+        'metrics_route': ("The route that plugin timings and other metrics are "
+                          "served on, in the Prometheus text format. If empty, "
+                          "metrics are not served."),
+        'process_pool_size': ("The number of worker processes that run the "
+                              "plugins which execute in a process pool, such "
+                              "as polyphemus.swchook. Zero means one per CPU."),
         }
 
     rcupdaters = {'flask_kwargs': lambda old, new: old.update(new) or old}
@@ -101,17 +148,48 @@ class PolyphemusPlugin(Plugin):
                             help=self.rcdocs["only_setup"])
         parser.add_argument('--host', help=self.rcdocs['host'])
         parser.add_argument('--port', help=self.rcdocs['port'])
+        parser.add_argument('--threaded', action='store_true', dest='threaded',
+                            help=self.rcdocs['threaded'])
+        parser.add_argument('--no-threaded', action='store_false', dest='threaded',
+                            help="Doesn't handle" + self.rcdocs['threaded'][7:])
         parser.add_argument('--appname', help=self.rcdocs['appname'])
         parser.add_argument('--server-url', dest='server_url', 
                             help=self.rcdocs["server_url"])
         parser.add_argument('--ssh-key-file', dest='ssh_key_file', 
                             help=self.rcdocs["ssh_key_file"])
+        parser.add_argument('--dispatch-workers', dest='dispatch_workers', 
+                            help=self.rcdocs["dispatch_workers"])
+        parser.add_argument('--dispatch-build-limit', dest='dispatch_build_limit', 
+                            help=self.rcdocs["dispatch_build_limit"])
+        parser.add_argument('--dispatch-coalesce-window', 
+                            dest='dispatch_coalesce_window', 
+                            help=self.rcdocs["dispatch_coalesce_window"])
+        parser.add_argument('--dispatch-max-queue', dest='dispatch_max_queue', 
+                            help=self.rcdocs["dispatch_max_queue"])
+        parser.add_argument('--dispatch-retry-after', dest='dispatch_retry_after', 
+                            help=self.rcdocs["dispatch_retry_after"])
+        parser.add_argument('--dispatch-batch-size', dest='dispatch_batch_size', 
+                            help=self.rcdocs["dispatch_batch_size"])
+        parser.add_argument('--dispatch-repo-limit', dest='dispatch_repo_limit', 
+                            help=self.rcdocs["dispatch_repo_limit"])
+        parser.add_argument('--metrics-route', dest='metrics_route', 
+                            help=self.rcdocs["metrics_route"])
+        parser.add_argument('--process-pool-size', dest='process_pool_size', 
+                            help=self.rcdocs["process_pool_size"])
 
     def setup(self, rc):
         if rc.version:
             print(report_versions())
             sys.exit()
         rc.port = int(rc.port)
+        rc.dispatch_workers = int(rc.dispatch_workers)
+        rc.dispatch_build_limit = int(rc.dispatch_build_limit)
+        rc.dispatch_coalesce_window = float(rc.dispatch_coalesce_window)
+        rc.dispatch_max_queue = int(rc.dispatch_max_queue)
+        rc.dispatch_retry_after = int(rc.dispatch_retry_after)
+        rc.dispatch_batch_size = int(rc.dispatch_batch_size)
+        rc.dispatch_repo_limit = int(rc.dispatch_repo_limit)
+        rc.process_pool_size = int(rc.process_pool_size)
         rc.rc = os.path.abspath(rc.rc)
 
         # set server_url
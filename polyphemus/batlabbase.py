@@ -2,12 +2,20 @@
 
 This module is available as an polyphemus plugin by the name `polyphemus.batlabbase`.
 
+Connections to the BaTLab submit node are kept open in the ``SSH_POOL`` and
+are shared by every plugin in this process.  SSH multiplexes many channels over
+one authenticated transport, so concurrent jobs only open new channels rather 
+than doing a full handshake each.  The transports send keepalives so that they
+are not dropped while idle, and a transport which has gone down anyway is 
+reconnected the next time that it is handed out.
+
 Basic BaTLaB API
 =================
 """
 from __future__ import print_function
 import os
 import sys
+import threading
 from tempfile import NamedTemporaryFile
 import subprocess
 from warnings import warn
@@ -19,12 +27,130 @@ from .utils import RunControl, NotSpecified, writenewonly, \
     DEFAULT_RC_FILE, DEFAULT_PLUGINS, nyansep, indent, check_cmd
 from .plugins import Plugin
 from .base import ssh_pub_key
+from .metrics import REGISTRY
 
 if sys.version_info[0] >= 3:
     basestring = str
 
 BATLAB_SUBMIT_HOSTNAME = 'submit-1.batlab.org'
 
+SSH_CONNECTS = REGISTRY.counter('polyphemus_batlab_ssh_connects_total',
+    'SSH connections made to the BaTLab submit node.')
+
+class SSHPool(object):
+    """A pool of authenticated SSH connections to a host.  Connections are 
+    made lazily and handed out round robin, and each may be used by many 
+    threads at once.
+    """
+
+    def __init__(self, hostname=BATLAB_SUBMIT_HOSTNAME, size=1, keepalive=30):
+        """Parameters
+        ----------
+        hostname : str, optional
+            The host to connect to.
+        size : int, optional
+            The number of connections to keep open.
+        keepalive : int, optional
+            The number of seconds between keepalive packets, zero for none.
+
+        """
+        self.hostname = hostname
+        self.size = size
+        self.keepalive = keepalive
+        self.username = None
+        self.key_filename = None
+        self._pkey = None
+        self._clients = []
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def configure(self, username, key_filename, size=None, keepalive=None):
+        """Sets the credentials used by new connections, closing any existing
+        connections if these have changed.
+        """
+        if size is not None:
+            self.size = max(1, int(size))
+        if keepalive is not None:
+            self.keepalive = int(keepalive)
+        if (username, key_filename) != (self.username, self.key_filename):
+            self.close()
+            with self._lock:
+                self.username = username
+                self.key_filename = key_filename
+                self._pkey = None
+
+    def _connect(self):
+        if self._pkey is None:
+            # only parse the key file once
+            self._pkey = paramiko.RSAKey.from_private_key_file(self.key_filename)
+        client = paramiko.SSHClient()
+        client.load_system_host_keys()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        client.connect(self.hostname, username=self.username, pkey=self._pkey)
+        if self.keepalive > 0:
+            client.get_transport().set_keepalive(self.keepalive)
+        SSH_CONNECTS.inc()
+        return client
+
+    def client(self):
+        """Returns a connected paramiko.SSHClient, reconnecting if its transport
+        has been dropped.  Connection errors propagate to the caller.
+        """
+        with self._lock:
+            if len(self._clients) < self.size:
+                self._clients.append(None)
+            i = self._next % len(self._clients)
+            self._next = i + 1
+            client = self._clients[i]
+            transport = None if client is None else client.get_transport()
+            if transport is None or not transport.is_active():
+                if client is not None:
+                    client.close()
+                self._clients[i] = None
+                self._clients[i] = client = self._connect()
+            return client
+
+    def close(self):
+        """Closes all of the connections in the pool."""
+        with self._lock:
+            clients, self._clients = self._clients, []
+        for client in clients:
+            if client is not None:
+                client.close()
+
+SSH_POOL = SSHPool()
+"""The pool of connections to the BaTLab submit node."""
+
+SECTION_MARKER = '@@polyphemus {0}@@'
+"""The line which introduces a section of the output of a remote script."""
+
+def parse_sections(output):
+    """Splits the output of a remote script into sections.
+
+    Parameters
+    ----------
+    output : str or bytes
+        The output, where each section is introduced by a SECTION_MARKER line.
+
+    Returns
+    -------
+    sections : dict
+        Maps the section names to lists of lines. Output before the first 
+        section is under the empty string.
+
+    """
+    if not isinstance(output, str):
+        output = output.decode('utf-8', 'replace')
+    sections = {'': []}
+    lines = sections['']
+    prefix, suffix = SECTION_MARKER.split('{0}')
+    for line in output.splitlines():
+        if line.startswith(prefix) and line.endswith(suffix):
+            lines = sections.setdefault(line[len(prefix):-len(suffix)], [])
+        else:
+            lines.append(line)
+    return sections
+
 class PolyphemusPlugin(Plugin):
     """This class provides basic BaTLab functionality."""
 
@@ -32,16 +158,27 @@ class PolyphemusPlugin(Plugin):
 
     defaultrc = RunControl(
         batlab_user=NotSpecified,
+        batlab_ssh_pool_size=2,
+        batlab_ssh_keepalive=30,
         )
 
     rcdocs = {
         'batlab_user': ("The BaTLab user name to login with.  Must have rights "
                         "on the submit node."),
+        'batlab_ssh_pool_size': ("The number of SSH connections to keep open to "
+                                 "the BaTLab submit node."),
+        'batlab_ssh_keepalive': ("The number of seconds between keepalive "
+                                 "packets on the BaTLab SSH connections, zero "
+                                 "for none."),
         }
 
     def update_argparser(self, parser):
         parser.add_argument('--batlab-user', dest='batlab_user',
                             help=self.rcdocs["batlab_user"])
+        parser.add_argument('--batlab-ssh-pool-size', dest='batlab_ssh_pool_size',
+                            help=self.rcdocs["batlab_ssh_pool_size"])
+        parser.add_argument('--batlab-ssh-keepalive', dest='batlab_ssh_keepalive',
+                            help=self.rcdocs["batlab_ssh_keepalive"])
 
     def setup(self, rc):
         if rc.batlab_user is NotSpecified:
@@ -49,16 +186,19 @@ class PolyphemusPlugin(Plugin):
             print("batlab username not specified, found {0!r}".format(user))
             rc.batlab_user = user
 
-        # make sure that we can authenticate in the future with SSH public keys
-        key = paramiko.RSAKey(filename=rc.ssh_key_file)
+        rc.batlab_ssh_pool_size = int(rc.batlab_ssh_pool_size)
+        rc.batlab_ssh_keepalive = int(rc.batlab_ssh_keepalive)
+        SSH_POOL.configure(rc.batlab_user, rc.ssh_key_file, 
+                           size=rc.batlab_ssh_pool_size, 
+                           keepalive=rc.batlab_ssh_keepalive)
+
+        # make sure that we can authenticate in the future with SSH public keys,
+        # the connection made here is kept open in the pool
         client = paramiko.SSHClient()
         client.load_system_host_keys()
         client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        #client.get_host_keys().add(BATLAB_SUBMIT_HOSTNAME, 'ssh-rsa', key)
         try:
-            client.connect(BATLAB_SUBMIT_HOSTNAME, username=rc.batlab_user, 
-                           key_filename=rc.ssh_key_file)
-            client.close()
+            SSH_POOL.client()
             can_connect = True
         except paramiko.AuthenticationException:
             can_connect = False
@@ -83,8 +223,9 @@ class PolyphemusPlugin(Plugin):
                 stdin, stdout, stderr = client.exec_command(cmd)
             client.close()
             # verify thatthis key works
-            client.connect(BATLAB_SUBMIT_HOSTNAME, username=rc.batlab_user, 
-                           key_filename=rc.ssh_key_file)
-            client.close()
+            SSH_POOL.client()
             print("finished connecting")
         client.close()  # Just to be safe
+
+    def teardown(self, rc):
+        SSH_POOL.close()
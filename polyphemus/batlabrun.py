@@ -2,23 +2,47 @@
 
 This module is available as an polyphemus plugin by the name ``polyphemus.batlabrun``.
 
+Jobs are prepared on the BaTLab submit node with few round trips.  A shell 
+script which copies the BaTLab scripts into the job directory is rendered 
+locally, uploaded over SFTP, and run with one remote command.  The scripts are
+hard linked from a cache on the submit node, which is only downloaded again 
+when they change upstream.  Since edited files are replaced rather than 
+changed in place, the cache is never modified through a job directory.  The 
+script reports its results in sections of its output, each introduced by a 
+``@@polyphemus <name>@@`` line, such as 'error' if a step failed.  It also 
+prints the run-spec, the pre_all and post_all task scripts, and the conda 
+``meta.yaml``, and then waits while these are edited in Python through 
+JobFiles.  The edited files are sent back as one gzipped tarball on the 
+standard input of the same command, which unpacks them, renames them into 
+place, submits the job, and reports its gid and report URL in sections of 
+their own.  So a job takes one upload and one remote command in all.
+
 BaTLaB Plugin API
 =================
 """
 from __future__ import print_function
 import os
+import io
 import sys
 import socket
+import hashlib
+import tarfile
+import posixpath
 import subprocess
 from warnings import warn
 
-import github3
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
 import paramiko
 
 from .utils import RunControl, NotSpecified, PersistentCache
 from .plugins import Plugin
 from .event import Event, runfor
-from .batlabbase import BATLAB_SUBMIT_HOSTNAME
+from .batlabbase import SSH_POOL, SECTION_MARKER, parse_sections
+from .githubbase import github_client
 
 if sys.version_info[0] >= 3:
     basestring = str
@@ -30,99 +54,395 @@ git_path = {repo_dir};cd {repo_dir};git checkout {branch}
 """
 
 pre_curl_template = r"""# polyphemus pre_all callback
-curl --form status='{{\"status\":\"pending\",\"number\":{number},\"description\":\"build and test initialized\"}}' {server_url}:{port}/batlabstatus
+curl --form status='{{"status":"pending","owner":"{owner}","repo":"{repo}","number":{number},"description":"build and test initialized"}}' {server_url}:{port}/batlabstatus
 """
 
 post_curl_template = r"""# polyphemus post_all callbacks
-val0=\`grep \"return value 0\" ../../run.log | wc -l\`
-valAny=\`grep \"return value\" ../../run.log | wc -l\`
+val0=`grep "return value 0" ../../run.log | wc -l`
+valAny=`grep "return value" ../../run.log | wc -l`
 
-if [ \$val0 == \$valAny ]
+if [ $val0 == $valAny ]
 then
-    curl --form status='{{\"status\":\"success\",\"number\":{number},\"description\":\"build and test completed successfully\"}}' {server_url}:{port}/batlabstatus
+    curl --form status='{{"status":"success","owner":"{owner}","repo":"{repo}","number":{number},"description":"build and test completed successfully"}}' {server_url}:{port}/batlabstatus
 else
-    curl --form status='{{\"status\":\"failure\",\"number\":{number},\"description\":\"build and test failed\"}}' {server_url}:{port}/batlabstatus
+    curl --form status='{{"status":"failure","owner":"{owner}","repo":"{repo}","number":{number},"description":"build and test failed"}}' {server_url}:{port}/batlabstatus
 fi
 """
 
-unzip_cmds_template = \
-"""curl -L -o batlab_scripts.zip {batlab_scripts_url};
-unzip -d {jobdir} batlab_scripts.zip;
-rm batlab_scripts.zip;
-"""
-
 jobdir_scp_template = \
 """method = scp
 scp_file = {jobdir}/*
 recursive = true
 """
 
-def _find_startswith(x, s):
-    """Finds the index of a sequence that starts with s or returns -1.
+job_script_header = \
+"""#!/bin/bash
+# polyphemus BaTLab job script
+rm -f "$0"
+cd "$HOME"
+jobdir="$HOME"/{jobname}
+section() {{ echo "@@polyphemus $1@@"; }}
+fail() {{ section error; echo "$1"; exit 1; }}
+"""
+
+kill_template = \
+"""{kill_cmd} {gid} > /dev/null 2>&1
+"""
+
+scripts_cache_header = \
+"""cache="$HOME"/{cache}
+mkdir -p "$(dirname "$cache")" || fail "Error creating the BaTLab scripts cache."
+exec 9> "$cache.lock"
+flock 9 2> /dev/null
+"""
+
+git_cache_template = \
+"""rev=$(git ls-remote {batlab_scripts_url} HEAD 2> /dev/null | cut -f 1)
+if [ -z "$rev" ] && [ ! -d "$cache" ]; then
+    fail "Error cloning BaTLab scripts."
+elif [ -n "$rev" ] && [ "$rev" != "$(cat "$cache.rev" 2> /dev/null)" ]; then
+    [ -d "$cache.git" ] || git init -q --bare "$cache.git"
+    git --git-dir="$cache.git" fetch -q {batlab_scripts_url} HEAD || \\
+        fail "Error cloning BaTLab scripts."
+    rm -rf "$cache.new" && mkdir "$cache.new"
+    git --git-dir="$cache.git" archive FETCH_HEAD | tar -x -C "$cache.new" || \\
+        fail "Error cloning BaTLab scripts."
+    rm -rf "$cache" && mv "$cache.new" "$cache" && echo "$rev" > "$cache.rev"
+fi
+"""
+
+zip_cache_template = \
+"""rev=$(curl -s -I -L {batlab_scripts_url} | tr -d '\\r' | \\
+      sed -n -e 's/^[Ee][Tt][Aa][Gg]:[[:space:]]*//p' \\
+             -e 's/^[Ll]ast-[Mm]odified:[[:space:]]*//p' | tail -n 1)
+if [ -z "$rev" ] || [ "$rev" != "$(cat "$cache.rev" 2> /dev/null)" ] || \\
+   [ ! -d "$cache" ]; then
+    rm -rf "$cache.new"
+    curl -s -L -o "$cache.zip" {batlab_scripts_url} && \\
+        unzip -q -d "$cache.new" "$cache.zip" || fail "Error unzipping BaTLab scripts."
+    rm -f "$cache.zip"
+    set -- "$cache.new"/*
+    if [ $# -eq 1 ] && [ -d "$1" ]; then
+        mv "$1"/* "$cache.new" || fail "Error moving BaTLab scripts."
+        rmdir "$1"
+    fi
+    rm -rf "$cache" && mv "$cache.new" "$cache" && echo "$rev" > "$cache.rev"
+fi
+"""
+
+scripts_copy_template = \
+"""rm -rf "$jobdir"
+cp -al "$cache" "$jobdir" || fail "Error copying BaTLab scripts."
+flock -u 9 2> /dev/null
+"""
+
+job_files_template = \
+"""cd "$jobdir" || fail "Error entering the job directory."
+section home
+echo "$HOME"
+show() {{ [ -f "$1" ] || return 0; section "file $1"; stat -c %a "$1"; awk 1 "$1"; }}
+for f in {paths}; do
+    show "$f"
+done
+for task in pre_all post_all; do
+    f=$(sed -n -e "s/^[[:space:]]*$task[[:space:]]*=[[:space:]]*//p" {run_spec} | \\
+        head -n 1 | sed -e 's/[[:space:]]*$//')
+    show "${{f:-$task.sh}}"
+done
+"""
+
+submit_template = \
+"""section edits
+staging={staging}
+rm -rf "$staging" && mkdir "$staging" && tar -xzmpf - -C "$staging" || \\
+    fail "Error unpacking the edited job files."
+(cd "$staging" && find . -type f) | while IFS= read -r f; do
+    mv -f "$staging/$f" "$f" || exit 1
+done || fail "Error installing the edited job files."
+rm -rf "$staging"
+out=$({{ {submit_cmd} {run_spec}; }} 2> "$jobdir.err")
+status=$?
+err=$(cat "$jobdir.err")
+rm -f "$jobdir.err"
+[ $status -eq 0 ] && [ -z "$err" ] || fail "${{err:-Error submitting BaTLab job.}}"
+gid=$(echo "$out" | awk 'NF {{ print $NF; exit }}')
+url=$(echo "$out" | awk 'NF {{ line = $0 }} END {{ print line }}')
+[ -n "$gid" ] || fail "Error submitting BaTLab job."
+section gid
+echo "$gid"
+section report_url
+echo "$url"
+"""
+
+JOB_FILES_STAGING = '.polyphemus-edits'
+"""The directory, within a job directory, where edited files are unpacked."""
+
+class JobFiles(object):
+    """Edits the text files of a job directory in memory, as lists of lines.  
+    The files are read from the output of the job script, where each is in a 
+    'file <path>' section whose first line is its octal mode.  Edited files 
+    are sent back in a single gzipped tarball by archive(), which the job 
+    script unpacks and renames over the originals.  Since the files are 
+    replaced rather than changed in place, hard links into the scripts cache
+    are left alone.
     """
-    for i, elem in enumerate(x):
-        if elem.startswith(s):
+
+    def __init__(self, sections):
+        """Parameters
+        ----------
+        sections : dict
+            The sections of the output of the job script.
+
+        """
+        self._files = {}  # path -> [lines, mode]
+        self._edited = []
+        for name, lines in sections.items():
+            if name.startswith('file ') and len(lines) > 0:
+                self._files[name[5:]] = [lines[1:], int(lines[0], 8)]
+
+    def lines(self, path):
+        """Returns the lines of a file, without line endings.  Raises IOError 
+        if the file was not read.
+        """
+        if path not in self._files:
+            raise IOError("{0} was not read from the job directory".format(path))
+        return self._files[path][0]
+
+    def edit(self, path, create=False, mode=0o644):
+        """Returns the list of lines of a file, to be changed in place and sent
+        back by archive().  If create is True, a missing file is started empty 
+        with the given mode.
+        """
+        if path not in self._files:
+            if not create:
+                raise IOError("{0} was not read from the job directory".format(path))
+            self._files[path] = [[], mode]
+        if path not in self._edited:
+            self._edited.append(path)
+        return self._files[path][0]
+
+    def archive(self):
+        """Returns a gzipped tarball of the edited files, with their modes."""
+        buf = io.BytesIO()
+        tar = tarfile.open(fileobj=buf, mode='w:gz')
+        try:
+            for path in self._edited:
+                lines, mode = self._files[path]
+                data = ''.join(l + '\n' for l in lines)
+                if not isinstance(data, bytes):
+                    data = data.encode('utf-8')
+                info = tarfile.TarInfo(path)
+                info.size = len(data)
+                info.mode = mode
+                tar.addfile(info, io.BytesIO(data))
+        finally:
+            tar.close()
+        return buf.getvalue()
+
+def _find_option(lines, option, sep='='):
+    """Finds the index of the first line which sets an option or returns -1."""
+    for i, line in enumerate(lines):
+        if sep in line and line.split(sep, 1)[0].strip() == option:
             return i
     return -1
 
-def _ensure_task_script(task, run_spec_lines, run_spec_path, jobdir, client):
-    i = _find_startswith(run_spec_lines, task)
+def _ensure_task_script(task, run_spec_lines, files):
+    """Returns the lines of the script for a run-spec task, adding the task to
+    the run-spec if needed.
+    """
+    i = _find_option(run_spec_lines, task)
     if i >= 0:
         task_file = run_spec_lines[i].split('=', 1)[1].strip()
     else:
         task_file = '{0}.sh'.format(task)
-        cmd = "echo '#!/bin/bash' > {0}/{1}".format(jobdir, task_file)
-        stdin, stdout, sterr = client.exec_command(cmd)
-        stdout.channel.recv_exit_status()
-        cmd = 'chmod 755 {0}/{1}'.format(jobdir, task_file)
-        stdin, stdout, sterr = client.exec_command(cmd)
-        stdout.channel.recv_exit_status()
-        cmd = 'echo "{0} = {1}" >> {2}/{3}'.format(task, task_file, 
-                                                   jobdir, run_spec_path)
-        stdin, stdout, sterr = client.exec_command(cmd)
-        stdout.channel.recv_exit_status()
-    return task_file
-
-def _ensure_runspec_option(option, run_spec_lines, run_spec_path, jobdir, client, value):
-    i = _find_startswith(run_spec_lines, option)
-    if i >= 0:
-        old_val = run_spec_lines[i].split('=', 1)[1].strip()
-        if old_val != value:
-            cmd = "sed -i -e 's/{0}/{1}={2}/g' {3}/{4}".format(
-                            run_spec_lines[i], option, value, jobdir, run_spec_path)
-            stdin, stdout, sterr = client.exec_command(cmd)
-            stdout.channel.recv_exit_status()
+        run_spec_lines.append('{0} = {1}'.format(task, task_file))
+    lines = files.edit(task_file, create=True, mode=0o755)
+    if len(lines) == 0:
+        lines.append('#!/bin/bash')
+    return lines
+
+def _ensure_runspec_option(option, run_spec_lines, value):
+    i = _find_option(run_spec_lines, option)
+    line = '{0} = {1}'.format(option, value)
+    if i < 0:
+        run_spec_lines.append(line)
+    elif run_spec_lines[i].split('=', 1)[1].strip() != value:
+        run_spec_lines[i] = line
+
+def _ensure_yaml_option(option, yaml_lines, value):
+    i = _find_option(yaml_lines, option, sep=':')
+    if i < 0:
+        yaml_lines.append('{0}: {1}'.format(option, value))
     else:
-        cmd = 'echo "{0} = {1}" >> {2}/{3}'.format(option, value,
-                                                   jobdir, run_spec_path)
-        stdin, stdout, sterr = client.exec_command(cmd)
-        stdout.channel.recv_exit_status()
-
-def _ensure_yaml_option(option,yaml_lines, yaml_path, jobdir, client, value):
-    i = -1
-    for j, elem in enumerate(yaml_lines):
-        if elem.strip().startswith(option):
-            i = j
-            break
-    if i >= 0:
-        prefix = yaml_lines[i].split(':', 1)[0] 
-        old_val = yaml_lines[i].split(':', 1)[1].strip()
-        if old_val != value:
-
-            newfile = ''
-            yaml_lines[i] = prefix +': ' + value + '\n'
-            for line in yaml_lines:
-                newfile += line
-            cmd = "echo '" + newfile + "' > {0}/{1}".format(jobdir, yaml_path)
-            stdin, stdout, sterr = client.exec_command(cmd)
-            stdout.channel.recv_exit_status()
+        prefix = yaml_lines[i].split(':', 1)[0]  # keeps the indentation
+        yaml_lines[i] = prefix + ': ' + value
+
+def _add_runspec_input(run_spec_lines, filename):
+    i = _find_option(run_spec_lines, 'inputs')
+    if i < 0:
+        raise ValueError("Error with run_spec formatting.")
+    inputs = run_spec_lines[i].split('=', 1)[1].strip()
+    inputs = inputs + ',' + filename if len(inputs) > 0 else filename
+    run_spec_lines[i] = 'inputs = ' + inputs
+
+def job_script(rc, job, gid=None):
+    """Renders the shell script which puts the BaTLab scripts in a clean job
+    directory.  The scripts are hard linked from a cache on the submit node,
+    which is only refreshed when the latest upstream commit, or the ETag of the
+    archive, changes.  The script removes itself, and then prints the home 
+    directory and the job files which are edited locally, see JobFiles.  It 
+    then waits for the edited files on its standard input, installs them, and
+    submits the job, printing its gid and report URL, see JobSession.
+
+    Parameters
+    ----------
+    rc : RunControl
+        The run control, which gives the BaTLab scripts and commands.
+    job : tuple
+        The job key, (owner, repo, number).
+    gid : str, optional
+        The BaTLab id of an existing job for this pull request, to be killed.
+
+    Returns
+    -------
+    script : str
+        The job script.
+
+    """
+    parts = [job_script_header.format(jobname=quote("--".join(map(str, job))))]
+    if gid is not None:
+        parts.append(kill_template.format(kill_cmd=rc.batlab_kill_cmd, 
+                                          gid=quote(gid)))
+    # refresh the cached scripts if they have changed upstream
+    url = quote(rc.batlab_scripts_url)
+    key = hashlib.sha1(rc.batlab_scripts_url.encode('utf-8')).hexdigest()[:16]
+    cache = posixpath.join(rc.batlab_scripts_cache, key)
+    parts.append(scripts_cache_header.format(cache=quote(cache)))
+    if rc.batlab_scripts_url.endswith('.git'):
+        parts.append(git_cache_template.format(batlab_scripts_url=url))
+    elif rc.batlab_scripts_url.endswith('.zip'):
+        parts.append(zip_cache_template.format(batlab_scripts_url=url))
     else:
-        cmd = 'echo "{0}: {1}" >> {2}/{3}'.format(option, value,
-                                                  jobdir, yaml_path)
-        stdin, stdout, sterr = client.exec_command(cmd)
-        stdout.channel.recv_exit_status()
+        raise ValueError("rc.batlab_scripts_url not understood.")
+    # put the scripts on batlab in a '~/owner--repository--number' dir
+    parts.append(scripts_copy_template)
+    # print the files which are edited locally
+    paths = [rc.batlab_run_spec]
+    if rc.batlab_build_type == 'conda':
+        paths.append(posixpath.join(job[1], 'meta.yaml'))
+    parts.append(job_files_template.format(paths=' '.join(map(quote, paths)),
+                                           run_spec=quote(rc.batlab_run_spec)))
+    parts.append(submit_template.format(staging=quote(JOB_FILES_STAGING),
+                                        submit_cmd=rc.batlab_submit_cmd, 
+                                        run_spec=quote(rc.batlab_run_spec)))
+    return '\n'.join(parts)
+
+class JobSession(object):
+    """A job script which is running on the submit node.  The script first 
+    prints the job files, and then waits for the edited files on its standard
+    input before submitting the job, so that both halves of preparing a job 
+    share a single remote command.  The standard error of the script is read 
+    once it has exited, and is added to its 'error' section, if any, or else 
+    kept in a 'stderr' section.
+    """
 
+    def __init__(self, stdin, stdout, stderr):
+        """Parameters
+        ----------
+        stdin, stdout, stderr : file-like
+            The standard streams of the running script.
+
+        """
+        self.stdin = stdin
+        self.stdout = stdout
+        self.stderr = stderr
+        self.finished = False
+
+    def job_files(self):
+        """Reads the output of the script up to where it waits for the edited 
+        files, or to its end if it failed first.  Returns the sections of the 
+        output, see parse_sections().
+        """
+        marker = SECTION_MARKER.format('edits')
+        lines = []
+        while True:
+            line = self.stdout.readline()
+            if not isinstance(line, str):
+                line = line.decode('utf-8', 'replace')
+            if len(line) == 0:
+                return self._finish(lines)
+            if line.rstrip('\r\n') == marker:
+                return parse_sections(''.join(lines))
+            lines.append(line)
+
+    def submit(self, archive):
+        """Sends the tarball of edited files, see JobFiles.archive(), and reads
+        the rest of the output, which has 'gid' and 'report_url' sections if 
+        the job was submitted.  Returns the sections of this output.
+        """
+        try:
+            self.stdin.write(archive)
+            self.stdin.flush()
+        finally:
+            self._close_stdin()
+        return self._finish([self.stdout.read()])
+
+    def abort(self):
+        """Stops the script without submitting the job, if it is waiting."""
+        if self.finished:
+            return
+        self._close_stdin()  # an empty tarball can not be unpacked
+        self._finish([self.stdout.read()])
 
+    def _close_stdin(self):
+        channel = getattr(self.stdin, 'channel', None)
+        if channel is None:
+            self.stdin.close()
+        else:
+            channel.shutdown_write()
+
+    def _finish(self, output):
+        self.finished = True
+        output = [o.decode('utf-8', 'replace') if isinstance(o, bytes) else o 
+                  for o in output]
+        sections = parse_sections(''.join(output))
+        err = self.stderr.read()
+        if isinstance(err, bytes):
+            err = err.decode('utf-8', 'replace')
+        err = err.strip().splitlines()
+        if len(err) > 0:
+            sections.setdefault('error' if 'error' in sections else 'stderr', 
+                                []).extend(err)
+        return sections
+
+def run_job_script(client, path, script, sftp=None):
+    """Uploads a job script over SFTP and starts it with a single command.
+
+    Parameters
+    ----------
+    client : paramiko.SSHClient
+        A connection to the submit node.
+    path : str
+        The remote path of the script, relative to the home directory.
+    script : str
+        The script itself.
+    sftp : paramiko.SFTPClient, optional
+        An open SFTP session to upload with, one is opened if not given.
+
+    Returns
+    -------
+    session : JobSession
+        The running script.
+
+    """
+    session = client.open_sftp() if sftp is None else sftp
+    try:
+        with session.open(path, 'w') as f:
+            f.write(script)
+    finally:
+        if sftp is None:
+            session.close()
+    return JobSession(*client.exec_command('bash ' + quote(path)))
 
 
 class PolyphemusPlugin(Plugin):
@@ -138,6 +458,7 @@ class PolyphemusPlugin(Plugin):
         batlab_fetch_file=NotSpecified,
         batlab_run_spec=NotSpecified,
         batlab_build_type='custom',
+        batlab_scripts_cache='.polyphemus/scripts',
         )
 
     rcdocs = {
@@ -159,6 +480,10 @@ class PolyphemusPlugin(Plugin):
         'batlab_build_type': ("Specifies method of building code. Currently "
                               "supports 'custom' build scripts (default) "
                               " and 'conda' package building"),
+        'batlab_scripts_cache': ("The directory on the submit node, relative to "
+                                 "the home directory, where pristine copies of "
+                                 "the BaTLab scripts are kept. Job directories "
+                                 "are hard linked copies of these."),
         }
 
     def update_argparser(self, parser):
@@ -176,6 +501,8 @@ class PolyphemusPlugin(Plugin):
                             help=self.rcdocs["batlab_run_spec"])
         parser.add_argument('--batlab-build-type',dest='batlab_build_type',
                             help=self.rcdocs["batlab_build_type"])
+        parser.add_argument('--batlab-scripts-cache', dest='batlab_scripts_cache',
+                            help=self.rcdocs["batlab_scripts_cache"])
 
     def setup(self, rc):
         if rc.batlab_scripts_url is NotSpecified:
@@ -189,196 +516,155 @@ class PolyphemusPlugin(Plugin):
         if rc.batlab_run_spec is NotSpecified:
             raise ValueError('batlab_run_spec must be provided!')
     
-    @runfor('batlab-run', 'github-pr-new', 'github-pr-sync')
+    @runfor('batlab-run', 'github-pr-new', 'github-pr-sync', priority='build')
     def execute(self, rc):
-        event_name = rc.event.name
-        pr = rc.event.data  # pull request object
-        #job = pr.repository + (pr.number,)  # job key (owner, repo, number) 
+        origin = rc.event  # flagged as cancelled if superseded by a newer event
+        event_name = origin.name
+        pr = origin.data  # pull request object
         job = pr.base.repo + (pr.number,)  # job key (owner, repo, number) 
-        #jobdir = "${HOME}/" + "--".join(pr.repository + (str(pr.number),))
-        jobdir = "${HOME}/" + "--".join(pr.base.repo + (str(pr.number),))
+        jobname = "--".join(pr.base.repo + (str(pr.number),))
+        jobdir = "${HOME}/" + jobname
         jobs = PersistentCache(cachefile=rc.batlab_jobs_cache)
         event = rc.event = Event(name='batlab-status', data={'status': 'error', 
-                                 'number': pr.number, 'description': ''})
-        # connect to batlab
-        key = paramiko.RSAKey(filename=rc.ssh_key_file)
-        client = paramiko.SSHClient()
-        client.load_system_host_keys()
-        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        #client.get_host_keys().add(BATLAB_SUBMIT_HOSTNAME, 'ssh-rsa', key)
+                                 'owner': job[0], 'repo': job[1],
+                                 'number': pr.number, 'sha': pr.head.sha,
+                                 'description': ''})
+        if rc.batlab_build_type not in ('conda', 'custom'):
+            event.data['description'] = 'Invalid batlab_build_type'
+            return
+        if origin.cancelled:
+            return
+        # if sync event, kill an existing job.
+        gid = None
+        if event_name == 'github-pr-sync' and job in jobs:
+            gid = jobs[job]['gid']
         try:
-            client.connect(BATLAB_SUBMIT_HOSTNAME, username=rc.batlab_user,
-                           key_filename=rc.ssh_key_file)
+            script = job_script(rc, job, gid=gid)
+        except ValueError as e:
+            event.data['description'] = str(e)
+            return
+        # get a pooled connection to batlab
+        try:
+            client = SSH_POOL.client()
+            sftp = client.open_sftp()
         except (paramiko.BadHostKeyException, paramiko.AuthenticationException, 
                 paramiko.SSHException, socket.error):
             msg = 'Error connecting to BaTLab.'
             warn(msg, RuntimeWarning)
             event.data['description'] = msg
             return
-        # if sync event, kill an existing job.
-        if event_name == 'github-pr-sync' and job in jobs:
-            try:
-                cmd = rc.batlab_kill_cmd + ' ' + jobs[job]['gid']
-                sin, out, err = client.exec_command(cmd)
-                out.channel.recv_exit_status()
-            except paramiko.SSHException:
-                event.data['description'] = "Error killing existing BaTLab job."
-                return
-            del jobs[job]
-
-        # make sure we have a clean jobdir
-        stdin, stdout, sterr = client.exec_command('rm -rf ' + jobdir)
-        stdout.channel.recv_exit_status()
-        # put the scripts on batlab in a '~/owner--reposiotry--number' dir
-        if rc.batlab_scripts_url.endswith('.git'):
-            cmd = 'git clone {0} {1}'.format(rc.batlab_scripts_url, jobdir)
-            try:
-                stdin, stdout, sterr = client.exec_command(cmd)
-                stdout.channel.recv_exit_status()
-            except paramiko.SSHException:
-                event.data['description'] = "Error cloning BaTLab scripts."
-                return            
-        elif rc.batlab_scripts_url.endswith('.zip'):
-            cmds = unzip_cmds_template.format(jobdir=jobdir, 
-                    batlab_scripts_url=rc.batlab_scripts_url)
-
-            try:
-                stdin, stdout, sterr = client.exec_command(cmds)
-                stdout.channel.recv_exit_status()
-            except paramiko.SSHException:
-                event.data['description'] = "Error unzipping BaTLab scripts."
-                return            
-            cmd = 'ls {0}'.format(jobdir)
-            stdin, stdout, sterr = client.exec_command(cmd)
-            stdout.channel.recv_exit_status()
- 
-            ls = stdout.read().split()
-            if len(ls) == 1:
-                try:
-                    cmd = 'mv {0}/{1}/* {0}'.format(jobdir, ls[0])
-                    stdin, stdout, sterr = client.exec_command(cmd)
-                    stdout.channel.recv_exit_status()
-                except paramiko.SSHException:
-                    event.data['description'] = "Error moving BaTLab scripts."
-                    return            
-        else:
-            raise ValueError("rc.batlab_scripts_url not understood.")
-
-        head_repo = github3.repository(*pr.head.repo)
         try:
-            if rc.batlab_build_type == 'conda':
-                cmd = 'cat {0}/{1}/meta.yaml'.format(jobdir, job[1])
-                yaml_path = '{0}/meta.yaml'.format(job[1])
-                _, x, _ = client.exec_command(cmd)
-                x.channel.recv_exit_status()
-                meta_lines = x.readlines()
-                newurl = head_repo.archive_urlt.expand(
-                    ref=pr.head.ref, archive_format='tarball')
-                _ensure_yaml_option("url", meta_lines, yaml_path, jobdir, 
-                                    client, newurl)
-            elif rc.batlab_build_type == "custom":
-                fetch = git_fetch_template.format(repo_url=head_repo.clone_url,
-                                                  repo_dir=job[1], branch=pr.head.ref)
-                cmd = 'echo "{0}" > {1}/{2}'.format(fetch, jobdir,
-                                             rc.batlab_fetch_file)
-                stdin, stdout, sterr = client.exec_command(cmd)
-                stdout.channel.recv_exit_status()
-                
-            else:
-                event.data['description'] = 'Invalid batlab_build_type'
+            # put the scripts in a clean jobdir and read the job files
+            try:
+                session = run_job_script(client, jobname + '.sh', script, 
+                                         sftp=sftp)
+                sections = session.job_files()
+            except (paramiko.SSHException, IOError, socket.error):
+                event.data['description'] = "Error running the BaTLab job script."
                 return
-
-        except paramiko.SSHException:
-            event.data['description'] = "Error overwriting Fetch fields."
-            return     
-
-        # append callbacks to run spec
-        try:
-            cmd = 'cat {0}/{1}'.format(jobdir, rc.batlab_run_spec)
-            _, x, _ = client.exec_command(cmd)
-            x.channel.recv_exit_status()
-            append = ', <a href="{0}/dashboard">{1}</a>'.format(
-                rc.server_url, 
-                "Polyphemus Dashboard")
-            run_spec_lines = [l.strip() for l in x.readlines()]
-            run_spec_lines = [
-                (l + append if l.split('=')[0].strip() == "description" else l) 
-                for l in run_spec_lines
-                ]
-            
-            pre_file = _ensure_task_script('pre_all', run_spec_lines, 
-                                           rc.batlab_run_spec, jobdir, client)
-            pre_curl = pre_curl_template.format(number=pr.number, port=rc.port, 
-                                                server_url=rc.server_url)
-            cmd = 'echo "{0}" >> {1}/{2}'.format(pre_curl, jobdir, pre_file)
-            sin, out, err = client.exec_command(cmd)
-            out.channel.recv_exit_status()
-            post_file = _ensure_task_script('post_all', run_spec_lines, 
-                                            rc.batlab_run_spec, jobdir, client)
-            _ensure_runspec_option('always_run_post_all', run_spec_lines, 
-                                   rc.batlab_run_spec, jobdir, client, 'true')
-            post_curl = post_curl_template.format(number=pr.number, port=rc.port, 
-                                                  server_url=rc.server_url)
-
-            cmd = 'echo "{0}" >> {1}/{2}'.format(post_curl, jobdir, post_file)
-            stdin, stdout, sterr = client.exec_command(cmd)
-            stdout.channel.recv_exit_status()
-        except paramiko.SSHException:
-            event.data['description'] = "Error appending BaTLab callbacks."
-            return            
-
-        # create scp for jobdir
-        jobdir_scp = jobdir_scp_template.format(jobdir=jobdir)
-        cmd = 'echo "{0}" >> {1}/jobdir.scp'.format(jobdir_scp, jobdir)
-        try:
-            stdin, stdout, sterr = client.exec_command(cmd)
-            stdout.channel.recv_exit_status()
-        except paramiko.SSHException:
-            event.data['description'] = "Error creating jobdir.scp file."
-            return            
-
+            if gid is not None:
+                del jobs[job]
+        finally:
+            sftp.close()
+        if 'error' in sections:
+            event.data['description'] = '\n'.join(sections['error']).strip()
+            return
+        files = JobFiles(sections)
+        home = ''.join(sections.get('home', [])).strip()
         try:
-            inputs = run_spec_lines[_find_startswith(run_spec_lines, 'inputs')].strip()
-        except IndexError:
-            event.data['description'] = "Error with run_spec formatting."
+            run_spec_lines = self._edit_job_files(rc, pr, job, jobname, files, home)
+        except ValueError as e:
+            event.data['description'] = str(e)
+            session.abort()
+            return
+        if rc.verbose:
+            print("BaTLab run spec:\n" + '\n'.join(run_spec_lines))
+        if origin.cancelled:
+            # the newer event prepares its own job directory
+            session.abort()
             return
 
-        if len(inputs.split('=', 1)[-1].strip()) > 0:
-            cmd = "sed -i 's:{0}:{0},jobdir.scp:' {1}/{2}"
-        else:
-            cmd = "sed -i 's:{0}:jobdir.scp:' {1}/{2}"
+        # install the edited files and submit the job
         try:
-            stdin, stdout, sterr = client.exec_command(cmd.format(inputs,
-                                                                  jobdir, 
-                                                                  rc.batlab_run_spec))
-            stdout.channel.recv_exit_status()
-        except paramiko.SSHException:
-            event.data['description'] = "Error adding jobdir.scp to inputs."
-            return            
-
-        # submit the job
-        cmd = 'cd {0}; {1} {2}'
-        cmd = cmd.format(jobdir, rc.batlab_submit_cmd, rc.batlab_run_spec)
-        try:
-            _, submitout, submiterr = client.exec_command(cmd)
-            submitout.channel.recv_exit_status()
-        except paramiko.SSHException:
+            sections = session.submit(files.archive())
+        except (paramiko.SSHException, IOError, socket.error):
             event.data['description'] = "Error submitting BaTLab job."
             return
-        err = submiterr.read().strip()
-        if 0 < len(err):
+        if 'error' in sections:
+            err = '\n'.join(sections['error']).strip()
             event.data['description'] = err
             warn("BaTLab job unsuccessfully submitted:\n" + err, RuntimeWarning)
             return
-
-        # clean up
-        lines = submitout.readlines()
-        report_url = lines[-1].strip()
-        gid = lines[0].split()[-1]
-        client.close()
-        jobs[job] = {'gid': gid, 'report_url': report_url, 'dir': jobdir}
+        gid = ''.join(sections.get('gid', [])).strip()
+        report_url = ''.join(sections.get('report_url', [])).strip()
+        if len(gid) == 0:
+            event.data['description'] = "Error submitting BaTLab job."
+            return
+        jobs[job] = {'gid': gid, 'report_url': report_url, 'dir': jobdir, 
+                     'sha': pr.head.sha}
         if rc.verbose:
             print("BaTLab reporting link: " + report_url)
         event.data.update(status='pending', description="BaTLab job submitted.",
                           target_url=report_url)
 
+    def _head_urls(self, rc, pr):
+        """Returns the clone URL of the head repository of a pull request and 
+        the URL of a tarball of its head ref.  These come from the webhook 
+        payload when they can, and otherwise the repository is fetched with 
+        the shared GitHub client.
+        """
+        head = pr.head
+        clone_url = getattr(head, 'clone_url', None)
+        archive_url = head.archive('tarball') if hasattr(head, 'archive') else None
+        if clone_url is not None and archive_url is not None:
+            return clone_url, archive_url
+        if head.repo is None:
+            raise ValueError("The head repository of the pull request is gone.")
+        gh = github_client(user=rc.github_user, credfile=rc.github_credentials)
+        head_repo = gh.repository(*head.repo)
+        return head_repo.clone_url, head_repo.archive_urlt.expand(
+            ref=head.ref, archive_format='tarball')
+
+    def _edit_job_files(self, rc, pr, job, jobname, files, home):
+        """Edits the files in a job directory for a pull request, in memory.  
+        Returns the lines of the run-spec.  Raises a ValueError with a 
+        description of the step which failed.
+        """
+        clone_url, archive_url = self._head_urls(rc, pr)
+        try:
+            if rc.batlab_build_type == 'conda':
+                meta_lines = files.edit(posixpath.join(job[1], 'meta.yaml'))
+                _ensure_yaml_option('url', meta_lines, archive_url)
+            elif rc.batlab_build_type == 'custom':
+                fetch = git_fetch_template.format(repo_url=clone_url,
+                                                  repo_dir=job[1], branch=pr.head.ref)
+                files.edit(rc.batlab_fetch_file, create=True)[:] = fetch.splitlines()
+        except IOError:
+            raise ValueError("Error overwriting Fetch fields.")
+
+        # append callbacks to run spec
+        kw = dict(owner=job[0], repo=job[1], number=pr.number, port=rc.port, 
+                  server_url=rc.server_url)
+        try:
+            run_spec_lines = files.edit(rc.batlab_run_spec)
+            append = ', <a href="{0}/dashboard">{1}</a>'.format(
+                rc.server_url, 
+                "Polyphemus Dashboard")
+            i = _find_option(run_spec_lines, 'description')
+            if i >= 0:
+                run_spec_lines[i] += append
+            pre_lines = _ensure_task_script('pre_all', run_spec_lines, files)
+            pre_lines.extend(pre_curl_template.format(**kw).splitlines())
+            post_lines = _ensure_task_script('post_all', run_spec_lines, files)
+            post_lines.extend(post_curl_template.format(**kw).splitlines())
+            _ensure_runspec_option('always_run_post_all', run_spec_lines, 'true')
+        except IOError:
+            raise ValueError("Error appending BaTLab callbacks.")
+
+        # create scp for jobdir
+        if len(home) == 0:
+            raise ValueError("Error creating jobdir.scp file.")
+        jobdir_scp = jobdir_scp_template.format(jobdir=posixpath.join(home, jobname))
+        files.edit('jobdir.scp', create=True).extend(jobdir_scp.splitlines())
+        _add_runspec_input(run_spec_lines, 'jobdir.scp')
+        return run_spec_lines
@@ -2,16 +2,37 @@
 
 This module is available as an polyphemus plugin by the name `polyphemus.batlabstat`.
 
+BaTLab jobs report their status by calling back to the ``/batlabstatus`` route
+from their pre_all and post_all tasks.  If a callback never arrives, because
+this server was unreachable or the job died, the pull request would stay 
+pending forever.  So, when ``batlab_status_cmd`` is given, a background poller 
+also asks the submit node for the status of every job in the jobs cache, with 
+one batched remote command per round, and dispatches a 'batlab-status' event 
+whenever a job's status has changed.  A job having finished does not mean that
+its tests passed, so the result of a finished job is read from its run log, as
+printed by ``batlab_result_cmd``, in the same way as the post_all callback 
+does.  Without this command, finished jobs are left to their callbacks.  The 
+poller idles while no jobs are in flight, polls every ``batlab_poll_interval``
+seconds after a change, and backs off while nothing changes, up to 
+``batlab_poll_max_interval`` divided by the number of jobs in flight.
+
 BaTLab Status API
 =================
 """
 from __future__ import print_function
 import os
 import io
+import re
 import sys
 import pprint
+import threading
 from warnings import warn
 
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
 if sys.version_info[0] >= 3:
     basestring = str
 
@@ -25,6 +46,105 @@ from flask import request
 from .utils import RunControl, NotSpecified, PersistentCache
 from .plugins import Plugin
 from .event import Event, runfor
+from .batlabbase import SSH_POOL, SECTION_MARKER, parse_sections
+from .dispatch import QueueFull, pull_request_key
+
+batch_script_template = \
+"""for gid in {gids}; do
+    echo "{marker}"
+    {cmd} "$gid" 2>&1
+done
+"""
+
+STATUS_WORDS = (
+    ('error', ('error', 'removed', 'aborted', 'cancelled', 'canceled', 'killed')),
+    ('pending', ('pending', 'running', 'queued', 'idle', 'submitted')),
+    ('finished', ('finished', 'complete', 'completed', 'done', 'failed', 
+                  'success', 'succeeded', 'passed')),
+    )
+"""Pairs of states and the whole words which indicate them in the output of the
+status command, in order of precedence.  Pending comes before finished so that
+a result is never read early."""
+
+def parse_status(lines):
+    """Returns the state of a job, as one of 'error', 'pending', or 'finished',
+    from the lines output by the status command, or None if this is not 
+    understood.
+    """
+    words = set(re.findall(r'[a-z]+', '\n'.join(lines).lower()))
+    for state, indicators in STATUS_WORDS:
+        if not words.isdisjoint(indicators):
+            return state
+    return None
+
+def parse_result(lines):
+    """Returns the result of a finished job, 'success' if every task in its run 
+    log returned zero and 'failure' otherwise, or None if the log has no task 
+    return values.  This follows the post_all callback.
+    """
+    values = re.findall(r'return value (\d+)', '\n'.join(lines))
+    if len(values) == 0:
+        return None
+    return 'success' if all(int(v) == 0 for v in values) else 'failure'
+
+def run_batched(client, cmd, gids):
+    """Runs a command for each of many BaTLab jobs with a single remote command.
+
+    Parameters
+    ----------
+    client : paramiko.SSHClient
+        A connection to the submit node.
+    cmd : str
+        The command, which is given the gid of a job.
+    gids : sequence of str
+        The job ids.
+
+    Returns
+    -------
+    outputs : dict
+        Maps gids to the lines output by the command.
+
+    """
+    script = batch_script_template.format(
+        gids=' '.join(quote(gid) for gid in gids), 
+        marker=SECTION_MARKER.format('$gid'), cmd=cmd)
+    _, stdout, _ = client.exec_command(script)
+    output = stdout.read()
+    stdout.channel.recv_exit_status()
+    sections = parse_sections(output)
+    return dict((gid, sections.get(gid, [])) for gid in gids)
+
+def poll_statuses(client, status_cmd, gids, result_cmd=None):
+    """Queries the statuses of many BaTLab jobs, with one remote command for the
+    states of the jobs and, if any have finished, one for their results.
+
+    Parameters
+    ----------
+    client : paramiko.SSHClient
+        A connection to the submit node.
+    status_cmd : str
+        The command which prints the status of a job, given its gid.
+    gids : sequence of str
+        The job ids.
+    result_cmd : str, optional
+        The command which prints the run log of a job, given its gid.
+
+    Returns
+    -------
+    statuses : dict
+        Maps gids to 'pending', 'error', 'success', or 'failure', or to None 
+        if the status is not known.
+
+    """
+    states = dict((gid, parse_status(lines)) for gid, lines in 
+                  run_batched(client, status_cmd, gids).items())
+    finished = sorted(gid for gid, state in states.items() if state == 'finished')
+    results = {}
+    if len(finished) > 0 and result_cmd is not None:
+        results = dict((gid, parse_result(lines)) for gid, lines in 
+                       run_batched(client, result_cmd, finished).items())
+    return dict((gid, results.get(gid) if state == 'finished' else state) 
+                for gid, state in states.items())
 
 class PolyphemusPlugin(Plugin):
     """This class routes batlab status updates."""
@@ -37,6 +157,168 @@ class PolyphemusPlugin(Plugin):
 
     _rm_job_stats = frozenset(['success', 'failure', 'error'])
 
+    _build_events = frozenset(['batlab-run', 'github-pr-new', 'github-pr-sync'])
+
+    defaultrc = RunControl(
+        batlab_status_cmd=NotSpecified,
+        batlab_result_cmd=NotSpecified,
+        batlab_poll_interval=60.0,
+        batlab_poll_max_interval=900.0,
+        )
+
+    rcdocs = {
+        'batlab_status_cmd': ("The command on the BaTLab submit node which prints "
+                              "the status of a job, given its gid. If given, the "
+                              "statuses of jobs are also polled in the "
+                              "background, in case their callbacks fail."),
+        'batlab_result_cmd': ("The command on the BaTLab submit node which prints "
+                              "the run log of a job, given its gid. This is used "
+                              "to tell whether a job which the status poller "
+                              "found finished has passed."),
+        'batlab_poll_interval': ("The shortest number of seconds between polls "
+                                 "of BaTLab job statuses."),
+        'batlab_poll_max_interval': ("The longest number of seconds between polls "
+                                     "of BaTLab job statuses, while a single job "
+                                     "is in flight. This is divided among the jobs "
+                                     "when there are more."),
+        }
+
+    def __init__(self):
+        self._statuses = {}  # job -> last known status
+        self._statuses_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._poller = None
+
+    def update_argparser(self, parser):
+        parser.add_argument('--batlab-status-cmd', dest='batlab_status_cmd',
+                            help=self.rcdocs["batlab_status_cmd"])
+        parser.add_argument('--batlab-result-cmd', dest='batlab_result_cmd',
+                            help=self.rcdocs["batlab_result_cmd"])
+        parser.add_argument('--batlab-poll-interval', dest='batlab_poll_interval',
+                            help=self.rcdocs["batlab_poll_interval"])
+        parser.add_argument('--batlab-poll-max-interval', 
+                            dest='batlab_poll_max_interval',
+                            help=self.rcdocs["batlab_poll_max_interval"])
+
+    def setup(self, rc):
+        rc.batlab_poll_interval = float(rc.batlab_poll_interval)
+        rc.batlab_poll_max_interval = max(float(rc.batlab_poll_max_interval), 
+                                          rc.batlab_poll_interval)
+        if rc.batlab_status_cmd is NotSpecified or rc.batlab_poll_interval <= 0.0:
+            return
+        self._poller = threading.Thread(target=self._poll_loop, args=(rc,), 
+                                        name='polyphemus-batlab-poller')
+        self._poller.daemon = True
+        self._poller.start()
+
+    def dispatched(self, rc, event):
+        if event.name == 'batlab-status' and 'number' in event.data:
+            data = event.data
+            job = (data.get('owner', rc.github_owner), 
+                   data.get('repo', rc.github_repo), data['number'])
+            with self._statuses_lock:
+                self._statuses[job] = data['status']
+
+    def completed(self, rc, event):
+        if event.name in self._build_events:
+            # a new job may have been submitted, which starts out pending
+            key = pull_request_key(event)
+            if key is not None:
+                with self._statuses_lock:
+                    self._statuses.pop(key, None)
+            self._wake.set()
+
+    def teardown(self, rc):
+        self._stop.set()
+        self._wake.set()
+        if self._poller is not None:
+            self._poller.join()
+            self._poller = None
+
+    def _poll(self, rc):
+        """Polls the statuses of all jobs in flight, dispatching an event for 
+        each that has changed.  Returns the number of jobs in flight and 
+        whether any status changed.  Since a job may be replaced while the 
+        submit node is queried, the jobs cache is read again before each 
+        status is dispatched, and statuses for gids which are no longer in the
+        cache are dropped.
+        """
+        jobs = PersistentCache(cachefile=rc.batlab_jobs_cache)
+        inflight = dict((job, info) for job, info in jobs.items() 
+                        if isinstance(job, tuple) and 'gid' in info)
+        with self._statuses_lock:
+            for job in list(self._statuses.keys()):
+                if job not in inflight:
+                    self._statuses.pop(job, None)
+        if len(inflight) == 0:
+            return 0, False
+        gids = dict((info['gid'], job) for job, info in inflight.items())
+        result_cmd = None if rc.batlab_result_cmd is NotSpecified \
+                     else rc.batlab_result_cmd
+        statuses = poll_statuses(SSH_POOL.client(), rc.batlab_status_cmd, 
+                                 sorted(gids), result_cmd=result_cmd)
+        changed = False
+        for gid, status in statuses.items():
+            job = gids[gid]
+            with self._statuses_lock:
+                known = self._statuses.get(job, 'pending')
+            if status is None or status == known:
+                continue
+            info = self._current_job(rc, job, gid)
+            if info is None:
+                continue  # replaced or finished while polling
+            data = {'status': status, 'owner': job[0], 'repo': job[1], 
+                    'number': job[2], 'target_url': info['report_url']}
+            if 'sha' in info:
+                data['sha'] = info['sha']
+            try:
+                rc.dispatcher.submit(Event(name='batlab-status', data=data))
+            except QueueFull:
+                continue  # try again next round
+            changed = True
+            if status in self._rm_job_stats:
+                jobs = PersistentCache(cachefile=rc.batlab_jobs_cache)
+                with jobs.lock:
+                    jobs.load()
+                    if jobs.get(job, {}).get('gid') == gid:
+                        del jobs[job]
+                with self._statuses_lock:
+                    self._statuses.pop(job, None)
+        return len(inflight), changed
+
+    def _current_job(self, rc, job, gid):
+        """Returns the cached info for a job if it is still the one with the 
+        given gid, or None otherwise.
+        """
+        info = PersistentCache(cachefile=rc.batlab_jobs_cache).get(job)
+        if info is None or info.get('gid') != gid:
+            return None
+        return info
+
+    def _poll_loop(self, rc):
+        interval = rc.batlab_poll_interval
+        while not self._stop.is_set():
+            try:
+                njobs, changed = self._poll(rc)
+            except Exception as e:
+                # keep polling, the next round may succeed
+                warn("could not poll BaTLab job statuses: {0}".format(e), 
+                     RuntimeWarning)
+                njobs, changed = 1, False
+            if changed:
+                interval = rc.batlab_poll_interval
+            else:
+                ceiling = rc.batlab_poll_max_interval / max(njobs, 1)
+                interval = max(rc.batlab_poll_interval, min(2.0 * interval, ceiling))
+            if njobs == 0:
+                # idle until a job may have been submitted
+                interval = rc.batlab_poll_interval
+                self._wake.wait(rc.batlab_poll_max_interval)
+            else:
+                self._wake.wait(interval)
+            self._wake.clear()
+
     def response(self, rc):
         if 'status' not in request.form:
             return "\n", None
@@ -44,10 +326,13 @@ class PolyphemusPlugin(Plugin):
         if 'status' not in data:
             return "\n", None
         jobs = PersistentCache(cachefile=rc.batlab_jobs_cache)
-        job = (rc.github_owner, rc.github_repo, data['number'])
+        job = (data.get('owner', rc.github_owner), data.get('repo', rc.github_repo), 
+               data['number'])
         if job in jobs:
             if 'target_url' not in data or not data['target_url'].startswith('http'):
                 data['target_url'] = jobs[job]['report_url']
+            if 'sha' in jobs[job]:
+                data.setdefault('sha', jobs[job]['sha'])
             if data['status'] in self._rm_job_stats:
                 del jobs[job]
         event = Event(name='batlab-status', data=data)
@@ -4,6 +4,16 @@ jobs.
 This module is available as an polyphemus plugin by the name
 `polyphemus.dashboard`.
 
+The dashboard is rendered from an in-memory model of the open pull requests and
+their latest statuses, so that page views do not make any GitHub API calls.  
+The model is seeded in the background when polyphemus starts up, so that the
+server does not wait on GitHub, and is kept up to date by the pull request 
+events that are dispatched and by the statuses that are posted.  It is also 
+reconciled with GitHub every ``dashboard_reconcile_interval`` seconds, which 
+catches pull requests that were closed.  When polyphemus serves several 
+repositories, each has its own model and the repository is chosen with the 
+``repo`` query parameter, e.g. ``/dashboard?repo=owner/name``.
+
 BaTLab Dashboard API
 ====================
 """
@@ -11,8 +21,12 @@ from __future__ import print_function
 import os
 import io
 import sys
+import time
 import pprint
+import threading
 from warnings import warn
+from collections import OrderedDict, namedtuple
+from multiprocessing.pool import ThreadPool
 
 if sys.version_info[0] >= 3:
     basestring = str
@@ -22,14 +36,124 @@ try:
 except ImportError:
     import json
 
-import github3
-
 from flask import request, render_template
 
 from .utils import RunControl, NotSpecified, PersistentCache
 from .plugins import Plugin
 from .event import Event, runfor
-from .githubbase import get_pull_request_status, ensure_logged_in
+from .githubbase import get_pull_request_status, github_client, low_priority, \
+    RateLimited, STATUS_QUEUE
+
+PullSummary = namedtuple('PullSummary', ['number', 'html_url', 'sha'])
+
+StatusSummary = namedtuple('StatusSummary', ['state', 'target_url', 'description'])
+
+class DashboardModel(object):
+    """An in-memory model of the open and recently closed pull requests of a 
+    repository and of their latest statuses.  Its update_status() method has
+    the signature of a status queue listener.
+    """
+
+    def __init__(self, owner, repo, nclosed=10):
+        """Parameters
+        ----------
+        owner : str
+            The repository owner.
+        repo : str
+            The repository name.
+        nclosed : int, optional
+            The number of closed pull requests to show.
+
+        """
+        self.owner = owner
+        self.repo = repo
+        self.nclosed = nclosed
+        self._open = OrderedDict()    # number -> PullSummary
+        self._closed = OrderedDict()  # number -> PullSummary
+        self._statuses = {}           # number -> StatusSummary
+        self._shas = {}               # head sha -> number
+        self._touched = {}            # number -> time of the last event update
+        self._lock = threading.Lock()
+
+    def update_pull(self, pr):
+        """Adds or updates a pull request from a github3 PullRequest or a 
+        PullRequestInfo.  New pull requests are open, while known ones stay 
+        open or closed, since events such as a 'batlab-run' from the dashboard
+        may refer to closed pull requests.  The next reconcile() moves pull 
+        requests that have been closed or reopened.
+        """
+        summary = PullSummary(pr.number, pr.html_url, pr.head.sha)
+        with self._lock:
+            bucket = self._closed if summary.number in self._closed else self._open
+            bucket[summary.number] = summary
+            self._shas[summary.sha] = summary.number
+            self._touched[summary.number] = time.time()
+
+    def update_status(self, owner, repo, ref, state, target_url='', description='', 
+                      context=None):
+        """Sets the latest status of a pull request, given either its number or
+        the sha of its head commit.
+        """
+        if owner != self.owner or repo != self.repo:
+            return
+        with self._lock:
+            number = self._shas.get(ref) if isinstance(ref, basestring) else ref
+            if number is None:
+                return
+            self._statuses[number] = StatusSummary(state, target_url, description)
+            self._touched[number] = time.time()
+
+    def rows(self):
+        """Returns lists of (pull, status) pairs for the open and the closed pull
+        requests.  The status is None if it is not known.
+        """
+        with self._lock:
+            get = self._statuses.get
+            return ([(pr, get(n)) for n, pr in self._open.items()],
+                    [(pr, get(n)) for n, pr in self._closed.items()])
+
+    def reconcile(self, gh, pool):
+        """Replaces the model with the pull requests and statuses from GitHub.  
+        These are fetched concurrently on the given thread pool.  Pull requests
+        and statuses that were updated by events while fetching are kept.
+        """
+        started = time.time()
+        r = gh.repository(self.owner, self.repo)
+        def fetch(f, *args, **kwargs):
+            with low_priority():  # the pool's threads do not inherit this
+                return f(*args, **kwargs)
+        def status(pr):
+            s = get_pull_request_status(gh, r, pr)
+            return None if s is None else \
+                   StatusSummary(s.state, s.target_url, s.description)
+        pulls = [pool.apply_async(fetch, (list, r.iter_pulls(state='open'))),
+                 pool.apply_async(fetch, (list, r.iter_pulls(state='closed', 
+                                                             number=self.nclosed)))]
+        open_prs, closed_prs = [p.get() for p in pulls]
+        statuses = pool.map(lambda pr: fetch(status, pr), open_prs + closed_prs)
+        summary = lambda pr: PullSummary(pr.number, pr.html_url, pr.head.sha)
+        with self._lock:
+            prev = self._statuses
+            prev_pulls = dict(self._closed)
+            prev_pulls.update(self._open)
+            self._open = OrderedDict((pr.number, summary(pr)) for pr in open_prs)
+            self._closed = OrderedDict((pr.number, summary(pr)) for pr in closed_prs)
+            self._shas = dict((pr.head.sha, pr.number) for pr in open_prs + closed_prs)
+            for n, t in self._touched.items():
+                if t > started and n in prev_pulls:
+                    bucket = self._closed if n in self._closed else self._open
+                    bucket[n] = prev_pulls[n]
+                    self._shas[prev_pulls[n].sha] = n
+            self._statuses = {}
+            for pr, s in zip(open_prs + closed_prs, statuses):
+                if s is not None:
+                    self._statuses[pr.number] = s
+            for n, t in self._touched.items():
+                if t > started and n in prev:
+                    self._statuses[n] = prev[n]
+            known = set(self._open) | set(self._closed)
+            self._touched = dict((n, t) for n, t in self._touched.items() 
+                                 if n in known)
 
 class PolyphemusPlugin(Plugin):
     """This class routes the dashboard."""
@@ -38,22 +162,103 @@ class PolyphemusPlugin(Plugin):
 
     request_methods = ['GET', 'POST']
 
+    defaultrc = RunControl(
+        dashboard_threads=8,
+        dashboard_reconcile_interval=300.0,
+        )
+
+    rcdocs = {
+        'dashboard_threads': ("The number of threads that fetch pull request "
+                              "statuses for the dashboard concurrently."),
+        'dashboard_reconcile_interval': ("The number of seconds between "
+                                         "reconciling the dashboard with GitHub."),
+        }
+
+    _pr_events = frozenset(['github-pr-new', 'github-pr-sync', 'batlab-run'])
+
+    def __init__(self):
+        self.models = OrderedDict()  # (owner, repo) -> DashboardModel
+        self._pool = None
+        self._stop = threading.Event()
+        self._reconciler = None
+
+    def update_argparser(self, parser):
+        parser.add_argument('--dashboard-threads', dest='dashboard_threads',
+                            help=self.rcdocs["dashboard_threads"])
+        parser.add_argument('--dashboard-reconcile-interval', 
+                            dest='dashboard_reconcile_interval',
+                            help=self.rcdocs["dashboard_reconcile_interval"])
+
+    def setup(self, rc):
+        rc.dashboard_threads = int(rc.dashboard_threads)
+        rc.dashboard_reconcile_interval = float(rc.dashboard_reconcile_interval)
+        if not any([p.startswith('polyphemus.github') for p in rc.plugins]):
+            return
+        self._pool = ThreadPool(max(1, rc.dashboard_threads))
+        for owner, repo in rc.github_repos:
+            model = self.models[owner, repo] = DashboardModel(owner, repo)
+            STATUS_QUEUE.add_listener(model.update_status)
+        self._reconciler = threading.Thread(target=self._reconcile_loop, 
+                                            args=(rc,), name='polyphemus-dashboard')
+        self._reconciler.daemon = True
+        self._reconciler.start()
+
+    def dispatched(self, rc, event):
+        if event.name in self._pr_events and hasattr(event.data, 'head'):
+            model = self.models.get(tuple(event.data.base.repo))
+            if model is not None:
+                model.update_pull(event.data)
+
+    def teardown(self, rc):
+        self._stop.set()
+        if self._reconciler is not None:
+            self._reconciler.join()
+            self._reconciler = None
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def _reconcile(self, rc):
+        for (owner, repo), model in self.models.items():
+            try:
+                gh = github_client(user=rc.github_user, 
+                                   credfile=rc.github_credentials)
+                model.reconcile(gh, self._pool)
+            except RateLimited:
+                pass  # try again next time
+            except Exception as e:
+                warn("could not reconcile the dashboard for {0}/{1}: {2}".format(
+                     owner, repo, e), RuntimeWarning)
+
+    def _reconcile_loop(self, rc):
+        self._reconcile(rc)  # seeds the models
+        if rc.dashboard_reconcile_interval <= 0.0:
+            return
+        while not self._stop.wait(rc.dashboard_reconcile_interval):
+            self._reconcile(rc)
+
     def response(self, rc):
         resp = ""
         event = banner_message = None
-        if any([p.startswith('polyphemus.github') for p in rc.plugins]):
-            gh = github3.GitHub()
-            ensure_logged_in(gh, user=rc.github_user, credfile=rc.github_credentials)
+        if len(self.models) > 0:
+            owner, repo = rc.github_owner, rc.github_repo
+            if 'repo' in request.values:
+                owner, _, repo = request.values['repo'].partition('/')
+            if (owner, repo) not in self.models:
+                return "Unknown repository {0}/{1}.".format(owner, repo), None
             if request.method == 'POST':
+                gh = github_client(user=rc.github_user, 
+                                   credfile=rc.github_credentials)
                 number = int(request.form['number'])
-                pr = gh.pull_request(rc.github_owner, rc.github_repo, number)
+                pr = gh.pull_request(owner, repo, number)
                 if rc.verbose:
                     print("Launching pull request", pr)
                 event = Event(name='batlab-run', data=pr)
                 banner_message = ('Launched BaTLab Job for Pull Request '
                                   '<a href="{0}">#{1}</a>')
                 banner_message = banner_message.format(pr.html_url, number)
-            resp = self._ghrepsonse(rc, gh, banner_message)
+            resp = self._ghrepsonse(rc, owner, repo, banner_message)
         else:
             resp = "No polyphemus dashboard found."
         return resp, event
@@ -65,17 +270,17 @@ class PolyphemusPlugin(Plugin):
         'error': 'rgba(51, 51, 51, 0.6)',
         }
 
-    def _ghprinfo(self, rc, gh, r, pr):
-        status = get_pull_request_status(gh, r, pr)
+    def _ghprinfo(self, pr, status):
         if status is not None and status.description is None:
-            status.description = "unhelpful message"
+            status = status._replace(description="unhelpful message")
         bgcolor = "#ffffff" if status is None else self._bgcolors[status.state]
         return pr, status, bgcolor
 
-    def _ghrepsonse(self, rc, gh, banner_message=None):
-        r = gh.repository(rc.github_owner, rc.github_repo)
-        open_prs = [self._ghprinfo(rc, gh, r, pr) for pr in r.iter_pulls(state='open')]
-        closed_prs = [self._ghprinfo(rc, gh, r, pr) for pr in 
-                      r.iter_pulls(state='closed', number=10)]
-        return render_template("github_dashboard.html", rc=rc, open_prs=open_prs, 
-                               closed_prs=closed_prs, banner_message=banner_message)
+    def _ghrepsonse(self, rc, owner, repo, banner_message=None):
+        open_prs, closed_prs = self.models[owner, repo].rows()
+        open_prs = [self._ghprinfo(pr, status) for pr, status in open_prs]
+        closed_prs = [self._ghprinfo(pr, status) for pr, status in closed_prs]
+        return render_template("github_dashboard.html", rc=rc, owner=owner, 
+                               repo=repo, repos=list(self.models.keys()), 
+                               open_prs=open_prs, closed_prs=closed_prs, 
+                               banner_message=banner_message)
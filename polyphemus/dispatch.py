@@ -0,0 +1,507 @@
+"""This module provides the machinery for dispatching events to the plugin
+execution pipeline in the background.
+
+Web hooks, such as those from GitHub, expect a response within a few seconds.
+However, the plugins that handle the events generated by these requests may take
+minutes to run (cloning repositories, submitting BaTLab jobs, etc).  Rather than
+executing the pipeline inside of the web request, the response is returned
+immediately and the event is placed on a queue.  A pool of worker threads then
+drains this queue, running each event through ``Plugins.execute()``.
+
+The number of worker threads is set by the ``dispatch_workers`` run control
+parameter.  If this is zero, events are executed inline, prior to the response
+being returned, as in older versions of polyphemus.
+
+Every submitted event is passed to the plugins' dispatched() hooks and, once it
+has been executed or dropped, to their completed() hooks.
+
+Coalescing
+----------
+Pushing several commits to a pull request in quick succession generates one
+event per push, though only the build of the newest commit matters.  Events
+which refer to a pull request (see ``COALESCE_EVENTS``) are therefore keyed by
+``(owner, repository, number, group)``, where the group collects the event 
+names that are handled by the same plugins.  A new event cancels any older 
+event with the same key which is already queued, as well as one that is 
+currently executing for a different head commit.  Such events may also be held
+for ``dispatch_coalesce_window`` seconds, which is zero by default, and any 
+newer event with the same key that arrives in the meantime replaces the held
+one.  Events in 
+different groups never replace one another, so that, say, a 'batlab-run' from
+the dashboard can not cancel the work of a 'github-pr-sync'.  Cancelled events
+that are executing stop after the plugin that is currently running finishes.
+Plugins with long running steps may also check the ``cancelled`` flag of the 
+event between them, as batlabrun does before preparing and before submitting
+a job.  Events executed in the process pool do not see the flag change.
+
+Priorities
+----------
+Events are scheduled according to their priority class, in the order given by
+``PRIORITIES``.  Cheap events, such as posting statuses to GitHub, belong to the
+``'status'`` class and are always run before waiting ``'normal'`` and
+``'build'`` events.  Plugins declare their class either with the ``priority``
+keyword argument of ``runfor`` or with their ``priority`` attribute, and an
+event belongs to the heaviest class among the plugins that handle it.  The 
+number of ``'build'`` events that execute at the same time is limited by the
+``dispatch_build_limit`` run control parameter, so that builds may never
+occupy all of the workers.
+
+Repositories
+------------
+When polyphemus serves several repositories, each priority class keeps a
+separate queue for every repository, and the workers take events from these
+queues in turn.  The number of events from a single repository that may 
+execute at the same time is limited by the ``dispatch_repo_limit`` run control
+parameter.  Thus a busy repository can not starve the others.  The repository 
+of an event is found by ``repository_key()``.
+
+Batching
+--------
+Some plugins, such as ``polyphemus.githubstat``, may handle many events of the
+same kind more cheaply all at once than one at a time.  When the next event
+in a queue is handled by a plugin with an ``execute_batch()`` method, the
+worker also takes the run of events with the same name that follow it, up to
+``dispatch_batch_size`` events, and executes them with 
+``Plugins.execute_batch()``.
+
+Backpressure
+------------
+The number of events waiting to be executed is bounded by the 
+``dispatch_max_queue`` run control parameter.  Once this is reached, submitting
+another event raises ``QueueFull``, and web requests are answered with an HTTP
+503 status and a ``Retry-After`` header.  The queue depth, the number of
+rejected events, and the time that each route takes to enqueue its events are
+available from ``Dispatcher.stats()``, and are exported on the metrics route
+(see ``polyphemus.metrics``) once the dispatcher has been started.
+
+Dispatch API
+============
+"""
+from __future__ import print_function
+import sys
+import time
+import threading
+from collections import deque, OrderedDict
+try:
+    from collections.abc import Sequence, Mapping
+except ImportError:
+    from collections import Sequence, Mapping
+from warnings import warn
+
+from .metrics import REGISTRY, EVENTS_DISPATCHED, ENQUEUE_SECONDS
+
+if sys.version_info[0] >= 3:
+    basestring = str
+
+PRIORITIES = ('status', 'normal', 'build')
+"""Event priority classes, from the highest priority to the lowest."""
+
+COALESCE_EVENTS = {
+    'github-pr-new': 'github-pr',
+    'github-pr-sync': 'github-pr',
+    'batlab-run': 'batlab-run',
+    }
+"""Maps the names of events whose data is a pull request, and which may be 
+coalesced, to their groups.  Only events in the same group, which are handled
+by the same plugins, replace one another."""
+
+class QueueFull(RuntimeError):
+    """Raised when an event is submitted to a dispatcher whose queue is full."""
+
+def pull_request_key(event):
+    """Returns the ``(owner, repository, number)`` tuple of the pull request
+    that an event refers to, or None if the event may not be coalesced.
+    """
+    if event.name not in COALESCE_EVENTS:
+        return None
+    pr = event.data
+    if isinstance(pr, Sequence) and not isinstance(pr, basestring):
+        return tuple(pr) if len(pr) == 3 else None
+    try:
+        return tuple(pr.base.repo) + (pr.number,)
+    except AttributeError:
+        return None
+
+def coalesce_key(event):
+    """Returns the ``(owner, repository, number, group)`` tuple by which an
+    event is coalesced, or None if the event may not be coalesced.
+    """
+    key = pull_request_key(event)
+    if key is None:
+        return None
+    return key + (COALESCE_EVENTS[event.name],)
+
+def repository_key(event):
+    """Returns the ``(owner, repository)`` tuple of the repository that an 
+    event refers to, or None if this is not known.  This is taken from the pull
+    request of the event or from the 'owner' and 'repo' keys of its data.
+    """
+    key = pull_request_key(event)
+    if key is not None:
+        return key[:2]
+    data = event.data
+    if isinstance(data, Mapping) and 'owner' in data and 'repo' in data:
+        return (data['owner'], data['repo'])
+    return None
+
+def _head_sha(event):
+    try:
+        return event.data.head.sha
+    except AttributeError:
+        return None
+
+class Dispatcher(object):
+    """Runs events through the plugin execution pipeline on a pool of worker
+    threads.  Events may be submitted before the dispatcher is started, in which
+    case they are held until start() is called.
+    """
+
+    def __init__(self, plugins):
+        """Parameters
+        ----------
+        plugins : Plugins
+            The plugins object whose execute() method is called for each event.
+
+        """
+        self.plugins = plugins
+        self.workers = 0
+        self.coalesce_window = 0.0
+        self.limits = {}
+        self.repo_limit = 0
+        self.max_queue = 0
+        self.batch_size = 1
+        self.rejected = 0
+        self.enqueue_times = {}  # route -> [count, total seconds, max seconds]
+        # priority class -> repository -> queue, in the order that they are served
+        self._queues = dict((cls, OrderedDict()) for cls in PRIORITIES)
+        self._active = dict((cls, 0) for cls in PRIORITIES)
+        self._repo_active = {}  # repository -> number of executing events
+        self._pending = {}   # coalesce key -> (deadline, event)
+        self._latest = {}    # coalesce key -> newest event
+        self._inflight = {}  # coalesce key -> executing event
+        self._cond = threading.Condition()
+        self._threads = []
+        self._started = False
+        self._running = False
+
+    def __len__(self):
+        return sum(self._queued().values()) + len(self._pending)
+
+    def _queued(self):
+        """Returns the number of queued events in each priority class."""
+        return dict((cls, sum(map(len, repos.values()))) 
+                    for cls, repos in self._queues.items())
+
+    def full(self):
+        """Tests whether the queue has reached its maximum size."""
+        return 0 < self.max_queue <= len(self)
+
+    def start(self, workers=1, coalesce_window=0.0, limits=None, max_queue=0,
+              batch_size=1, repo_limit=0):
+        """Starts the worker threads.
+
+        Parameters
+        ----------
+        workers : int, optional
+            The number of worker threads to launch.  If this is less than one,
+            no threads are started and events are executed inline when they
+            are submitted.
+        coalesce_window : float, optional
+            The number of seconds to hold pull request events for, waiting
+            on newer events which would replace them.
+        limits : dict, optional
+            Maps priority classes to the maximum number of events of that 
+            class which may execute at the same time.  Classes that are not
+            present are only limited by the number of workers.
+        max_queue : int, optional
+            The maximum number of events that may be waiting to execute, 
+            zero or less for no limit.
+        batch_size : int, optional
+            The maximum number of events which may be executed together by
+            plugins that provide execute_batch().
+        repo_limit : int, optional
+            The maximum number of events for a single repository which may 
+            execute at the same time, zero or less for no limit.
+
+        """
+        if self._started:
+            return
+        self.workers = workers
+        self.coalesce_window = coalesce_window
+        self.limits = dict((cls, max(1, n)) for cls, n in (limits or {}).items())
+        self.max_queue = max_queue
+        self.batch_size = max(1, batch_size)
+        self.repo_limit = repo_limit
+        self._started = True
+        self._register_metrics()
+        if workers < 1:
+            for deadline, event in self._pending.values():
+                self._enqueue(event)
+            self._pending.clear()
+            for cls in PRIORITIES:
+                repos = self._queues[cls]
+                while len(repos) > 0:
+                    repo, queue = repos.popitem(last=False)
+                    while len(queue) > 0:
+                        self._execute([queue.popleft()])
+            return
+        self._running = True
+        for i in range(workers):
+            t = threading.Thread(target=self._work,
+                                 name='polyphemus-dispatch-{0}'.format(i))
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def stop(self, wait=True):
+        """Stops the worker threads once the queue has been drained.  Events
+        which are being held for coalescing are released immediately.
+
+        Parameters
+        ----------
+        wait : bool, optional
+            Whether or not to block until the workers have exited.
+
+        """
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        if wait:
+            for t in self._threads:
+                t.join()
+        self._threads = []
+
+    def submit(self, event):
+        """Places an event on the queue to be executed.
+
+        Parameters
+        ----------
+        event : Event
+            The event to run through the plugins.
+
+        Raises
+        ------
+        QueueFull
+            If the queue has reached its maximum size.  Events which replace
+            one that is held for coalescing are always accepted.
+
+        """
+        if self._started and self.workers < 1:
+            EVENTS_DISPATCHED.inc(event.name)
+            self.plugins.dispatched(event)
+            self._execute([event])
+            return
+        key = coalesce_key(event)
+        dropped = None
+        with self._cond:
+            if self.full() and (key is None or key not in self._pending):
+                self.rejected += 1
+                raise QueueFull("dispatch queue is full, {0} rejected".format(event))
+            EVENTS_DISPATCHED.inc(event.name)
+            self.plugins.dispatched(event)
+            if key is None:
+                self._enqueue(event)
+            else:
+                self._supersede(key, event)
+                if self.coalesce_window > 0.0:
+                    deadline = time.time() + self.coalesce_window
+                    if key in self._pending:
+                        dropped = self._pending[key][1]
+                    self._pending[key] = (deadline, event)
+                else:
+                    self._enqueue(event)
+            self._cond.notify()
+        if dropped is not None:
+            self.plugins.completed(dropped)
+
+    def reject(self):
+        """Counts an event that was rejected before it was submitted."""
+        with self._cond:
+            self.rejected += 1
+
+    def record_enqueue(self, route, seconds):
+        """Records the time that a route took to enqueue an event."""
+        ENQUEUE_SECONDS.observe(seconds, route)
+        with self._cond:
+            times = self.enqueue_times.get(route)
+            if times is None:
+                times = self.enqueue_times[route] = [0, 0.0, 0.0]
+            times[0] += 1
+            times[1] += seconds
+            times[2] = max(times[2], seconds)
+
+    def stats(self):
+        """Returns a dictionary of statistics about the dispatcher, which may be
+        used to size the number of workers.
+        """
+        with self._cond:
+            return {
+                'workers': self.workers,
+                'depth': len(self),
+                'queued': self._queued(),
+                'held': len(self._pending),
+                'active': dict(self._active),
+                'active_repos': dict(self._repo_active),
+                'rejected': self.rejected,
+                'enqueue_times': dict((route, tuple(times)) for route, times 
+                                      in self.enqueue_times.items()),
+                }
+
+    def _register_metrics(self):
+        """Exports the state of the dispatcher through the metrics registry."""
+        def queued():
+            with self._cond:
+                return dict(((cls,), n) for cls, n in self._queued().items())
+        def active():
+            with self._cond:
+                return dict(((cls,), n) for cls, n in self._active.items())
+        REGISTRY.gauge('polyphemus_dispatch_queued', 'Events waiting to execute, '
+                       'by priority class.', labels=('priority',), func=queued)
+        REGISTRY.gauge('polyphemus_dispatch_active', 'Events executing, by '
+                       'priority class.', labels=('priority',), func=active)
+        REGISTRY.gauge('polyphemus_dispatch_held', 'Events held for coalescing.',
+                       func=lambda: len(self._pending))
+        REGISTRY.gauge('polyphemus_dispatch_workers', 'Dispatch worker threads.',
+                       func=lambda: self.workers)
+        REGISTRY.counter('polyphemus_dispatch_rejected_total', 'Events rejected '
+                         'because the queue was full.', func=lambda: self.rejected)
+
+    def _enqueue(self, event):
+        """Appends an event to the queue for its priority class and repository.
+        Must be called with the lock held.
+        """
+        repos = self._queues[self.plugins.priority(event.name)]
+        repo = repository_key(event)
+        queue = repos.get(repo)
+        if queue is None:
+            queue = repos[repo] = deque()
+        queue.append(event)
+
+    def _supersede(self, key, event):
+        """Cancels the previous event with the same coalesce key, unless it is 
+        already executing for the same head commit.  Must be called with the lock held.
+        """
+        prev = self._latest.get(key)
+        self._latest[key] = event
+        if prev is None:
+            return
+        sha = _head_sha(event)
+        if self._inflight.get(key) is prev and sha is not None and \
+           sha == _head_sha(prev):
+            return
+        prev.cancelled = True
+
+    def _release(self):
+        """Moves held events whose windows have expired onto the queue and
+        returns the time until the next one expires.  Must be called with the
+        lock held.
+        """
+        now = time.time()
+        timeout = None
+        for key, (deadline, event) in list(self._pending.items()):
+            if deadline <= now or not self._running:
+                del self._pending[key]
+                self._enqueue(event)
+            elif timeout is None or deadline - now < timeout:
+                timeout = deadline - now
+        return timeout
+
+    def _pop(self):
+        """Returns the next events and their slot from the highest priority 
+        class whose limit has not been reached, or (None, None).  Within a class,
+        the repositories whose limits have not been reached are served in turn.
+        More than one event is returned only for runs of events which may be 
+        batched.  The slot is the ``(class, repository)`` that the events count
+        against, or None for a cancelled event, which does not count against 
+        the limits.  Must be called with the lock held.
+        """
+        for cls in PRIORITIES:
+            repos = self._queues[cls]
+            full = self._active[cls] >= self.limits.get(cls, self.workers)
+            for repo, queue in list(repos.items()):
+                if queue[0].cancelled:
+                    events, slot = [queue.popleft()], None
+                elif full:
+                    break
+                elif 0 < self.repo_limit <= self._repo_active.get(repo, 0):
+                    continue
+                else:
+                    events, slot = [queue.popleft()], (cls, repo)
+                    name = events[0].name
+                    if self.batch_size > 1 and self.plugins.batchable(name):
+                        while len(queue) > 0 and len(events) < self.batch_size \
+                              and queue[0].name == name:
+                            events.append(queue.popleft())
+                    self._active[cls] += 1
+                    self._repo_active[repo] = self._repo_active.get(repo, 0) + 1
+                    for event in events:
+                        key = coalesce_key(event)
+                        if key is not None and not event.cancelled:
+                            self._inflight[key] = event
+                # move the repository to the back of the line
+                del repos[repo]
+                if len(queue) > 0:
+                    repos[repo] = queue
+                return events, slot
+        return None, None
+
+    def _next(self):
+        """Blocks until events are available, returns (None, None) when 
+        stopped.
+        """
+        with self._cond:
+            while True:
+                timeout = self._release()
+                events, slot = self._pop()
+                if events is not None:
+                    return events, slot
+                if not self._running and len(self) == 0:
+                    return None, None
+                self._cond.wait(timeout)
+
+    def _done(self, events, slot):
+        with self._cond:
+            if slot is not None:
+                cls, repo = slot
+                self._active[cls] -= 1
+                self._repo_active[repo] -= 1
+                if self._repo_active[repo] == 0:
+                    del self._repo_active[repo]
+                self._cond.notify_all()
+            for event in events:
+                key = coalesce_key(event)
+                if key is None:
+                    continue
+                if self._inflight.get(key) is event:
+                    del self._inflight[key]
+                if self._latest.get(key) is event:
+                    del self._latest[key]
+
+    def _execute(self, events):
+        """Executes events, unless they have been cancelled, and then calls the
+        completed() hooks.
+        """
+        try:
+            live = [event for event in events if not event.cancelled]
+            if len(live) == 1:
+                self.plugins.execute(live[0])
+            elif len(live) > 1:
+                self.plugins.execute_batch(live)
+        finally:
+            for event in events:
+                self.plugins.completed(event)
+
+    def _work(self):
+        while True:
+            events, slot = self._next()
+            if events is None:
+                return
+            try:
+                self._execute(events)
+            except (Exception, SystemExit) as e:
+                # keep the worker alive, the failure has already been reported
+                msg = "execution of {0} failed: {1}".format(
+                      ", ".join(map(str, events)), e)
+                warn(msg, RuntimeWarning)
+            finally:
+                self._done(events, slot)
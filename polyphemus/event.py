@@ -4,7 +4,10 @@ from functools import wraps
 
 class Event(object):
     """A basic event class that has a kind (name, type, identifier, whatevs) and 
-    some associated data.
+    some associated data.  Events that have been superseded by newer ones are 
+    flagged as cancelled, and the remaining plugins are not executed for them.
+    Events may be pickled, in which case GitHub objects in the data are 
+    reduced to their JSON.
     """
 
     def __init__(self, name, data=None):
@@ -18,6 +21,7 @@ class Event(object):
         """
         self.name = name
         self.data = data
+        self.cancelled = False
 
     def __str__(self):
         return "{0} event holding {1}".format(self.name, self.data)
@@ -31,15 +35,42 @@ class Event(object):
             return NotImplemented
         return (self.name == other.name) and (self.data == other.data)
 
-def runfor(*events):
-    """A decorator for running only certain events.
+    def __getstate__(self):
+        # GitHub objects hold an unpicklable session, so only their JSON is 
+        # sent, e.g. to plugin worker processes, and they are rebuilt from it.
+        state = dict(self.__dict__)
+        json = getattr(self.data, '_json_data', None)
+        if json is not None:
+            state['data'] = ('__github3__', type(self.data), json)
+        return state
+
+    def __setstate__(self, state):
+        data = state['data']
+        if isinstance(data, tuple) and len(data) == 3 and data[0] == '__github3__':
+            state['data'] = data[1](data[2])
+        self.__dict__.update(state)
+
+def runfor(*events, **kwargs):
+    """A decorator for running only certain events.  The set of event names is
+    recorded on the decorated function as the ``runfor`` attribute so that the
+    plugins may route events only to the methods that handle them.
+
+    The priority class of the decorated method, one of ``'status'``, 
+    ``'normal'``, or ``'build'``, may optionally be given with the ``priority``
+    keyword argument.  This overrides the plugin's ``priority`` attribute.
     """
     events = frozenset(events)
+    priority = kwargs.pop('priority', None)
+    if len(kwargs) > 0:
+        raise TypeError("unexpected keyword arguments to runfor(): " + 
+                        ", ".join(sorted(kwargs.keys())))
     def dec(f):
         @wraps(f)
         def wrapper(self, rc, *args, **kwargs):
             if rc.event.name not in events:
                 return 
             return f(self, rc, *args, **kwargs)
+        wrapper.runfor = events
+        wrapper.priority = priority
         return wrapper
     return dec
@@ -9,10 +9,18 @@ from __future__ import print_function
 import os
 import io
 import sys
+import time
 import pprint
 import socket
+import hashlib
+import threading
 from warnings import warn
-from collections import Sequence
+from contextlib import contextmanager
+from collections import OrderedDict, namedtuple
+try:
+    from collections.abc import Sequence
+except ImportError:
+    from collections import Sequence
 from getpass import getuser, getpass
 from tempfile import NamedTemporaryFile
 
@@ -27,11 +35,102 @@ except ImportError:
 from github3 import GitHub, pull_request, repository
 import github3.events
 from flask import request
+from requests import Response
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
 
 from .utils import RunControl, NotSpecified, writenewonly, newoverwrite, \
-    DEFAULT_RC_FILE, DEFAULT_PLUGINS, nyansep, indent, check_cmd
+    DEFAULT_RC_FILE, DEFAULT_PLUGINS, nyansep, indent, check_cmd, PersistentCache
 from .plugins import Plugin
 from .event import Event, runfor
+from .metrics import REGISTRY
+
+STATUSES = REGISTRY.counter('polyphemus_github_statuses_total',
+    'Commit statuses handled by the status queue, by result.', labels=('result',))
+
+HTTP_CACHE_REQUESTS = REGISTRY.counter('polyphemus_github_http_cache_total',
+    'GitHub API reads that went through the HTTP cache, by result.', 
+    labels=('result',))
+
+class RateLimited(RuntimeError):
+    """Raised for low priority GitHub reads which can not be served while the
+    rate limit budget is reserved for writes.  The ``reset`` attribute is the 
+    time at which the budget is replenished.
+    """
+
+    def __init__(self, reset):
+        self.reset = reset
+        msg = "GitHub rate limit is low, reads are deferred until {0}"
+        super(RateLimited, self).__init__(msg.format(time.ctime(reset)))
+
+class RateLimit(object):
+    """Tracks the GitHub API rate limit from the X-RateLimit headers of 
+    responses.  Once the remaining budget falls to the reserve, it is kept for
+    writes, such as statuses, and low priority reads are served stale or 
+    deferred.
+    """
+
+    def __init__(self, reserve=100):
+        """Parameters
+        ----------
+        reserve : int, optional
+            The number of requests to keep for writes and normal reads.
+
+        """
+        self.reserve = reserve
+        self.limit = None
+        self.remaining = None
+        self.reset = 0.0
+
+    def update(self, headers):
+        """Updates the budget from the headers of a response."""
+        remaining = headers.get('X-RateLimit-Remaining')
+        if remaining is None:
+            return
+        self.limit = int(headers.get('X-RateLimit-Limit', self.limit or 0))
+        self.reset = float(headers.get('X-RateLimit-Reset', 0))
+        self.remaining = int(remaining)
+
+    def budget(self):
+        """Returns the number of requests remaining, or None if this is unknown
+        or the limit has since been reset.
+        """
+        if self.remaining is None or time.time() >= self.reset:
+            return None
+        return self.remaining
+
+    def low(self):
+        """Tests whether the budget has fallen to the reserve."""
+        budget = self.budget()
+        return budget is not None and budget <= self.reserve
+
+    def exhausted(self):
+        """Tests whether no requests remain until the limit is reset."""
+        budget = self.budget()
+        return budget is not None and budget <= 0
+
+RATE_LIMIT = RateLimit()
+"""The rate limit of the shared GitHub clients."""
+
+REGISTRY.gauge('polyphemus_github_rate_remaining', 
+    'GitHub API requests remaining until the rate limit is reset.', 
+    func=lambda: {} if RATE_LIMIT.budget() is None else {(): RATE_LIMIT.remaining})
+
+_priority = threading.local()
+
+@contextmanager
+def low_priority():
+    """A context manager which marks the GitHub reads made in it, by this 
+    thread, as low priority.  When the rate limit budget is low, these are 
+    served stale from ``HTTP_CACHE`` if possible, and otherwise raise 
+    RateLimited rather than spending the budget.
+    """
+    prev = getattr(_priority, 'low', False)
+    _priority.low = True
+    try:
+        yield
+    finally:
+        _priority.low = prev
 
 def gh_make_token(gh, user, credfile='gh.cred'):
     """Creates a github token for the user.
@@ -78,10 +177,277 @@ def ensure_logged_in(gh, user=None, credfile='gh.cred'):
         id = f.readline().strip()
     gh.login(username=user, token=token)
 
-_stat_key = lambda s: s.created_at
+class ConditionalCache(HTTPAdapter):
+    """A transport adapter for the GitHub client's session which caches GET
+    responses that have an ETag or Last-Modified header, in a bounded LRU. 
+    Later requests for the same URL are made conditional with If-None-Match or
+    If-Modified-Since.  If GitHub answers with 304 Not Modified, which does 
+    not count against the rate limit, the cached response is returned instead.
+    Every response updates ``RATE_LIMIT``, and low priority reads (see 
+    low_priority()) are not sent while the budget is low.
+    """
+
+    def __init__(self, maxsize=1024, **kwargs):
+        """Parameters
+        ----------
+        maxsize : int, optional
+            The maximum number of responses to cache.
+        kwargs : optional
+            Passed to HTTPAdapter.
+
+        """
+        super(ConditionalCache, self).__init__(**kwargs)
+        self.maxsize = maxsize
+        self._entries = OrderedDict()  # key -> (headers, content, encoding)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _key(self, prepared):
+        # the credentials are hashed so that they are not persisted to disk
+        auth = prepared.headers.get('Authorization', '')
+        if not isinstance(auth, bytes):
+            auth = auth.encode('utf-8')
+        return (prepared.url, prepared.headers.get('Accept', ''), 
+                hashlib.sha1(auth).hexdigest())
+
+    def send(self, prepared, **kwargs):
+        if prepared.method != 'GET':
+            resp = super(ConditionalCache, self).send(prepared, **kwargs)
+            RATE_LIMIT.update(resp.headers)
+            return resp
+        key = self._key(prepared)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.pop(key)
+                self._entries[key] = entry
+        if getattr(_priority, 'low', False) and RATE_LIMIT.low():
+            if entry is None:
+                HTTP_CACHE_REQUESTS.inc('deferred')
+                raise RateLimited(RATE_LIMIT.reset)
+            HTTP_CACHE_REQUESTS.inc('stale')
+            return self._response(prepared, entry[0], entry[1], entry[2])
+        if entry is not None:
+            headers = entry[0]
+            if 'ETag' in headers:
+                prepared.headers['If-None-Match'] = headers['ETag']
+            if 'Last-Modified' in headers:
+                prepared.headers['If-Modified-Since'] = headers['Last-Modified']
+        resp = super(ConditionalCache, self).send(prepared, **kwargs)
+        RATE_LIMIT.update(resp.headers)
+        if resp.status_code == 304 and entry is not None:
+            HTTP_CACHE_REQUESTS.inc('hit')
+            headers = dict(entry[0])
+            headers.update(resp.headers)  # fresh rate limit headers, etc.
+            resp.close()
+            return self._response(prepared, headers, entry[1], entry[2])
+        HTTP_CACHE_REQUESTS.inc('miss')
+        if resp.status_code == 200 and ('ETag' in resp.headers or 
+                                        'Last-Modified' in resp.headers):
+            entry = (dict(resp.headers), resp.content, resp.encoding)
+            with self._lock:
+                self._entries.pop(key, None)
+                self._entries[key] = entry
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+        return resp
+
+    def _response(self, prepared, headers, content, encoding):
+        resp = Response()
+        resp.status_code = 200
+        resp.reason = 'OK'
+        resp.headers = CaseInsensitiveDict(headers)
+        resp._content = content
+        resp.encoding = encoding
+        resp.url = prepared.url
+        resp.request = prepared
+        resp.connection = self
+        return resp
+
+    def load(self, cachefile):
+        """Loads cached responses from a file written by dump()."""
+        entries = PersistentCache(cachefile=cachefile).get('github_http', ())
+        with self._lock:
+            for key, entry in entries:
+                self._entries[key] = entry
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def dump(self, cachefile):
+        """Writes the cached responses out to a file."""
+        with self._lock:
+            entries = list(self._entries.items())
+        PersistentCache(cachefile=cachefile)['github_http'] = entries
+
+HTTP_CACHE = ConditionalCache()
+"""The HTTP cache that is mounted on the shared GitHub clients."""
+
+_clients = {}  # (user, credfile) -> (GitHub, credfile mtime)
+_clients_lock = threading.Lock()
+
+def github_client(user=None, credfile='gh.cred'):
+    """Returns a logged in GitHub instance which is shared by everyone in this
+    process that logs in with the same user and credentials file.  Reusing the
+    client keeps its HTTP connections alive between calls, and its reads go 
+    through ``HTTP_CACHE``.  The client logs in again only when the 
+    modification time of the credentials file changes.
+
+    Parameters
+    ----------
+    user : str, None, or NotSpecified, optional
+        The username to log into github with.
+    credfile : str, optional
+        The github credentials file name.
+
+    Returns
+    -------
+    gh : GitHub
+        The logged in GitHub instance.
+
+    """
+    credfile = os.path.abspath(credfile)
+    key = (user, credfile)
+    with _clients_lock:
+        gh, mtime = _clients.get(key, (None, None))
+        if gh is not None and os.path.isfile(credfile) and \
+           os.path.getmtime(credfile) == mtime:
+            return gh
+        if gh is None:
+            gh = GitHub()
+            gh._session.mount('https://', HTTP_CACHE)
+        ensure_logged_in(gh, user=user, credfile=credfile)
+        _clients[key] = (gh, os.path.getmtime(credfile))
+        return gh
+
+class PullRequestRef(object):
+    """The head or base of a pull request, as given in a webhook payload.  This
+    has the same ``sha``, ``ref``, ``label``, and ``repo`` attributes as the
+    github3 object, where ``repo`` is an ``(owner, name)`` tuple.  The 
+    ``clone_url`` and ``archive_url`` of the repository are also kept, so that
+    it need not be fetched to build from it.  These are None if the repository
+    has been deleted.
+    """
+
+    __slots__ = ('sha', 'ref', 'label', 'repo', 'clone_url', 'archive_url')
+
+    def __init__(self, payload):
+        self.sha = payload['sha']
+        self.ref = payload['ref']
+        self.label = payload.get('label')
+        repo = payload.get('repo')
+        self.repo = None if repo is None else (repo['owner']['login'], repo['name'])
+        self.clone_url = None if repo is None else repo.get('clone_url')
+        self.archive_url = None if repo is None else repo.get('archive_url')
+
+    def archive(self, archive_format='tarball'):
+        """Returns the URL of an archive of this ref, or None if the archive 
+        URL is not known.
+        """
+        if self.archive_url is None:
+            return None
+        return self.archive_url.replace('{archive_format}', archive_format
+                                        ).replace('{/ref}', '/' + self.ref)
+
+    def __getstate__(self):
+        return dict((k, getattr(self, k)) for k in self.__slots__)
+
+    def __setstate__(self, state):
+        for k, v in state.items():
+            setattr(self, k, v)
+
+class PullRequestInfo(object):
+    """A lightweight pull request built directly from a webhook payload, which
+    saves fetching it from GitHub again.  The attributes that the plugins use
+    (``number``, ``html_url``, ``head``, ``base``, and ``mergeable``) come 
+    from the payload.  Touching any other attribute, or ``mergeable`` when
+    GitHub had not yet computed it, fetches the full github3 pull request with
+    the shared client and caches it.
+    """
+
+    __slots__ = ('number', 'html_url', 'head', 'base', 'user', 'credfile', 
+                 '_mergeable', '_full')
+
+    def __init__(self, payload, user=None, credfile='gh.cred'):
+        """Parameters
+        ----------
+        payload : dict
+            The 'pull_request' object from a webhook payload.
+        user : str, None, or NotSpecified, optional
+            The username to fetch the full pull request with.
+        credfile : str, optional
+            The github credentials file name.
+
+        """
+        self.number = payload['number']
+        self.html_url = payload.get('html_url')
+        self.head = PullRequestRef(payload['head'])
+        self.base = PullRequestRef(payload['base'])
+        self.user = user
+        self.credfile = credfile
+        self._mergeable = payload.get('mergeable')
+        self._full = None
+
+    @property
+    def mergeable(self):
+        if self._mergeable is None:
+            return self.full_pull_request().mergeable
+        return self._mergeable
+
+    def full_pull_request(self):
+        """Returns the full github3 pull request, fetching it on first use."""
+        if self._full is None:
+            gh = github_client(user=self.user, credfile=self.credfile)
+            self._full = gh.pull_request(self.base.repo[0], self.base.repo[1], 
+                                         self.number)
+        return self._full
+
+    def __getattr__(self, name):
+        # only called for attributes which are not in the payload
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.full_pull_request(), name)
+
+    def __getstate__(self):
+        return dict((k, getattr(self, k)) for k in self.__slots__ if k != '_full')
+
+    def __setstate__(self, state):
+        self._full = None
+        for k, v in state.items():
+            setattr(self, k, v)
+
+    def __repr__(self):
+        return "<Pull Request #{0} on {1}/{2}>".format(self.number, *self.base.repo)
+
+def get_combined_status(r, sha):
+    """Fetches the combined status of a commit, which holds the latest status 
+    for each context, in a single request.
+
+    Parameters
+    ----------
+    r : Repository
+        A github3 repository object.
+    sha : str
+        The sha of the commit.
+
+    Returns
+    -------
+    combined : dict or None
+        The JSON of the combined status, with 'state' and 'statuses' keys.
+
+    """
+    url = r._build_url('commits', sha, 'status', base_url=r._api)
+    return r._json(r._get(url), 200)
+
+_stat_key = lambda s: s['updated_at']
+
+CommitStatus = namedtuple('CommitStatus', ['state', 'target_url', 'description'])
+"""The latest status of a commit, as read from the combined status endpoint."""
 
 def get_pull_request_status(gh, r, pr):
-    """Sets a state for every commit associated with a pull request.
+    """Gets the latest status of the head commit of a pull request, using the
+    combined status endpoint.
 
     Parameters
     ----------
@@ -94,20 +460,219 @@ def get_pull_request_status(gh, r, pr):
 
     Returns
     -------
-    status : Status or None
+    status : CommitStatus or None
         The latest pull request status or None
 
     """
     if isinstance(pr, Sequence):
         pr = gh.pull_request(*pr)
-    statuses = sorted(r.iter_statuses(pr.head.sha), key=_stat_key)
-    if len(statuses) == 0:
+    statuses = (get_combined_status(r, pr.head.sha) or {}).get('statuses')
+    if not statuses:
         return None
-    return statuses[-1]
+    s = max(statuses, key=_stat_key)
+    return CommitStatus(s.get('state'), s.get('target_url'), s.get('description'))
+
+class StatusQueue(object):
+    """A write-behind queue of commit statuses, which are posted to GitHub on a
+    background thread.  Callers should give the sha of the commit when they 
+    have it; pull request numbers are resolved to their head commits on the 
+    background thread, just before posting, so that queueing never blocks on 
+    GitHub.  While waiting, only the newest status for each commit, or pull 
+    request, and context is kept.  Statuses which are identical to the last one 
+    posted for a commit are skipped, and failed posts are retried with an 
+    exponential backoff, unless a newer status for the same commit and context
+    has been queued since.  Listeners, such as the dashboard, may be added to
+    hear about every status as it is queued.
+    """
+
+    def __init__(self, retries=3, delay=1.0, maxsent=1024):
+        """Parameters
+        ----------
+        retries : int, optional
+            The number of times to retry a failed post.
+        delay : float, optional
+            The number of seconds to wait before the first retry.
+        maxsent : int, optional
+            The number of posted statuses to remember for skipping duplicates.
+
+        """
+        self.retries = retries
+        self.delay = delay
+        self.maxsent = maxsent
+        self._pending = OrderedDict()  # (owner, repo, ref, context) -> item
+        self._sent = OrderedDict()     # (owner, repo, sha, context) -> status
+        self._newest = OrderedDict()   # (owner, repo, sha, context) -> sequence
+        self._seq = 0
+        self._repos = {}               # (id(gh), owner, repo) -> (gh, Repository)
+        self._busy = False
+        self._cond = threading.Condition()
+        self._thread = None
+        self.listeners = []
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add_listener(self, listener):
+        """Adds a function which is called with the arguments of put(), except
+        for gh, whenever a status is queued.  It should be fast.
+        """
+        self.listeners.append(listener)
+
+    def put(self, gh, owner, repo, ref, state, target_url='', description='', 
+            context=None):
+        """Queues a status to be posted, replacing any waiting status for the 
+        same commit, or pull request, and context.  This does not contact 
+        GitHub; a pull request number is resolved to its head commit when the
+        status is posted.
+
+        Parameters
+        ----------
+        gh : GitHub
+            A logged in GitHub instance to post with.
+        owner : str
+            The repository owner.
+        repo : str
+            The repository name.
+        ref : str or int
+            The sha of the commit, or the number of the pull request whose head
+            commit should be used.
+        state : str
+            Accepted values are 'pending', 'success', 'error', 'failure'.
+        target_url : str, optional
+            URL to link with this status.
+        description : str, optional
+            Flavor text.
+        context : str, optional
+            The status context, GitHub's default if None.
+
+        """
+        key = (owner, repo, ref, context)
+        with self._cond:
+            if self._pending.pop(key, None) is not None:
+                STATUSES.inc('superseded')
+            self._seq += 1
+            if isinstance(ref, basestring):
+                self._mark_newest(key, self._seq)
+            # gh, status, number of attempts, time of the next attempt, sequence
+            self._pending[key] = (gh, (state, target_url, description), 0, 0.0, 
+                                  self._seq)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, 
+                                                name='polyphemus-statuses')
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify_all()
+        for listener in self.listeners:
+            try:
+                listener(owner, repo, ref, state, target_url, description, context)
+            except Exception as e:
+                warn("status listener failed: {0}".format(e), RuntimeWarning)
+
+    def flush(self, timeout=None):
+        """Blocks until all queued statuses have been posted or given up on.
+        Returns False if the timeout, in seconds, expired first.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while len(self._pending) > 0 or self._busy:
+                wait = None if deadline is None else deadline - time.time()
+                if wait is not None and wait <= 0.0:
+                    return False
+                self._cond.wait(wait)
+        return True
+
+    def _next(self):
+        """Blocks until a status is due to be posted and returns it."""
+        with self._cond:
+            while True:
+                now = time.time()
+                wait = None
+                for key, item in self._pending.items():
+                    if item[3] <= now:
+                        del self._pending[key]
+                        self._busy = True
+                        return key, item
+                    wait = item[3] - now if wait is None else min(wait, item[3] - now)
+                self._cond.wait(wait)
+
+    def _run(self):
+        while True:
+            key, item = self._next()
+            try:
+                result = self._post(key, item)
+            except Exception as e:
+                result = self._retry(key, item, e)
+            STATUSES.inc(result)
+            with self._cond:
+                self._busy = False
+                self._cond.notify_all()
+
+    def _mark_newest(self, key, seq):
+        """Records the sequence number of the newest status for a commit and
+        context.  Must be called with the lock held.
+        """
+        self._newest.pop(key, None)
+        self._newest[key] = seq
+        while len(self._newest) > self.maxsent:
+            self._newest.popitem(last=False)
+
+    def _post(self, key, item):
+        owner, repo, ref, context = key
+        gh, status = item[:2]
+        seq = item[4]
+        if not isinstance(ref, basestring):
+            # the newest status for the head commit wins, whichever way it was
+            # queued
+            ref = gh.pull_request(owner, repo, ref).head.sha
+        sent = (owner, repo, ref, context)
+        with self._cond:
+            if self._newest.get(sent, seq) > seq:
+                return 'superseded'  # a newer status was queued or sent
+            self._mark_newest(sent, seq)
+        if self._sent.get(sent) == status:
+            return 'skipped'
+        r = self._repository(gh, owner, repo)
+        kwargs = {} if context is None else {'context': context}
+        state, target_url, description = status
+        r.create_status(ref, state=state, target_url=target_url, 
+                        description=description, **kwargs)
+        with self._cond:
+            self._sent.pop(sent, None)
+            self._sent[sent] = status
+            while len(self._sent) > self.maxsent:
+                self._sent.popitem(last=False)
+        return 'posted'
+
+    def _retry(self, key, item, err):
+        gh, status, attempts, _, seq = item
+        with self._cond:
+            if key in self._pending or self._newest.get(key, seq) > seq:
+                return 'superseded'  # a newer status is waiting or was sent
+            if attempts < self.retries:
+                when = time.time() + self.delay * 2**attempts
+                if RATE_LIMIT.exhausted():
+                    when = max(when, RATE_LIMIT.reset)
+                self._pending[key] = (gh, status, attempts + 1, when, seq)
+                return 'retried'
+        warn("could not post {0} status for {1}/{2} {3}: {4}".format(status[0], 
+             key[0], key[1], key[2], err), RuntimeWarning)
+        return 'failed'
+
+    def _repository(self, gh, owner, repo):
+        """Returns a cached repository object."""
+        key = (id(gh), owner, repo)
+        cached = self._repos.get(key)
+        if cached is None:
+            cached = self._repos[key] = (gh, gh.repository(owner, repo))
+        return cached[1]
+
+STATUS_QUEUE = StatusQueue()
+"""The status queue that set_pull_request_status() posts through."""
 
 def set_pull_request_status(pr, state, target_url="", description='', user=None, 
-                            credfile='gh.cred'):
-    """Sets a state for every commit associated ith a pull request.
+                            credfile='gh.cred', gh=None, context=None, wait=False):
+    """Sets a state for the head commit of a pull request.  The status is 
+    posted in the background by ``STATUS_QUEUE``, unless wait is True.
 
     Parameters
     ----------
@@ -123,18 +688,27 @@ def set_pull_request_status(pr, state, target_url="", description='', user=None,
         The username to log into github with.
     credfile : str, optional
         The github credentials file name.
+    gh : GitHub, optional
+        A logged in GitHub instance to use.  If not given, the shared client
+        for user and credfile is used.
+    context : str, optional
+        The status context, GitHub's default if None.
+    wait : bool, optional
+        Whether to block until the status queue has been flushed.
 
     """
-    gh = GitHub()
-    ensure_logged_in(gh, user=user, credfile=credfile)
+    if gh is None:
+        gh = github_client(user=user, credfile=credfile)
     if isinstance(pr, Sequence):
-        r = gh.repository(*pr[:2])
-        pr = gh.pull_request(*pr)
+        owner, repo, ref = pr
     else:
         #r = gh.repository(*pr.repository)  Broken on github3.py v0.8+
-        r = gh.repository(*pr.base.repo)
-    status = r.create_status(pr.head.sha, state=state, target_url=target_url, 
-                             description=description)    
+        owner, repo = pr.base.repo
+        ref = pr.head.sha
+    STATUS_QUEUE.put(gh, owner, repo, ref, state, target_url=target_url, 
+                     description=description, context=context)
+    if wait:
+        STATUS_QUEUE.flush()
 
 class PolyphemusPlugin(Plugin):
     """This class provides basic functionality for github interactions."""
@@ -144,19 +718,37 @@ class PolyphemusPlugin(Plugin):
     defaultrc = RunControl(
         github_owner=NotSpecified,
         github_repo=NotSpecified,
+        github_repos=(),
         github_events=['pull_request'],
         github_user=NotSpecified,
         github_credentials='gh.cred',
+        github_cache_size=1024,
+        github_cache_file=NotSpecified,
+        github_rate_reserve=100,
         )
 
     rcdocs = {
         'github_owner': "The repository owner on github, e.g. 'scopatz'",
         'github_repo': "The repository name on github, e.g. 'pyne'",
+        'github_repos': ("Further repositories for this server to handle, as "
+                         "'owner/repo' strings. These may be given instead of "
+                         "github_owner and github_repo, in which case the first "
+                         "is taken as the primary repository. After setup, this "
+                         "is the list of all (owner, repo) tuples."),
         'github_events': "The github events to trigger on.",
         'github_user': ("The github user name to login with.  Must have rights "
                         "to the repo."),
         'github_credentials': ("The github credentials file where token "
                                "authentication is stored."),
+        'github_cache_size': ("The maximum number of GitHub API responses to "
+                              "cache for conditional requests."),
+        'github_cache_file': ("A file to keep cached GitHub API responses in "
+                              "between runs. If not given, the cache is only "
+                              "kept in memory."),
+        'github_rate_reserve': ("The number of GitHub API requests to keep for "
+                                "posting statuses. Once the rate limit budget "
+                                "falls to this, dashboard reads are served "
+                                "from the cache or deferred."),
         }
 
     def update_argparser(self, parser):
@@ -164,17 +756,52 @@ class PolyphemusPlugin(Plugin):
                             help=self.rcdocs["github_owner"])
         parser.add_argument('--github-repo', dest='github_repo',
                             help=self.rcdocs["github_repo"])
+        parser.add_argument('--github-repos', nargs="+", dest='github_repos',
+                            help=self.rcdocs["github_repos"])
         parser.add_argument('--github-events', nargs="+", dest='github_events',
                             help=self.rcdocs["github_events"])
         parser.add_argument('--github-user', dest='github_user',
                             help=self.rcdocs["github_user"])
         parser.add_argument('--github-credentials', dest='github_credentials',
                             help=self.rcdocs["github_credentials"])
+        parser.add_argument('--github-cache-size', dest='github_cache_size',
+                            help=self.rcdocs["github_cache_size"])
+        parser.add_argument('--github-cache-file', dest='github_cache_file',
+                            help=self.rcdocs["github_cache_file"])
+        parser.add_argument('--github-rate-reserve', dest='github_rate_reserve',
+                            help=self.rcdocs["github_rate_reserve"])
 
     def setup(self, rc):
-        if rc.github_owner is NotSpecified:
-            raise ValueError('github_owner run control parameter must be specified '
-                             'to use the githubhook plugin.')
-        if rc.github_repo is NotSpecified:
-            raise ValueError('github_repo run control parameter must be specified '
-                             'to use the githubhook plugin.')
+        repos = []
+        if rc.github_owner is not NotSpecified or rc.github_repo is not NotSpecified \
+           or len(rc.github_repos) == 0:
+            if rc.github_owner is NotSpecified:
+                raise ValueError('github_owner run control parameter must be '
+                                 'specified to use the githubhook plugin.')
+            if rc.github_repo is NotSpecified:
+                raise ValueError('github_repo run control parameter must be '
+                                 'specified to use the githubhook plugin.')
+            repos.append((rc.github_owner, rc.github_repo))
+        for repo in rc.github_repos:
+            if isinstance(repo, basestring):
+                repo = repo.split('/')
+            repo = tuple(repo)
+            if len(repo) != 2:
+                raise ValueError("github_repos entries must be 'owner/repo', "
+                                 "got {0!r}".format(repo))
+            if repo not in repos:
+                repos.append(repo)
+        rc.github_repos = repos
+        rc.github_owner, rc.github_repo = repos[0]
+        rc.github_cache_size = int(rc.github_cache_size)
+        HTTP_CACHE.maxsize = rc.github_cache_size
+        rc.github_rate_reserve = int(rc.github_rate_reserve)
+        RATE_LIMIT.reserve = rc.github_rate_reserve
+        if rc.github_cache_file is not NotSpecified:
+            rc.github_cache_file = os.path.abspath(rc.github_cache_file)
+            HTTP_CACHE.load(rc.github_cache_file)
+
+    def teardown(self, rc):
+        STATUS_QUEUE.flush()
+        if rc.github_cache_file is not NotSpecified:
+            HTTP_CACHE.dump(rc.github_cache_file)
@@ -2,6 +2,12 @@
 
 This module is available as an polyphemus plugin by the name ``polyphemus.githubhook``.
 
+Deliveries are screened before their payload is parsed.  Only 'pull_request' 
+events, as given by the ``X-GitHub-Event`` header, are accepted.  When the 
+``github_secret`` run control parameter is set, the web hook is set up with 
+this secret and deliveries whose ``X-Hub-Signature-256`` header does not match 
+the HMAC-SHA256 of their body are answered with an HTTP 403 status.
+
 GitHub Hook API
 =================
 """
@@ -9,8 +15,11 @@ from __future__ import print_function
 import os
 import io
 import sys
+import hmac
 import pprint
 import socket
+import hashlib
+import threading
 from warnings import warn
 from getpass import getuser, getpass
 from tempfile import NamedTemporaryFile
@@ -26,17 +35,29 @@ try:
 except ImportError:
     import json
 
-from github3 import GitHub
 import github3.events
 from flask import request
 
 from .utils import RunControl, NotSpecified, writenewonly, \
-    DEFAULT_RC_FILE, DEFAULT_PLUGINS, nyansep, indent, check_cmd
+    DEFAULT_RC_FILE, DEFAULT_PLUGINS, nyansep, indent, check_cmd, PersistentCache
 from .plugins import Plugin
 from .event import Event, runfor
-from .githubbase import ensure_logged_in, set_pull_request_status
+from .githubbase import github_client, set_pull_request_status, PullRequestInfo
+from .metrics import REGISTRY
+
+HOOK_REJECTED = REGISTRY.counter('polyphemus_github_hook_rejected_total',
+    'GitHub web hook deliveries that were rejected, by reason.', labels=('reason',))
+
+def signature(secret, body):
+    """Returns the value of the ``X-Hub-Signature-256`` header that GitHub sends
+    for a web hook delivery with the given body, signed with the given secret.
+    """
+    if not isinstance(secret, bytes):
+        secret = secret.encode('utf-8')
+    return 'sha256=' + hmac.new(secret, body, hashlib.sha256).hexdigest()
 
-def verify_hook(owner, repo, url, events, user=None, credfile='gh.cred'):
+def verify_hook(owner, repo, url, events, user=None, credfile='gh.cred', 
+                secret=None, reset_secret=False):
     """Ensures that the github WebURL API hook has been set up properly.
 
     Parameters
@@ -54,10 +75,14 @@ def verify_hook(owner, repo, url, events, user=None, credfile='gh.cred'):
         The username to log into github with.
     credfile : str, optional
         The github credentials file name.
+    secret : str, optional
+        The secret that GitHub signs deliveries with.  GitHub does not reveal
+        the secret of an existing hook, so it is only set if the hook has none.
+    reset_secret : bool, optional
+        Whether to set the secret of an existing hook regardless.
 
     """
-    gh = GitHub()
-    ensure_logged_in(gh, user=user, credfile=credfile)
+    gh = github_client(user=user, credfile=credfile)
     r = gh.repository(owner, repo)
     for hook in r.iter_hooks():
         if hook.name != 'web':
@@ -65,8 +90,11 @@ def verify_hook(owner, repo, url, events, user=None, credfile='gh.cred'):
         elif hook.config['url'] == url:
             break
     else:
-        hook = r.create_hook(name='web', config={"url": url, "content_type": "json"}, 
-                             events=events, active=True)
+        config = {"url": url, "content_type": "json"}
+        if secret:
+            config["secret"] = secret
+        hook = r.create_hook(name='web', config=config, events=events, active=True)
+        reset_secret = False
         if hook is None:
             msg = ("failed to create github webhook for {0}/{1} pointing to {2} with " 
                    "the {3} events").format(owner, repo, url, ", ".join(events))
@@ -80,6 +108,8 @@ def verify_hook(owner, repo, url, events, user=None, credfile='gh.cred'):
         update['events'] = events
     if not hook.active:
         update['active'] = True
+    if secret and (reset_secret or not hook.config.get('secret')):
+        update['config'] = {"url": url, "content_type": "json", "secret": secret}
 
     if len(update) > 0:
         status = hook.edit(**update)
@@ -88,6 +118,19 @@ def verify_hook(owner, repo, url, events, user=None, credfile='gh.cred'):
                    "the {3} events").format(owner, repo, url, ", ".join(events))
             raise RuntimeError(msg)
 
+def hook_fingerprint(owner, repo, url, events, secret=None):
+    """Returns a string which identifies the configuration of a web hook, as 
+    set up by verify_hook().  When there is a secret, this is an HMAC keyed 
+    with it, so that the secret can not be recovered from the fingerprint.
+    """
+    config = (owner, repo, url, sorted(events), 'json', bool(secret))
+    config = repr(config).encode('utf-8')
+    if not secret:
+        return hashlib.sha1(config).hexdigest()
+    if not isinstance(secret, bytes):
+        secret = secret.encode('utf-8')
+    return hmac.new(secret, config, hashlib.sha256).hexdigest()
+
 class PolyphemusPlugin(Plugin):
     """This class provides functionality for getting data from github."""
 
@@ -97,33 +140,125 @@ class PolyphemusPlugin(Plugin):
 
     request_methods = ['GET', 'POST']
 
+    defaultrc = RunControl(
+        github_hook_cache='githubhook.cache',
+        github_hook_verify_interval=86400.0,
+        github_secret=NotSpecified,
+        )
+
+    rcdocs = {
+        'github_hook_cache': ("The file that records the fingerprint of the last "
+                              "verified web hook, so that verification may be "
+                              "skipped at startup when the hook is unchanged."),
+        'github_hook_verify_interval': ("The number of seconds between verifying "
+                                        "the web hook with GitHub in the "
+                                        "background, to catch changes made "
+                                        "there. Zero disables this."),
+        'github_secret': ("The secret that GitHub signs web hook deliveries "
+                          "with. Deliveries with a missing or wrong signature "
+                          "are rejected. If not given, deliveries are not "
+                          "verified."),
+        }
+
+    def __init__(self):
+        self._stop = threading.Event()
+        self._verifier = None
+
+    def update_argparser(self, parser):
+        parser.add_argument('--github-hook-cache', dest='github_hook_cache',
+                            help=self.rcdocs["github_hook_cache"])
+        parser.add_argument('--github-hook-verify-interval', 
+                            dest='github_hook_verify_interval',
+                            help=self.rcdocs["github_hook_verify_interval"])
+        parser.add_argument('--github-secret', dest='github_secret',
+                            help=self.rcdocs["github_secret"])
+
     def setup(self, rc):
+        rc.github_hook_cache = os.path.abspath(rc.github_hook_cache)
+        rc.github_hook_verify_interval = float(rc.github_hook_verify_interval)
+        if rc.github_secret is NotSpecified or not rc.github_secret:
+            rc.github_secret = None
         hookurl = ("{0}/githubhook" if rc.port == 80 else \
                    "{0}:{1}/githubhook").format(rc.server_url, rc.port)
-        verify_hook(rc.github_owner, rc.github_repo, hookurl, rc.github_events, 
-                    user=rc.github_user, credfile=rc.github_credentials)
+        cache = PersistentCache(cachefile=rc.github_hook_cache)
+        for owner, repo in rc.github_repos:
+            fingerprint = hook_fingerprint(owner, repo, hookurl, rc.github_events,
+                                           rc.github_secret)
+            if cache.get((owner, repo)) != fingerprint:
+                self._verify(rc, owner, repo, hookurl, reset_secret=True)
+            elif rc.verbose:
+                print("github web hook for {0}/{1} is unchanged, skipping "
+                      "verification".format(owner, repo))
+        if rc.github_hook_verify_interval > 0.0:
+            self._verifier = threading.Thread(target=self._verify_loop, 
+                                              args=(rc, hookurl),
+                                              name='polyphemus-hook-verifier')
+            self._verifier.daemon = True
+            self._verifier.start()
+
+    def teardown(self, rc):
+        self._stop.set()
+        if self._verifier is not None:
+            self._verifier.join()
+            self._verifier = None
+
+    def _verify(self, rc, owner, repo, hookurl, reset_secret=False):
+        """Verifies a repository's web hook and records its fingerprint."""
+        verify_hook(owner, repo, hookurl, rc.github_events, 
+                    user=rc.github_user, credfile=rc.github_credentials,
+                    secret=rc.github_secret, reset_secret=reset_secret)
+        PersistentCache(cachefile=rc.github_hook_cache)[(owner, repo)] = \
+            hook_fingerprint(owner, repo, hookurl, rc.github_events, 
+                             rc.github_secret)
+
+    def _verify_loop(self, rc, hookurl):
+        while not self._stop.wait(rc.github_hook_verify_interval):
+            for owner, repo in rc.github_repos:
+                try:
+                    self._verify(rc, owner, repo, hookurl)
+                except Exception as e:
+                    warn("could not verify the github web hook for {0}/{1}: "
+                         "{2}".format(owner, repo, e), RuntimeWarning)
 
     _action_to_event = {'opened': 'github-pr-new', 'synchronize': 'github-pr-sync'}
 
     def response(self, rc):
-        rawdata = json.loads(request.data)
+        # screen the delivery by its headers before reading and parsing the body
+        if request.headers.get('X-GitHub-Event') != 'pull_request':
+            HOOK_REJECTED.inc('event')
+            return "\n", None
+        body = request.get_data()
+        if rc.github_secret is not None:
+            sig = request.headers.get('X-Hub-Signature-256', '')
+            if not hmac.compare_digest(str(sig), signature(rc.github_secret, body)):
+                HOOK_REJECTED.inc('signature')
+                return ("bad signature\n", 403), None
+        rawdata = json.loads(body.decode('utf-8'))
         if 'pull_request' not in rawdata:
             return "\n", None
+        repository = rawdata.get('repository') or {}
+        repo = ((repository.get('owner') or {}).get('login') or '', 
+                repository.get('name') or '')
+        # GitHub owner and repository names are not case sensitive
+        handled = set((o.lower(), r.lower()) for o, r in rc.github_repos)
+        if (repo[0].lower(), repo[1].lower()) not in handled:
+            # a hook for a repository that this server does not handle
+            return "\n", None
         action = rawdata['action']
         if action not in self._action_to_event:
             # Can be one of 'opened', 'closed', 'synchronize', or 'reopened', 
             # but we only care about "opened" and "synchronize".
             return "\n", None
-        gh = GitHub()
-        pr = gh.pull_request(rc.github_owner, rc.github_repo, rawdata['number'])
+        pr = PullRequestInfo(rawdata['pull_request'], user=rc.github_user, 
+                             credfile=rc.github_credentials)
         event = Event(name=self._action_to_event[action], data=pr)
         return request.method + ": github\n", event
 
     @runfor(*_action_to_event.values())
     def execute(self, rc):
         """The github hook plugin is executed for 'github-pr-new' and 'github-pr-sync'
-        events.  The event data must be either a github3 PullRequest object or a
-        tuple of the form (owner, repository, number).
+        events.  The event data must be either a PullRequestInfo, a github3 
+        PullRequest object, or a tuple of the form (owner, repository, number).
         """
         event = rc.event
         pr = event.data
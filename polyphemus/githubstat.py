@@ -19,13 +19,12 @@ try:
 except ImportError:
     import json
 
-from github3 import GitHub
 import github3.events
 
 from .utils import RunControl, NotSpecified, writenewonly
 from .plugins import Plugin
 from .event import Event, runfor
-from .githubbase import set_pull_request_status
+from .githubbase import set_pull_request_status, github_client
 
 class PolyphemusPlugin(Plugin):
     """This class provides functionality for updating pull request statuses on 
@@ -41,16 +40,38 @@ class PolyphemusPlugin(Plugin):
         'error': 'Error: does not compute.',
         }
 
-    @runfor('batlab-status', 'swc-status')
+    @runfor('batlab-status', 'swc-status', priority='status')
     def execute(self, rc):
         """The githubstat plugin is only executed for 'batlab-status' and
         'swc-status' events and requires that the event data be a dictionary
         with 'status' and 'number' as keys.  It optionally may also include
-        'target_url' and 'description' keys.
+        'target_url' and 'description' keys, and a 'sha' key for the commit 
+        which was built, in which case the status is posted for that commit 
+        rather than the current head of the pull request.
         """
-        data = rc.event.data
-        pr = (rc.github_owner, rc.github_repo, data['number'])
+        self._set_status(rc, rc.event.data)
+
+    def execute_batch(self, rc, events):
+        """Sets the statuses for many 'batlab-status' and 'swc-status' events over
+        a single logged in session.  Only the last status for each pull request
+        is posted.
+        """
+        gh = github_client(user=rc.github_user, credfile=rc.github_credentials)
+        latest = {}
+        for event in events:
+            latest[self._job(rc, event.data)] = event.data
+        for data in latest.values():
+            self._set_status(rc, data, gh=gh)
+
+    def _job(self, rc, data):
+        return (data.get('owner', rc.github_owner), data.get('repo', rc.github_repo), 
+                data['number'])
+
+    def _set_status(self, rc, data, gh=None):
+        pr = self._job(rc, data)
+        if data.get('sha'):
+            pr = pr[:2] + (data['sha'],)
         set_pull_request_status(pr, data['status'], 
             target_url=data.get('target_url', ""), 
             description=data.get('description', self._status_descs[data['status']]), 
-            user=rc.github_user, credfile=rc.github_credentials)
+            user=rc.github_user, credfile=rc.github_credentials, gh=gh)
@@ -0,0 +1,188 @@
+"""The plugin to durably record dispatched events and replay them after a crash.
+
+This module is available as an polyphemus plugin by the name ``polyphemus.journal``.
+
+Every event that is handed to the dispatcher is appended to a SQLite database
+(in write-ahead logging mode) and is marked as completed once the execution
+pipeline has finished with it.  When polyphemus starts up, any events that were
+never completed, for example because the process was restarted in the middle
+of a BaTLab submission, are dispatched again.
+
+Writes happen on a background thread which groups all of the records that
+arrive within ``journal_commit_interval`` seconds into a single transaction,
+so journaling adds very little to the time it takes to respond to a web hook.
+
+Journal API
+===========
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+import uuid
+import sqlite3
+import threading
+from warnings import warn
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from .utils import RunControl
+from .plugins import Plugin
+from .event import Event
+from .githubbase import github_client
+
+if sys.version_info[0] >= 3:
+    basestring = str
+
+_schema = """CREATE TABLE IF NOT EXISTS events (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    data BLOB,
+    dispatched REAL NOT NULL,
+    completed REAL
+)"""
+
+def freeze_data(data):
+    """Converts event data into a pickled string.  Pull request objects are
+    stored as their ``(owner, repository, number)`` and are re-fetched when the
+    data is thawed.
+    """
+    if hasattr(data, 'head') and hasattr(data, 'base') and hasattr(data, 'number'):
+        data = ('__pull_request__',) + tuple(data.base.repo) + (data.number,)
+    return pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+
+def thaw_data(blob, rc):
+    """Converts a string from freeze_data() back into event data.  Pull 
+    requests are fetched with the shared GitHub client for the run control's
+    user and credentials.  Raises a ValueError if a pull request can not be
+    fetched.
+    """
+    data = pickle.loads(bytes(blob))
+    if isinstance(data, tuple) and len(data) == 4 and data[0] == '__pull_request__':
+        gh = github_client(user=getattr(rc, 'github_user', None), 
+                           credfile=getattr(rc, 'github_credentials', 'gh.cred'))
+        pr = gh.pull_request(*data[1:])
+        if pr is None:
+            raise ValueError("pull request {0}/{1}#{2} could not be "
+                             "fetched".format(*data[1:]))
+        data = pr
+    return data
+
+class PolyphemusPlugin(Plugin):
+    """This class provides a durable journal of dispatched events."""
+
+    requires = ('polyphemus.base',)
+
+    defaultrc = RunControl(
+        journal_file='journal.db',
+        journal_commit_interval=0.05,
+        )
+
+    rcdocs = {
+        'journal_file': "The SQLite file that dispatched events are journaled to.",
+        'journal_commit_interval': ("The number of seconds that journal records "
+                                    "are grouped together for before they are "
+                                    "committed."),
+        }
+
+    def __init__(self):
+        self._records = queue.Queue()
+        self._writer = None
+        self._conn = None
+
+    def update_argparser(self, parser):
+        parser.add_argument('--journal-file', dest='journal_file',
+                            help=self.rcdocs["journal_file"])
+        parser.add_argument('--journal-commit-interval',
+                            dest='journal_commit_interval',
+                            help=self.rcdocs["journal_commit_interval"])
+
+    def setup(self, rc):
+        rc.journal_file = os.path.abspath(rc.journal_file)
+        rc.journal_commit_interval = float(rc.journal_commit_interval)
+        conn = sqlite3.connect(rc.journal_file, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(_schema)
+        conn.execute('DELETE FROM events WHERE completed IS NOT NULL')
+        conn.commit()
+        rows = conn.execute('SELECT id, name, data FROM events '
+                            'ORDER BY dispatched').fetchall()
+        self._conn = conn
+        self._writer = threading.Thread(target=self._write,
+                                        args=(rc.journal_commit_interval,),
+                                        name='polyphemus-journal')
+        self._writer.daemon = True
+        self._writer.start()
+        # replay unfinished events, these are run once the dispatcher starts
+        for id, name, blob in rows:
+            try:
+                event = Event(name=name, data=thaw_data(blob, rc))
+            except Exception as e:
+                warn("could not replay journaled {0} event: {1}".format(name, e),
+                     RuntimeWarning)
+                self._records.put(('complete', id, time.time()))
+                continue
+            event.journal_id = id
+            if rc.verbose:
+                print("replaying journaled " + str(event))
+            rc.dispatcher.submit(event)
+
+    def dispatched(self, rc, event):
+        if getattr(event, 'journal_id', None) is not None:
+            return  # this is a replayed event
+        try:
+            blob = freeze_data(event.data)
+        except Exception as e:
+            warn("could not journal {0}: {1}".format(event, e), RuntimeWarning)
+            return
+        event.journal_id = uuid.uuid4().hex
+        self._records.put(('dispatch', event.journal_id, event.name, blob,
+                           time.time()))
+
+    def completed(self, rc, event):
+        id = getattr(event, 'journal_id', None)
+        if id is not None:
+            self._records.put(('complete', id, time.time()))
+
+    def _write(self, interval):
+        """Group commits journal records until a None record is received."""
+        conn = self._conn
+        done = False
+        while not done:
+            records = [self._records.get()]
+            deadline = time.time() + interval
+            while True:
+                timeout = deadline - time.time()
+                if timeout <= 0.0:
+                    break
+                try:
+                    records.append(self._records.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            with conn:
+                for record in records:
+                    if record is None:
+                        done = True
+                    elif record[0] == 'dispatch':
+                        conn.execute('INSERT OR REPLACE INTO events (id, name, '
+                                     'data, dispatched) VALUES (?, ?, ?, ?)',
+                                     (record[1], record[2],
+                                      sqlite3.Binary(record[3]), record[4]))
+                    else:
+                        conn.execute('UPDATE events SET completed = ? WHERE id = ?',
+                                     (record[2], record[1]))
+
+    def teardown(self, rc):
+        if self._writer is None:
+            return
+        self._records.put(None)
+        self._writer.join()
+        self._writer = None
+        self._conn.close()
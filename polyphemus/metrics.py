@@ -0,0 +1,213 @@
+"""Lightweight instrumentation for polyphemus, exported in the Prometheus text
+format.
+
+Polyphemus records how long each plugin spends in each phase (setup, response,
+execute) for each kind of event, as well as the number of events dispatched and
+the number of exceptions raised.  Recording a measurement only updates a few
+numbers in memory; the text exposition is only built when the metrics route,
+``/metrics`` by default, is requested.  The route may be changed or disabled
+with the ``metrics_route`` run control parameter.
+
+Plugins may add their own metrics to the module-level ``REGISTRY``::
+
+    from polyphemus.metrics import REGISTRY
+    JOBS = REGISTRY.counter('myplugin_jobs_total', 'Jobs run by my plugin.')
+    JOBS.inc()
+
+Metrics API
+===========
+"""
+from __future__ import print_function
+import threading
+from bisect import bisect_left
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+"""The content type of the Prometheus text format."""
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+                   30.0, 60.0, 120.0, 300.0, 600.0, float('inf'))
+"""Default histogram bucket upper bounds, in seconds."""
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+def _labelstr(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if len(pairs) == 0:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(n, _escape(v)) for n, v in pairs) + '}'
+
+def _fmt(x):
+    if x == float('inf'):
+        return '+Inf'
+    return repr(float(x)) if isinstance(x, float) else str(x)
+
+class Metric(object):
+    """Base class for metrics, which may have a number of label names.  Values
+    are either stored in the metric or are computed by a function at export
+    time.  Such a function takes no arguments and returns either a number or
+    a dict mapping tuples of label values to numbers.
+    """
+
+    kind = 'untyped'
+
+    def __init__(self, name, doc, labels=(), func=None):
+        """Parameters
+        ----------
+        name : str
+            The metric name.
+        doc : str
+            A description of the metric.
+        labels : sequence of str, optional
+            The label names of the metric.
+        func : callable, optional
+            A function computing the values of the metric when exported.
+
+        """
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self.func = func
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def samples(self):
+        """Returns a list of (name, label string, value) samples."""
+        if self.func is None:
+            with self._lock:
+                values = dict(self._values)
+        else:
+            values = self.func()
+            if not isinstance(values, dict):
+                values = {(): values}
+        return [(self.name, _labelstr(self.labels, k), v)
+                for k, v in sorted(values.items())]
+
+    def render(self):
+        """Returns the metric in the Prometheus text format."""
+        lines = ['# HELP {0} {1}'.format(self.name, self.doc.replace('\n', ' ')),
+                 '# TYPE {0} {1}'.format(self.name, self.kind)]
+        for name, labels, value in self.samples():
+            lines.append('{0}{1} {2}'.format(name, labels, _fmt(value)))
+        return '\n'.join(lines)
+
+class Counter(Metric):
+    """A monotonically increasing count."""
+
+    kind = 'counter'
+
+    def inc(self, *labels, **kwargs):
+        """Increments the counter for the given label values by the ``amount``
+        keyword argument, default 1.
+        """
+        amount = kwargs.get('amount', 1)
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+class Gauge(Metric):
+    """A value that may go up or down."""
+
+    kind = 'gauge'
+
+    def set(self, value, *labels):
+        """Sets the gauge for the given label values."""
+        with self._lock:
+            self._values[labels] = value
+
+class Histogram(Metric):
+    """Counts observations, such as durations, in cumulative buckets."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, doc, labels=(), buckets=DEFAULT_BUCKETS):
+        """Parameters
+        ----------
+        name : str
+            The metric name.
+        doc : str
+            A description of the metric.
+        labels : sequence of str, optional
+            The label names of the metric.
+        buckets : sequence of float, optional
+            The sorted upper bounds of the buckets, ending with infinity.
+
+        """
+        super(Histogram, self).__init__(name, doc, labels=labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        """Records an observation for the given label values."""
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                # per bucket counts, followed by the sum of the observations
+                counts = self._values[labels] = [0] * len(self.buckets) + [0.0]
+            counts[i] += 1
+            counts[-1] += value
+
+    def samples(self):
+        with self._lock:
+            values = dict((k, list(v)) for k, v in self._values.items())
+        samples = []
+        for k, counts in sorted(values.items()):
+            total = 0
+            for bound, count in zip(self.buckets, counts):
+                total += count
+                labels = _labelstr(self.labels, k, [('le', _fmt(bound))])
+                samples.append((self.name + '_bucket', labels, total))
+            labels = _labelstr(self.labels, k)
+            samples.append((self.name + '_sum', labels, counts[-1]))
+            samples.append((self.name + '_count', labels, total))
+        return samples
+
+class Registry(object):
+    """A collection of metrics, keyed by name.  Creating a metric with the name
+    of an existing one replaces it.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def add(self, metric):
+        """Adds a metric to the registry and returns it."""
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, doc, labels=(), func=None):
+        """Creates and registers a Counter."""
+        return self.add(Counter(name, doc, labels=labels, func=func))
+
+    def gauge(self, name, doc, labels=(), func=None):
+        """Creates and registers a Gauge."""
+        return self.add(Gauge(name, doc, labels=labels, func=func))
+
+    def histogram(self, name, doc, labels=(), buckets=DEFAULT_BUCKETS):
+        """Creates and registers a Histogram."""
+        return self.add(Histogram(name, doc, labels=labels, buckets=buckets))
+
+    def render(self):
+        """Returns all of the metrics in the Prometheus text format."""
+        with self._lock:
+            metrics = sorted(self._metrics.items())
+        return '\n'.join(m.render() for name, m in metrics) + '\n'
+
+REGISTRY = Registry()
+"""The registry of all polyphemus metrics."""
+
+PLUGIN_SECONDS = REGISTRY.histogram('polyphemus_plugin_seconds',
+    'Wall time spent in plugins, by plugin, event name, and phase.',
+    labels=('plugin', 'event', 'phase'))
+
+EVENTS_DISPATCHED = REGISTRY.counter('polyphemus_events_dispatched_total',
+    'Events handed to the dispatcher, by event name.', labels=('event',))
+
+EXCEPTIONS = REGISTRY.counter('polyphemus_exceptions_total',
+    'Exceptions raised by plugins, by plugin and phase.',
+    labels=('plugin', 'phase'))
+
+ENQUEUE_SECONDS = REGISTRY.histogram('polyphemus_enqueue_seconds',
+    'Time taken by routes to respond to requests and enqueue their events.',
+    labels=('route',))
@@ -81,7 +81,32 @@ Interface
 :execute(rc): Performs the heavy lifting of the plugin, which may require a run 
     controller.If needed, the rc should be modified in-place so that changes 
     propagate to other plugins and further calls on this plugin. This should 
-    return None. 
+    return None.  If this method is decorated with ``polyphemus.event.runfor``
+    then it is only ever called for the listed events, and it may declare the
+    priority class of these events with the ``priority`` keyword argument of 
+    ``runfor``.  Each event is executed 
+    with its own copy-on-write overlay of the run control, so changes to the rc
+    here are only seen by the later plugins handling the same event.
+:execute_batch(rc, events): Optional.  When present, this is called instead of 
+    execute() with a list of several events of the same name that this plugin
+    handles, so that they may be processed together, e.g. over a single 
+    session.  Here rc.event is not set, and the events in the list may not be
+    replaced.  Plugins that do not provide this have execute() called for each
+    event.
+:priority: The priority class, one of ``'status'``, ``'normal'``, or ``'build'``, 
+    of the events that this plugin executes.  This is used by the dispatcher to 
+    schedule cheap events ahead of expensive ones.  An event is assigned the 
+    lowest priority class among all of the plugins that execute it.
+:process_pool: If True, execute() is run in a separate worker process, so that
+    CPU-bound plugins do not stall the web application.  The run control and
+    event are pickled on the way to and from the worker, and setup() is not 
+    run there.  The number of worker processes is set by the 
+    ``process_pool_size`` run control parameter.
+:dispatched(rc, event): Called for every event as it is handed to the dispatcher,
+    prior to it being executed.  This should be fast and return None.
+:completed(rc, event): Called for every dispatched event once the execution 
+    pipeline has finished with it, or once it has been dropped because it was
+    superseded.  This should be fast and return None.
 :teardown(rc): Performs any cleanup tasks needed by the plugin, including removing
     temporary files.  If needed, the rc should be modified in-place so that changes 
     propagate to other plugins and further calls on this plugin. This should 
@@ -148,12 +173,19 @@ import warnings
 import importlib
 import argparse
 import textwrap
+import time
+import pickle
+import threading
 import traceback
+import multiprocessing
+from bisect import bisect_left
 from functools import wraps
 
-from flask import Flask
+from flask import Flask, request
 
 from .utils import RunControl, NotSpecified, nyansep
+from .dispatch import Dispatcher, QueueFull, PRIORITIES
+from .metrics import REGISTRY, CONTENT_TYPE, PLUGIN_SECONDS, EXCEPTIONS
 
 if sys.version_info[0] >= 3:
     basestring = str
@@ -207,6 +239,31 @@ class Plugin(object):
     data 'POST' is also needed.  See the flask documentation for more details.
     """
 
+    execute_batch = None
+    """Plugins may set this to a method which takes a run controller and a list
+    of events, ``execute_batch(rc, events)``, to handle several events of the 
+    same name at once.  The events all pass the plugin's runfor() filter.  If 
+    this is None, execute() is called for each event instead.
+    """
+
+    priority = 'normal'
+    """This is the priority class of the events that this plugin executes: 
+    'status' for cheap events which should not wait on others, 'normal', or 
+    'build' for expensive events whose concurrency is limited.  This may also
+    be given by the ``priority`` keyword argument to ``runfor``, which takes
+    precedence.
+    """
+
+    process_pool = False
+    """If True, execute() is run in a separate worker process so that CPU-bound
+    work does not block the web application.  The run control and event are 
+    pickled and sent to the worker, where a fresh instance of the plugin runs
+    execute().  The event and any run control values that were set are sent 
+    back.  Note that setup() is not run in the worker, so any state must be 
+    kept on the run control, and that unpicklable run control values, such as 
+    the flask application, are not available there.
+    """
+
     def __init__(self):
         """The __init__() method may take no arguments or keyword arguments."""
         pass
@@ -258,7 +315,9 @@ class Plugin(object):
             event will automatically be set to rc.event and may be handled
             by any plugin's execute() method.  This is most useful for responses
             from POST requests.  The event returned may be None in which case the
-            execution pipeline will not be triggered.
+            execution pipeline will not be triggered.  Unless ``dispatch_workers``
+            is zero, the pipeline is run in the background after the response 
+            has been returned.
 
         """
         return "\n", None
@@ -273,6 +332,31 @@ class Plugin(object):
         """
         pass
 
+    def dispatched(self, rc, event):
+        """Called when an event is handed to the dispatcher, before it is executed.
+
+        Parameters
+        ----------
+        rc : polyphemus.utils.RunControl
+        event : Event
+            The event that was dispatched.
+
+        """
+        pass
+
+    def completed(self, rc, event):
+        """Called when the execution pipeline has finished with a dispatched 
+        event, or when the event was dropped because it was superseded.
+
+        Parameters
+        ----------
+        rc : polyphemus.utils.RunControl
+        event : Event
+            The event that was originally dispatched.
+
+        """
+        pass
+
     def teardown(self, rc):
         """Performs any cleanup tasks needed by the plugin.
 
@@ -310,6 +394,9 @@ class Plugins(object):
     3. ``setup()``
     4. ``execute()`` OR ``run_app()``
     5. ``teardown()``
+
+    Events that are generated by the web application are passed to ``dispatch()``,
+    which hands them off to the dispatcher that is stored as ``rc.dispatcher``.
        
     """
 
@@ -327,10 +414,14 @@ class Plugins(object):
         self.plugins = []
         self.modnames = []
         self._load(modnames, loaddeps=loaddeps)
+        self.build_routes()
         self.parser = None
         self.rc = None
         self.rcdocs = {}
         self.warnings = []
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._unpicklable = set(['app', 'dispatcher'])
 
     def _load(self, modnames, loaddeps=True):
         for modname in modnames:
@@ -344,6 +435,52 @@ class Plugins(object):
             self.modnames.append(modname)
             self.plugins.append(plugin)
 
+    def build_routes(self):
+        """Builds the dispatch table which maps event names to the sorted indices
+        of the plugins whose execute() methods handle them.  Plugins whose 
+        execute() methods are not decorated with ``runfor`` receive every event,
+        while plugins which do not override execute() receive none.  The 
+        priority class of each event is the lowest priority of the plugins that
+        handle it.  The plugins which override the dispatched() and completed() 
+        hooks are collected here as well.
+        """
+        self._dispatched = [p for p in self.plugins 
+                            if _overrides(p, 'dispatched')]
+        self._completed = [p for p in self.plugins if _overrides(p, 'completed')]
+        anyevent = []
+        routes = {}
+        for i, plugin in enumerate(self.plugins):
+            if not _overrides(plugin, 'execute'):
+                continue
+            events = getattr(plugin.execute, 'runfor', None)
+            if events is None:
+                anyevent.append(i)
+                continue
+            for name in events:
+                routes.setdefault(name, []).append(i)
+        for idxs in routes.values():
+            idxs.extend(anyevent)
+            idxs.sort()
+        self.routes = routes
+        self._anyevent = anyevent
+        ranks = [PRIORITIES.index(_priority(p)) for p in self.plugins]
+        lowest = lambda idxs: PRIORITIES[max([ranks[i] for i in idxs])] \
+                              if len(idxs) > 0 else 'normal'
+        self.priorities = dict((name, lowest(idxs)) for name, idxs in routes.items())
+        self._anypriority = lowest(anyevent)
+        self._batchable = frozenset(name for name, idxs in routes.items() if 
+            any(getattr(self.plugins[i], 'execute_batch', None) for i in idxs))
+        self._isolated = frozenset(i for i, p in enumerate(self.plugins) 
+                                   if getattr(p, 'process_pool', False))
+
+    def priority(self, name):
+        """Returns the priority class for events with the given name."""
+        return self.priorities.get(name, self._anypriority)
+
+    def batchable(self, name):
+        """Tests whether any plugin handles events with the given name in batches."""
+        return name in self._batchable
+
     def build_cli(self):
         """Builds and returns a command line interface based on the plugins.
 
@@ -394,58 +531,239 @@ class Plugins(object):
         return rc
 
     def setup(self):
-        """Performs all plugin setup tasks."""
+        """Performs all plugin setup tasks and then starts the dispatcher."""
         rc = self.rc
+        rc.dispatcher = Dispatcher(self)
         try:
             for plugin in self.plugins:
+                start = time.time()
                 plugin.setup(rc)
+                _observe(plugin, '', 'setup', start)
         except Exception as e:
+            EXCEPTIONS.inc(plugin.__module__, 'setup')
             s = traceback.format_exc()
             self.exit(s + '\n' + str(e))
         if rc.only_setup:
             self.exit(0)
+        rc.dispatcher.start(workers=rc.dispatch_workers, 
+                            coalesce_window=rc.dispatch_coalesce_window,
+                            limits={'build': rc.dispatch_build_limit},
+                            max_queue=rc.dispatch_max_queue,
+                            batch_size=rc.dispatch_batch_size,
+                            repo_limit=rc.dispatch_repo_limit)
+
+    def execute(self, event=None):
+        """Preforms all plugin executions.  The plugins are handed a copy-on-write
+        overlay of the run control so that events may be executed concurrently
+        without clobbering each other.
 
-    def execute(self):
-        """Preforms all plugin executions."""
-        rc = self.rc
+        Parameters
+        ----------
+        event : Event, optional
+            The event to execute, defaults to rc.event.  This is set as the 
+            event on the run control overlay.
+
+        """
+        rc = self.rc._overlay(event=self.rc.event if event is None else event)
+        plugins = self.plugins
+        routes = self.routes
+        origin = rc.event
+        plugin = None
+        i = 0
         try:
-            for plugin in self.plugins:
-                plugin.execute(rc)
+            # plugins may replace rc.event, so the route is looked up at each step
+            while not origin.cancelled:
+                name = rc.event.name
+                idxs = routes.get(name, self._anyevent)
+                j = bisect_left(idxs, i)
+                if j == len(idxs):
+                    break
+                i = idxs[j]
+                plugin = plugins[i]
+                start = time.time()
+                if i in self._isolated:
+                    self.execute_isolated(i, rc)
+                else:
+                    plugin.execute(rc)
+                _observe(plugin, name, 'execute', start)
+                i += 1
         except Exception as e:
+            if plugin is not None:
+                EXCEPTIONS.inc(plugin.__module__, 'execute')
             s = traceback.format_exc()
-            self.exit(s + '\n' + str(e))
+            self.exit(s + '\n' + str(e), rc=rc)
+
+    def execute_batch(self, events):
+        """Preforms all plugin executions for several events together.  Each 
+        event moves through the pipeline as it would in execute(), with its own 
+        run control overlay.  However, when several events reach the same plugin
+        and that plugin provides execute_batch(), it is called once for all of
+        them.
+
+        Parameters
+        ----------
+        events : list of Event
+            The events to execute.
+
+        """
+        base = self.rc
+        plugins = self.plugins
+        routes = self.routes
+        plugin = None
+        rcs = [base._overlay(event=event) for event in events]
+        nexts = [0] * len(events)
+        rc = base
+        try:
+            while True:
+                # find the next plugin index for each of the events
+                for k, rc in enumerate(rcs):
+                    if nexts[k] is None:
+                        continue
+                    idxs = routes.get(rc.event.name, self._anyevent)
+                    j = bisect_left(idxs, nexts[k])
+                    nexts[k] = None if j == len(idxs) or events[k].cancelled \
+                                    else idxs[j]
+                live = [i for i in nexts if i is not None]
+                if len(live) == 0:
+                    break
+                i = min(live)
+                group = [k for k, n in enumerate(nexts) if n == i]
+                plugin = plugins[i]
+                if len(group) > 1 and i not in self._isolated and \
+                   getattr(plugin, 'execute_batch', None):
+                    rc = base._overlay()
+                    batch = [rcs[k].event for k in group]
+                    start = time.time()
+                    plugin.execute_batch(rc, batch)
+                    _observe(plugin, batch[0].name, 'execute_batch', start)
+                else:
+                    for k in group:
+                        rc = rcs[k]
+                        name = rc.event.name
+                        start = time.time()
+                        if i in self._isolated:
+                            self.execute_isolated(i, rc)
+                        else:
+                            plugin.execute(rc)
+                        _observe(plugin, name, 'execute', start)
+                for k in group:
+                    nexts[k] = i + 1
+        except Exception as e:
+            if plugin is not None:
+                EXCEPTIONS.inc(plugin.__module__, 'execute')
+            s = traceback.format_exc()
+            self.exit(s + '\n' + str(e), rc=rc)
+
+    def execute_isolated(self, i, rc):
+        """Runs the execute() method of a plugin in a worker process from the
+        process pool, and then applies the run control changes that it made.
+
+        Parameters
+        ----------
+        i : int
+            The index of the plugin.
+        rc : polyphemus.utils.RunControlOverlay
+            The run control for the event being executed.
+
+        """
+        state = {}
+        for key, value in rc._merged().items():
+            if key in self._unpicklable:
+                continue
+            try:
+                pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+            except Exception:
+                self._unpicklable.add(key)
+                continue
+            state[key] = value
+        changes = self.process_pool().apply(_isolated_execute, 
+                                            (self.modnames[i], state))
+        for key, value in changes.items():
+            setattr(rc, key, value)
+
+    def process_pool(self):
+        """Returns the pool of worker processes for plugins with process_pool
+        set, creating it if needed.  Its size is given by the 
+        ``process_pool_size`` run control parameter.
+        """
+        with self._pool_lock:
+            if self._pool is None:
+                ctx = multiprocessing
+                if hasattr(multiprocessing, 'get_context'):
+                    # forking a process with running threads is unsafe
+                    ctx = multiprocessing.get_context('spawn')
+                self._pool = ctx.Pool(self.rc.process_pool_size or None)
+            return self._pool
 
     def build_app(self):
-        """Creates a default flask application."""
-        app = Flask(self.rc.appname, **self.rc.flask_kwargs)
+        """Creates a default flask application.  Unless the ``metrics_route``
+        run control parameter is empty, the metrics are served there as well.
+        """
+        rc = self.rc
+        app = Flask(rc.appname, **rc.flask_kwargs)
         for plugin in self.plugins:
             if plugin.route is None:
                 continue
             view = wrap_response(self, plugin)
             app.add_url_rule(plugin.route, plugin.__module__, view, 
                              methods=plugin.request_methods)
-        self.rc.app = app
+        if rc.metrics_route:
+            app.add_url_rule(rc.metrics_route, 'polyphemus.metrics', _metrics)
+        rc.app = app
 
     def run_app(self):
         """Runs, and possibly builds, the flask web application."""
         rc = self.rc
         if 'app' not in rc:
             self.build_app()
-        rc.app.run(host=rc.host, port=rc.port, debug=rc.debug)
+        rc.app.run(host=rc.host, port=rc.port, debug=rc.debug, threaded=rc.threaded)
+
+    def dispatch(self, event):
+        """Sends an event to the dispatcher to be executed, possibly in the 
+        background.
+        """
+        self.rc.dispatcher.submit(event)
+
+    def dispatched(self, event):
+        """Calls the dispatched() hook of the plugins for an event."""
+        for plugin in self._dispatched:
+            try:
+                plugin.dispatched(self.rc, event)
+            except Exception as e:
+                warnings.warn("{0}.dispatched() failed: {1}".format(
+                              plugin.__module__, e), RuntimeWarning)
+
+    def completed(self, event):
+        """Calls the completed() hook of the plugins for an event."""
+        for plugin in self._completed:
+            try:
+                plugin.completed(self.rc, event)
+            except Exception as e:
+                warnings.warn("{0}.completed() failed: {1}".format(
+                              plugin.__module__, e), RuntimeWarning)
 
     def teardown(self):
-        """Preforms all plugin teardown tasks."""
+        """Waits for any dispatched events to finish and then preforms all 
+        plugin teardown tasks."""
         rc = self.rc
+        if 'dispatcher' in rc:
+            rc.dispatcher.stop()
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
         try:
             for plugin in self.plugins:
                 plugin.teardown(rc)
         except Exception as e:
+            EXCEPTIONS.inc(plugin.__module__, 'teardown')
             s = traceback.format_exc()
             self.exit(s + '\n' + str(e))
 
-    def exit(self, err=0):
-        """Exits the process, possibly printing debug info."""
-        rc = self.rc
+    def exit(self, err=0, rc=None):
+        """Exits the process, possibly printing debug info.  The run control to 
+        report on may be given, and defaults to the plugins' run control."""
+        rc = self.rc if rc is None else rc
         if rc.debug:
             import traceback
             sep = nyansep + '\n\n'
@@ -471,6 +789,46 @@ class Plugins(object):
         else:
             sys.exit(err)
 
+def _func(method):
+    """Returns the underlying function of a (possibly bound) method."""
+    return getattr(method, '__func__', method)
+
+def _priority(plugin):
+    """Returns the priority class that a plugin executes events with."""
+    priority = getattr(getattr(plugin, 'execute', None), 'priority', None) or \
+               getattr(plugin, 'priority', 'normal')
+    if priority not in PRIORITIES:
+        raise ValueError("{0} has invalid priority {1!r}, must be one of {2}".format(
+                         plugin.__module__, priority, ", ".join(PRIORITIES)))
+    return priority
+
+_isolated_plugins = {}
+
+def _isolated_execute(modname, state):
+    """Runs a plugin's execute() method in a worker process.  The plugin is 
+    instantiated once per process.  Returns the run control values which were
+    set, along with the event, which may have been modified in-place.
+    """
+    plugin = _isolated_plugins.get(modname)
+    if plugin is None:
+        plugin = importlib.import_module(modname).PolyphemusPlugin()
+        _isolated_plugins[modname] = plugin
+    rc = RunControl(**state)
+    plugin.execute(rc)
+    changes = dict((k, v) for k, v in rc._dict.items() 
+                   if k not in state or state[k] is not v)
+    changes['event'] = rc.event
+    return changes
+
+def _observe(plugin, event, phase, start):
+    """Records the time that a plugin has spent in a phase since start."""
+    PLUGIN_SECONDS.observe(time.time() - start, plugin.__module__, event, phase)
+
+def _overrides(plugin, name):
+    """Tests whether a plugin provides its own version of a Plugin method."""
+    method = getattr(plugin, name, None)
+    return method is not None and _func(method) is not _func(getattr(Plugin, name))
+
 def summarize_rcdocs(modnames, headersep="=", maxdflt=2000):
     """For a list of plugin module names, return a rST string that 
     summarizes the docstrings for all run control parameters.
@@ -511,13 +869,37 @@ def wrap_response(plugins, plugin):
     -------
     response : function
         The response proxy function that is bound to plugins and plugin.
+        When the dispatch queue is full, POST requests are answered with
+        an HTTP 503 status and a Retry-After header.
 
     """
     @wraps(plugin.response)
     def response(*args, **kwargs):
-        resp, event = plugin.response(plugins.rc, *args, **kwargs)
+        start = time.time()
+        rc = plugins.rc._overlay()
+        dispatcher = rc.dispatcher
+        if request.method == 'POST' and dispatcher.full():
+            dispatcher.reject()
+            return _busy(rc)
+        try:
+            resp, event = plugin.response(rc, *args, **kwargs)
+        except Exception:
+            EXCEPTIONS.inc(plugin.__module__, 'response')
+            raise
+        _observe(plugin, '' if event is None else event.name, 'response', start)
         if event is not None:
-            plugins.rc.event = event
-            plugins.execute()
+            try:
+                plugins.dispatch(event)
+            except QueueFull:
+                return _busy(rc)
+            dispatcher.record_enqueue(plugin.route, time.time() - start)
         return resp
     return response
+
+def _metrics():
+    """A response with all of the metrics, in the Prometheus text format."""
+    return REGISTRY.render(), 200, {'Content-Type': CONTENT_TYPE}
+
+def _busy(rc):
+    """A response for when the dispatcher can not accept any more events."""
+    return "busy, retry later\n", 503, {'Retry-After': str(rc.dispatch_retry_after)}
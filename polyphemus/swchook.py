@@ -98,58 +98,61 @@ class PolyphemusPlugin(Plugin):
         flask_kwargs={'static_folder': os.path.join(os.getcwd(), 'static')}
         )
 
-    def __init__(self):
-        self._files = []
+    # lxml parsing and diffing are CPU-bound, so keep them out of the web process
+    process_pool = True
 
-    def _build_base_html(self, base):
+    # Per-event state is passed between these methods rather than stored on
+    # the plugin, since several events may be executed at the same time.
+
+    def _build_base_html(self, base, base_dir, updater):
         base_repo = github3.repository(*base.repo)
 
-        if os.path.exists(self._base_dir):
-            shutil.rmtree(self._base_dir)
+        if os.path.exists(base_dir):
+            shutil.rmtree(base_dir)
         
-        self._updater.update(
+        updater.update(
             status='pending', description="Getting base repository.")
-        clone_repo(base_repo.clone_url, self._base_dir)
-        checkout_commit(base.ref, cwd=self._base_dir)
+        clone_repo(base_repo.clone_url, base_dir)
+        checkout_commit(base.ref, cwd=base_dir)
 
-        self._updater.update(
+        updater.update(
             status='pending', description="Building base website.")
-        subprocess.check_call(build_html, cwd=self._base_dir, shell=True)
+        subprocess.check_call(build_html, cwd=base_dir, shell=True)
 
-    def _build_head_html(self, base, head):        
+    def _build_head_html(self, base, head, head_dir, updater):        
         head_repo = github3.repository(*head.repo)
         base_repo = github3.repository(*base.repo)
 
-        if os.path.exists(self._head_dir):
-            shutil.rmtree(self._head_dir)
+        if os.path.exists(head_dir):
+            shutil.rmtree(head_dir)
                 
-        self._updater.update(
+        updater.update(
             status='pending', description="Getting head repository.")
-        clone_repo(head_repo.clone_url, self._head_dir)
+        clone_repo(head_repo.clone_url, head_dir)
         add_fetch_remote("upstream", base_repo.clone_url, 
-                         cwd=self._head_dir)
-        checkout_commit(base.ref, cwd=self._head_dir)
-        merge_commit("origin", head.ref, cwd=self._head_dir)
+                         cwd=head_dir)
+        checkout_commit(base.ref, cwd=head_dir)
+        merge_commit("origin", head.ref, cwd=head_dir)
 
-        self._updater.update(
+        updater.update(
             status='pending', description="Building head website.")
-        subprocess.check_call(build_html, shell=True, cwd=self._head_dir)
+        subprocess.check_call(build_html, shell=True, cwd=head_dir)
 
-    def _generate_diffs(self):
-        self._updater.update(
+    def _generate_diffs(self, files, base_dir, head_dir, updater):
+        updater.update(
             status='pending', 
             description="Creating head and base website diffs.")
 
-        for f in self._files:
+        for f in files:
             froot, fext = os.path.splitext(f)
             if fext not in HTML_EXTS:
                 f = froot + '.html'
             f = os.path.join("_site", f)
             fpath, fname = os.path.split(f)
 
-            head = os.path.join(self._head_dir, f)
-            base = os.path.join(self._base_dir, f)
-            diff = os.path.join(self._head_dir, fpath, "diff-" + fname)
+            head = os.path.join(head_dir, f)
+            base = os.path.join(base_dir, f)
+            diff = os.path.join(head_dir, fpath, "diff-" + fname)
 
             # if addition or deletion, just skip
             if not os.path.isfile(head) or not os.path.isfile(base):
@@ -175,46 +178,47 @@ class PolyphemusPlugin(Plugin):
                 f.write(diffdoc.encode('utf-8'))
             print("diff'd {0!r}".format(diff))
 
-    @runfor('swc-hook', 'github-pr-new', 'github-pr-sync')                    
+    @runfor('swc-hook', 'github-pr-new', 'github-pr-sync', priority='build')
     def execute(self, rc):
         event_name = rc.event.name
         pr = rc.event.data  # pull request object
 
         rc.event = Event(name='swc-status', 
                          data={'status': 'error', 
+                               'owner': pr.base.repo[0], 
+                               'repo': pr.base.repo[1], 
                                'number': pr.number, 
                                'description': ''})
-        self._updater = rc.event.data
+        updater = rc.event.data
 
         if not pr.mergeable:
             msg = "Error, PR #{0} is not mergeable.".format(pr.number)
             warn(msg, RuntimeWarning)
             rc.event.data['status'] = 'failure'
-            self._updater['description'] = msg
+            updater['description'] = msg
             return 
         
-        self._files = [os.path.join(*f.filename.split("/")) 
-                       for f in pr.iter_files()]
-        self._files = [f for f in self._files if os.path.splitext(f)[1] in KNOWN_EXTS]
+        files = [os.path.join(*f.filename.split("/")) for f in pr.iter_files()]
+        files = [f for f in files if os.path.splitext(f)[1] in KNOWN_EXTS]
 
-        orp = (rc.github_owner, rc.github_repo, pr.number)
+        orp = tuple(pr.base.repo) + (pr.number,)
         stat_dir = rc.flask_kwargs['static_folder']
         orp_dir = "{0}-{1}-{2}".format(*orp)
         stat_orp_dir = os.path.join(stat_dir, orp_dir)
-        self._base_dir = os.path.join(stat_orp_dir, "base")
-        self._head_dir = os.path.join(stat_orp_dir, "head")
+        base_dir = os.path.join(stat_orp_dir, "base")
+        head_dir = os.path.join(stat_orp_dir, "head")
         if os.path.exists(stat_orp_dir):
             shutil.rmtree(stat_orp_dir)
 
-        self._build_head_html(pr.base, pr.head)
-        self._build_base_html(pr.base)
-        self._generate_diffs()
+        self._build_head_html(pr.base, pr.head, head_dir, updater)
+        self._build_base_html(pr.base, base_dir, updater)
+        self._generate_diffs(files, base_dir, head_dir, updater)
 
         cache = PersistentCache(cachefile=rc.swc_cache)
-        cache[orp] = {'base': self._base_dir,
-                      'head': self._head_dir,
-                      'files': self._files}
+        cache[orp] = {'base': base_dir,
+                      'head': head_dir,
+                      'files': files}
 
-        self._updater.update(status='success', description="comparison available.", 
-                             target_url=os.path.join(rc.server_url, rc.github_owner, 
-                                                     rc.github_repo, str(pr.number)))
+        updater.update(status='success', description="comparison available.", 
+                             target_url=os.path.join(rc.server_url, orp[0], orp[1], 
+                                                     str(pr.number)))
@@ -10,18 +10,27 @@ import re
 import sys
 import glob
 import tempfile
+import threading
 import functools
 import subprocess
 from copy import deepcopy
 from pprint import pformat
-from collections import Mapping, Iterable, Hashable, Sequence, namedtuple, \
-    MutableMapping
+from collections import namedtuple
+try:
+    from collections.abc import Mapping, Iterable, Hashable, Sequence, \
+        MutableMapping
+except ImportError:
+    from collections import Mapping, Iterable, Hashable, Sequence, MutableMapping
 from hashlib import md5
 from warnings import warn
 try:
     import cPickle as pickle
 except ImportError:
     import pickle
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 if sys.version_info[0] >= 3:
     basestring = str
@@ -184,6 +193,10 @@ class NotSpecified(object):
     def __repr__(self):
         return "NotSpecified"
 
+    def __reduce__(self):
+        # unpickles as the singleton, e.g. in plugin worker processes
+        return "NotSpecified"
+
 NotSpecified = NotSpecified()
 """A helper class singleton for run control meaning that a 'real' value
 has not been given."""
@@ -286,6 +299,86 @@ class RunControl(object):
                 v = self._updaters[k](getattr(self, k), v)
             setattr(self, k, v)
 
+    def _overlay(self, **kwargs):
+        """Returns a copy-on-write overlay of this run control.  See 
+        RunControlOverlay for more details.
+        """
+        return RunControlOverlay(self, **kwargs)
+
+class RunControlOverlay(RunControl):
+    """A lightweight, copy-on-write view of another run control.  Attributes are 
+    read from the underlying run control until they are set on the overlay.  
+    Setting attributes on the overlay never modifies the underlying run control,
+    so many overlays of the same run control may be used concurrently, e.g. one 
+    per event being executed.  Note that mutable values are shared with the 
+    underlying run control and should not be modified in-place.
+    """
+
+    def __init__(self, base, **kwargs):
+        """Parameters
+        -------------
+        base : RunControl
+            The run control to read attributes from.
+        kwargs : optional
+            Items to place into the overlay.
+
+        """
+        self._base = base
+        super(RunControlOverlay, self).__init__(**kwargs)
+        self._updaters = base._updaters
+
+    def __getattr__(self, key):
+        if key.startswith('_'):
+            raise AttributeError(key)
+        if key in self._dict:
+            return self._dict[key]
+        return getattr(self._base, key)
+
+    def __delattr__(self, key):
+        if key in self._dict:
+            del self._dict[key]
+        elif key in self.__dict__:
+            del self.__dict__[key]
+        else:
+            msg = "RunControlOverlay may not delete {0!r} from the underlying "
+            raise AttributeError(msg.format(key) + "run control.")
+
+    def __iter__(self):
+        keys = set(self._base)
+        keys.update(self._dict)
+        return iter(keys)
+
+    def __contains__(self, key):
+        return key in self._dict or key in self._base
+
+    def _merged(self):
+        """Returns a dict of the underlying run control updated with the overlay."""
+        d = dict((k, getattr(self._base, k)) for k in self._base)
+        d.update(self._dict)
+        return d
+
+    def __repr__(self):
+        d = self._merged()
+        s = ", ".join(["{0!s}={1!r}".format(k, d[k]) for k in sorted(d.keys())])
+        return "{0}({1})".format(self.__class__.__name__, s)
+
+    def _pformat(self):
+        d = self._merged()
+        f = lambda k: "{0!s}={1}".format(k, pformat(d[k], indent=2))
+        s = ",\n ".join(map(f, sorted(d.keys())))
+        return "{0}({1})".format(self.__class__.__name__, s)
+
+    def __eq__(self, other):
+        if hasattr(other, '_dict'):
+            other = other._merged() if hasattr(other, '_merged') else other._dict
+        elif not isinstance(other, Mapping):
+            return NotImplemented
+        return self._merged() == other
+
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        return eq if eq is NotImplemented else not eq
+
 def infer_format(filename, format):
     """Tries to figure out a file format."""
     if isinstance(format, basestring):
@@ -406,8 +499,73 @@ def check_cmd(args):
 # Persisted Cache
 #
 
+class _CacheLock(object):
+    """A reentrant lock for a cache file, which is shared by all threads in a
+    process and, where fcntl is available, is also held against other 
+    processes with flock() on a '.lock' file beside the cache file.
+    """
+
+    def __init__(self, cachefile):
+        self.lockfile = cachefile + '.lock'
+        self._rlock = threading.RLock()
+        self._depth = 0
+        self._fd = None
+
+    def __enter__(self):
+        self._rlock.acquire()
+        try:
+            if self._depth == 0 and fcntl is not None:
+                pardir = os.path.dirname(self.lockfile)
+                if not os.path.exists(pardir):
+                    os.makedirs(pardir)
+                fd = os.open(self.lockfile, os.O_RDWR | os.O_CREAT, 0o644)
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX)
+                except Exception:
+                    os.close(fd)
+                    raise
+                self._fd = fd
+            self._depth += 1
+        except Exception:
+            self._rlock.release()
+            raise
+        return self
+
+    def __exit__(self, *exc):
+        self._depth -= 1
+        if self._depth == 0 and self._fd is not None:
+            fd, self._fd = self._fd, None
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+        self._rlock.release()
+
+_cache_locks = {}
+_cache_locks_lock = threading.Lock()
+
+def _cache_lock(cachefile):
+    """Returns the lock for a cache file, which is shared by all threads."""
+    cachefile = os.path.abspath(cachefile)
+    with _cache_locks_lock:
+        if cachefile not in _cache_locks:
+            _cache_locks[cachefile] = _CacheLock(cachefile)
+        return _cache_locks[cachefile]
+
+def _file_stamp(filename):
+    """Returns what identifies a version of a file, or None if it is missing."""
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime)
+
 class PersistentCache(MutableMapping):
-    """A quick persistent cache."""
+    """A quick persistent cache.  Modifications are made under a lock that is
+    shared between all threads and, where fcntl is available, between 
+    processes.  The cache file is only re-read before a write if another 
+    writer has replaced it since it was last read, so that concurrent users of
+    the same file do not lose each other's changes.  Each write goes to a 
+    unique temporary file which is renamed over the cache file.
+    """
 
     def __init__(self, cachefile='cache.pkl'):
         """Parameters
@@ -417,12 +575,26 @@ class PersistentCache(MutableMapping):
 
         """
         self.cachefile = cachefile
-        if os.path.isfile(cachefile):
-            with io.open(cachefile, 'rb') as f:
+        self.lock = _cache_lock(cachefile)
+        with self.lock:
+            self.load()
+
+    def load(self):
+        """Reads the cache in from the filesystem."""
+        self._stamp = _file_stamp(self.cachefile)
+        if self._stamp is not None:
+            with io.open(self.cachefile, 'rb') as f:
                 self.cache = pickle.load(f)
         else:
             self.cache = {}
 
+    def _refresh(self):
+        """Re-reads the cache if the file has changed since it was last read.
+        Must be called with the lock held.
+        """
+        if _file_stamp(self.cachefile) != self._stamp:
+            self.load()
+
     def __len__(self):
         return len(self.cache)
 
@@ -433,12 +605,16 @@ class PersistentCache(MutableMapping):
         return self.cache[key]  # return the results of the finder only
 
     def __setitem__(self, key, value):
-        self.cache[key] = value
-        self.dump()
+        with self.lock:
+            self._refresh()
+            self.cache[key] = value
+            self.dump()
 
     def __delitem__(self, key):
-        del self.cache[key]
-        self.dump()
+        with self.lock:
+            self._refresh()
+            del self.cache[key]
+            self.dump()
 
     def __iter__(self):
         for key in self.cache.keys():
@@ -446,12 +622,23 @@ class PersistentCache(MutableMapping):
 
     def dump(self):
         """Writes the cache out to the filesystem."""
-        if not os.path.exists(self.cachefile):
-            pardir = os.path.split(os.path.abspath(self.cachefile))[0]
-            if not os.path.exists(pardir):
-                os.makedirs(pardir)
-        with io.open(self.cachefile, 'wb') as f:
-            pickle.dump(self.cache, f, pickle.HIGHEST_PROTOCOL)
+        pardir, basename = os.path.split(os.path.abspath(self.cachefile))
+        if not os.path.exists(pardir):
+            os.makedirs(pardir)
+        with self.lock:
+            fd, tmpfile = tempfile.mkstemp(prefix=basename + '.', suffix='.tmp', 
+                                           dir=pardir)
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    pickle.dump(self.cache, f, pickle.HIGHEST_PROTOCOL)
+                if os.name == 'nt' and os.path.exists(self.cachefile):
+                    os.remove(self.cachefile)
+                os.rename(tmpfile, self.cachefile)
+            except Exception:
+                if os.path.exists(tmpfile):
+                    os.remove(tmpfile)
+                raise
+            self._stamp = _file_stamp(self.cachefile)
 
     def __str__(self):
         return pformat(self.cache)
@@ -111,7 +111,9 @@ def setup():
             'Flask >= 0.10.1',
             'paramiko >= 1.10.0',
             'github3.py >= 0.7.1',
+            'requests >= 2.0',
             ]
+        setup_kwargs['tests_require'] = ['pytest']
     # changing dirs for virtualenv
     cwd = os.getcwd()
     os.chdir(dir_name)
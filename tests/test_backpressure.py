@@ -0,0 +1,60 @@
+"""Tests for rejecting events once the dispatch queue is full."""
+from __future__ import print_function
+
+import pytest
+from flask import Flask
+
+from polyphemus.utils import RunControl
+from polyphemus.event import Event
+from polyphemus.plugins import Plugin, wrap_response
+from polyphemus.dispatch import Dispatcher, QueueFull
+
+class FakePlugins(object):
+
+    def dispatched(self, event):
+        pass
+
+    def completed(self, event):
+        pass
+
+    def priority(self, name):
+        return 'normal'
+
+    def batchable(self, name):
+        return False
+
+    def execute(self, event):
+        pass
+
+class EchoPlugin(Plugin):
+    route = '/echo'
+    request_methods = ['POST']
+
+    def response(self, rc):
+        return "ok\n", Event('swc-status', {})
+
+def test_full_queue_rejects():
+    d = Dispatcher(FakePlugins())
+    d.max_queue = 1
+    d.submit(Event('swc-status', {}))
+    assert d.full()
+    with pytest.raises(QueueFull):
+        d.submit(Event('swc-status', {}))
+    assert d.stats()['rejected'] == 1
+
+def test_full_queue_retry_after():
+    plugins = FakePlugins()
+    plugins.rc = RunControl(dispatch_retry_after=7)
+    plugins.rc.dispatcher = d = Dispatcher(plugins)
+    plugins.dispatch = d.submit
+    d.max_queue = 1
+    app = Flask(__name__)
+    app.add_url_rule('/echo', 'echo', wrap_response(plugins, EchoPlugin()), 
+                     methods=['POST'])
+    client = app.test_client()
+    assert client.post('/echo').status_code == 200
+    resp = client.post('/echo')
+    assert resp.status_code == 503
+    assert resp.headers['Retry-After'] == '7'
+    assert d.stats()['rejected'] == 1
+    assert len(d) == 1
@@ -0,0 +1,106 @@
+"""Tests for executing runs of events together with execute_batch()."""
+from __future__ import print_function
+
+from polyphemus.utils import RunControl
+from polyphemus.event import Event, runfor
+from polyphemus.plugins import Plugin, Plugins
+from polyphemus.dispatch import Dispatcher
+
+class BatchPlugin(Plugin):
+
+    def __init__(self):
+        self.calls = []
+
+    @runfor('batlab-status')
+    def execute(self, rc):
+        self.calls.append(('execute', rc.event.data))
+
+    def execute_batch(self, rc, events):
+        self.calls.append(('execute_batch', [e.data for e in events]))
+
+class SinglePlugin(Plugin):
+
+    def __init__(self):
+        self.calls = []
+
+    @runfor('batlab-status')
+    def execute(self, rc):
+        self.calls.append(rc.event.data)
+        rc.event = Event('done', rc.event.data)
+
+class AfterPlugin(Plugin):
+
+    def __init__(self):
+        self.seen = []
+
+    @runfor('done')
+    def execute(self, rc):
+        self.seen.append(rc.event.data)
+
+def make_plugins(*plugins):
+    p = Plugins([])
+    p.plugins = list(plugins)
+    p.build_routes()
+    p.rc = RunControl(event=None)
+    return p
+
+def test_batch_called_once_for_group():
+    batch, single, after = BatchPlugin(), SinglePlugin(), AfterPlugin()
+    plugins = make_plugins(batch, single, after)
+    assert plugins.batchable('batlab-status')
+    assert not plugins.batchable('done')
+    plugins.execute_batch([Event('batlab-status', n) for n in (1, 2, 3)])
+    assert batch.calls == [('execute_batch', [1, 2, 3])]
+    assert single.calls == [1, 2, 3]
+    assert after.seen == [1, 2, 3]
+
+def test_lone_event_uses_execute():
+    batch = BatchPlugin()
+    plugins = make_plugins(batch)
+    plugins.execute_batch([Event('batlab-status', 1)])
+    assert batch.calls == [('execute', 1)]
+
+def test_cancelled_events_left_out():
+    batch = BatchPlugin()
+    plugins = make_plugins(batch)
+    events = [Event('batlab-status', n) for n in (1, 2, 3)]
+    events[1].cancelled = True
+    plugins.execute_batch(events)
+    assert batch.calls == [('execute_batch', [1, 3])]
+
+class RecordingPlugins(object):
+    """Records the groups of events that the dispatcher executes together."""
+
+    def __init__(self):
+        self.groups = []
+
+    def dispatched(self, event):
+        pass
+
+    def completed(self, event):
+        pass
+
+    def priority(self, name):
+        return 'status'
+
+    def batchable(self, name):
+        return name == 'batlab-status'
+
+    def execute(self, event):
+        self.groups.append([event.data['number']])
+
+    def execute_batch(self, events):
+        self.groups.append([e.data['number'] for e in events])
+
+def test_dispatcher_groups_runs_of_batchable_events():
+    plugins = RecordingPlugins()
+    d = Dispatcher(plugins)
+    status = lambda n: Event('batlab-status', {'owner': 'o', 'repo': 'r', 
+                                               'number': n})
+    for event in [status(1), status(2), status(3), 
+                  Event('swc-status', {'owner': 'o', 'repo': 'r', 'number': 4}),
+                  status(5)]:
+        d.submit(event)
+    d.start(workers=1, batch_size=2)
+    d.stop(wait=True)
+    assert plugins.groups == [[1, 2], [3], [4], [5]]
@@ -0,0 +1,74 @@
+"""Tests for the pool of connections to the BaTLab submit node."""
+from __future__ import print_function
+
+from polyphemus.batlabbase import SSHPool, parse_sections
+
+class FakeTransport(object):
+
+    def __init__(self):
+        self.active = True
+
+    def is_active(self):
+        return self.active
+
+class FakeClient(object):
+
+    def __init__(self):
+        self.transport = FakeTransport()
+        self.closed = False
+
+    def get_transport(self):
+        return None if self.closed else self.transport
+
+    def close(self):
+        self.closed = True
+
+class FakePool(SSHPool):
+
+    def __init__(self, **kwargs):
+        super(FakePool, self).__init__(**kwargs)
+        self.connects = []
+
+    def _connect(self):
+        client = FakeClient()
+        self.connects.append(client)
+        return client
+
+def test_client_reused():
+    pool = FakePool()
+    client = pool.client()
+    assert pool.client() is client
+    assert len(pool.connects) == 1
+
+def test_dropped_transport_reconnected():
+    pool = FakePool()
+    first = pool.client()
+    first.transport.active = False
+    second = pool.client()
+    assert second is not first
+    assert first.closed
+    assert pool.client() is second
+    assert len(pool.connects) == 2
+
+def test_round_robin_and_close():
+    pool = FakePool(size=2)
+    clients = [pool.client() for i in range(4)]
+    assert clients[0] is clients[2] and clients[1] is clients[3]
+    assert clients[0] is not clients[1]
+    pool.close()
+    assert all(c.closed for c in clients)
+    assert pool.client() is not clients[0]
+
+def test_new_credentials_close_connections():
+    pool = FakePool()
+    pool.configure('me', 'id_rsa')
+    client = pool.client()
+    pool.configure('me', 'id_rsa', size=3)
+    assert not client.closed
+    pool.configure('you', 'id_rsa')
+    assert client.closed
+    assert pool.size == 3
+
+def test_parse_sections():
+    sections = parse_sections(b'before\n@@polyphemus a@@\n1\n2\n@@polyphemus b c@@\n')
+    assert sections == {'': ['before'], 'a': ['1', '2'], 'b c': []}
@@ -0,0 +1,230 @@
+"""Tests for preparing BaTLab job directories."""
+from __future__ import print_function
+import os
+import stat
+import subprocess
+
+from polyphemus import batlabrun
+from polyphemus.event import Event
+from polyphemus.utils import RunControl
+from polyphemus.githubbase import PullRequestInfo
+from polyphemus.batlabrun import job_script_header, job_files_template, \
+    submit_template, job_script, JobFiles, JobSession, JOB_FILES_STAGING, \
+    scripts_cache_header, git_cache_template, scripts_copy_template, \
+    _ensure_task_script, _add_runspec_input
+
+RUN_SPEC = """project = cyclus
+description = tests
+pre_all = pre.sh
+inputs = fetch.git
+"""
+
+SUBMIT = """#!/bin/bash
+echo "submitted $1 in $(pwd) with gid o_r_1.123"
+echo
+echo "http://batlab.example.com/report/123"
+"""
+
+def make_jobdir(tmpdir):
+    jobdir = tmpdir.mkdir('o--r--1')
+    jobdir.join('cyclus.run-spec').write(RUN_SPEC)
+    jobdir.join('pre.sh').write('#!/bin/bash\necho pre')  # no final newline
+    jobdir.join('pre.sh').chmod(0o755)
+    return jobdir
+
+def start_script(tmpdir, submit_cmd):
+    script = job_script_header.format(jobname='o--r--1') + \
+             job_files_template.format(paths='cyclus.run-spec',
+                                       run_spec='cyclus.run-spec') + \
+             submit_template.format(staging=JOB_FILES_STAGING, 
+                                    submit_cmd=submit_cmd,
+                                    run_spec='cyclus.run-spec')
+    tmpdir.join('job.sh').write(script)
+    env = dict(os.environ, HOME=str(tmpdir))
+    p = subprocess.Popen(['bash', 'job.sh'], cwd=str(tmpdir), env=env,
+                         stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE)
+    return p, JobSession(p.stdin, p.stdout, p.stderr)
+
+def test_job_files_round_trip(tmpdir):
+    jobdir = make_jobdir(tmpdir)
+    tmpdir.join('submit').write(SUBMIT)
+    tmpdir.join('submit').chmod(0o755)
+    p, session = start_script(tmpdir, str(tmpdir.join('submit')))
+    sections = session.job_files()
+    assert sections['home'] == [str(tmpdir)]
+    assert sections['file pre.sh'] == ['755', '#!/bin/bash', 'echo pre']
+    assert 'file post_all.sh' not in sections
+    assert not tmpdir.join('job.sh').check()  # the script removes itself
+
+    files = JobFiles(sections)
+    run_spec_lines = files.edit('cyclus.run-spec')
+    _ensure_task_script('pre_all', run_spec_lines, files).append('echo cb')
+    _ensure_task_script('post_all', run_spec_lines, files).append('echo done')
+    _add_runspec_input(run_spec_lines, 'jobdir.scp')
+    original = jobdir.join('pre.sh').stat().ino
+
+    sections = session.submit(files.archive())
+    p.wait()
+    assert 'error' not in sections and 'stderr' not in sections
+    assert sections['gid'] == ['o_r_1.123']
+    assert sections['report_url'] == ['http://batlab.example.com/report/123']
+    assert jobdir.join('pre.sh').read() == '#!/bin/bash\necho pre\necho cb\n'
+    assert jobdir.join('pre.sh').stat().ino != original  # replaced, not changed
+    assert jobdir.join('post_all.sh').read() == '#!/bin/bash\necho done\n'
+    assert stat.S_IMODE(jobdir.join('post_all.sh').stat().mode) == 0o755
+    assert 'post_all = post_all.sh' in jobdir.join('cyclus.run-spec').read()
+    assert 'inputs = fetch.git,jobdir.scp' in jobdir.join('cyclus.run-spec').read()
+    assert not jobdir.join(JOB_FILES_STAGING).check()
+
+def test_submit_errors_reported(tmpdir):
+    make_jobdir(tmpdir)
+    p, session = start_script(tmpdir, 'echo "no such project" >&2; false')
+    files = JobFiles(session.job_files())
+    files.edit('cyclus.run-spec').append('# edited')
+    sections = session.submit(files.archive())
+    p.wait()
+    assert sections['error'] == ['no such project']
+    assert 'gid' not in sections
+
+def test_failed_script_drains_stderr(tmpdir):
+    p, session = start_script(tmpdir, 'true')  # there is no job directory
+    sections = session.job_files()
+    p.wait()
+    assert session.finished
+    assert sections['error'][0] == "Error entering the job directory."
+    assert any('o--r--1' in line for line in sections['error'][1:])
+    session.abort()  # nothing is waiting
+
+def test_abort_does_not_submit(tmpdir):
+    make_jobdir(tmpdir)
+    p, session = start_script(tmpdir, 'touch submitted')
+    session.job_files()
+    session.abort()
+    p.wait()
+    assert session.finished
+    assert not tmpdir.join('o--r--1', 'submitted').check()
+
+class Ref(object):
+
+    def __init__(self, repo, sha='abc'):
+        self.repo, self.sha, self.ref = repo, sha, 'feature'
+
+class Pull(object):
+    number = 1
+    base = Ref(('o', 'r'))
+    head = Ref(('fork', 'r'))
+
+class UnusedPool(object):
+
+    def client(self):
+        raise AssertionError("a cancelled event must not connect to BaTLab")
+
+def test_cancelled_event_not_prepared(tmpdir, monkeypatch):
+    monkeypatch.setattr(batlabrun, 'SSH_POOL', UnusedPool())
+    origin = Event('github-pr-sync', Pull())
+    origin.cancelled = True
+    rc = RunControl(event=origin, batlab_jobs_cache=str(tmpdir.join('jobs.pkl')),
+                    batlab_build_type='custom')
+    batlabrun.PolyphemusPlugin().execute(rc)
+    assert rc.event.name == 'batlab-status'
+
+def test_head_urls_from_payload(monkeypatch):
+    def no_client(**kwargs):
+        raise AssertionError("the head repository must not be fetched")
+    monkeypatch.setattr(batlabrun, 'github_client', no_client)
+    repo = {'owner': {'login': 'fork'}, 'name': 'r', 
+            'clone_url': 'https://github.com/fork/r.git',
+            'archive_url': 'https://api.github.com/repos/fork/r/'
+                           '{archive_format}{/ref}'}
+    pr = PullRequestInfo({'number': 1, 
+        'head': {'sha': 'abc', 'ref': 'feature', 'repo': repo},
+        'base': {'sha': 'def', 'ref': 'master', 'repo': repo}})
+    urls = batlabrun.PolyphemusPlugin()._head_urls(RunControl(), pr)
+    assert urls == ('https://github.com/fork/r.git', 
+                    'https://api.github.com/repos/fork/r/tarball/feature')
+
+def make_rc(**kwargs):
+    rc = RunControl(batlab_kill_cmd='nmi_rm', batlab_submit_cmd='nmi_submit',
+                    batlab_scripts_url='https://example.com/scripts.git',
+                    batlab_scripts_cache='.polyphemus/scripts', 
+                    batlab_run_spec='my project.run-spec', 
+                    batlab_build_type='custom')
+    rc._update(kwargs)
+    return rc
+
+def test_job_script_sections():
+    script = job_script(make_rc(), ('o', 'r', 1), gid='o_r_1.123')
+    assert script.startswith(job_script_header.format(jobname='o--r--1'))
+    assert 'nmi_rm o_r_1.123 ' in script
+    assert 'git ls-remote https://example.com/scripts.git HEAD' in script
+    assert "show \"$f\"" in script and "for f in 'my project.run-spec'; do" in script
+    # the edits are read between the job files and the submission
+    files, submit = script.split('section edits\n')
+    assert 'section home' in files and 'nmi_submit' not in files
+    assert "{ nmi_submit 'my project.run-spec'; }" in submit
+    assert 'section gid' in submit and 'section report_url' in submit
+
+def test_job_script_conda_and_zip():
+    rc = make_rc(batlab_build_type='conda', 
+                 batlab_scripts_url='https://example.com/scripts.zip')
+    script = job_script(rc, ('o', 'r', 1))
+    assert 'nmi_rm' not in script
+    assert 'unzip' in script and 'git ls-remote' not in script
+    assert "for f in 'my project.run-spec' r/meta.yaml; do" in script
+
+GIT_ENV = {'GIT_AUTHOR_NAME': 'a', 'GIT_AUTHOR_EMAIL': 'a@example.com',
+           'GIT_COMMITTER_NAME': 'a', 'GIT_COMMITTER_EMAIL': 'a@example.com'}
+
+def git(cwd, *args):
+    env = dict(os.environ, **GIT_ENV)
+    return subprocess.check_output(('git',) + args, cwd=str(cwd), env=env)
+
+def push_scripts(work, text):
+    work.join('run.sh').write(text)
+    git(work, 'add', 'run.sh')
+    git(work, 'commit', '-q', '-m', text)
+    git(work, 'push', '-q', 'origin', 'HEAD:master')
+    return git(work, 'rev-parse', 'HEAD').decode().strip()
+
+def refresh_scripts(tmpdir, url):
+    cache = '.polyphemus/scripts/abc'
+    script = job_script_header.format(jobname='o--r--1') + \
+             scripts_cache_header.format(cache=cache) + \
+             git_cache_template.format(batlab_scripts_url=url) + \
+             scripts_copy_template
+    tmpdir.join('job.sh').write(script)
+    env = dict(os.environ, HOME=str(tmpdir))
+    p = subprocess.Popen(['bash', 'job.sh'], cwd=str(tmpdir), env=env,
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = p.communicate()
+    assert p.returncode == 0, (out, err)
+    return tmpdir.join(cache)
+
+def test_scripts_cache_refreshed_on_change(tmpdir):
+    upstream = tmpdir.join('upstream.git')
+    git(tmpdir, 'init', '-q', '--bare', str(upstream))
+    git(upstream, 'symbolic-ref', 'HEAD', 'refs/heads/master')
+    work = tmpdir.join('work')
+    git(tmpdir, 'clone', '-q', str(upstream), str(work))
+    home = tmpdir.mkdir('home')
+    rev = push_scripts(work, 'echo one')
+
+    cache = refresh_scripts(home, str(upstream))
+    jobdir = home.join('o--r--1')
+    assert jobdir.join('run.sh').read() == 'echo one'
+    assert jobdir.join('run.sh').stat().ino == cache.join('run.sh').stat().ino
+    assert home.join('.polyphemus/scripts/abc.rev').read().strip() == rev
+
+    # unchanged upstream, the cache is left alone but the jobdir is fresh
+    jobdir.join('stale').write('x')
+    ino = cache.stat().ino
+    refresh_scripts(home, str(upstream))
+    assert cache.stat().ino == ino
+    assert not jobdir.join('stale').check()
+
+    rev = push_scripts(work, 'echo two')
+    refresh_scripts(home, str(upstream))
+    assert jobdir.join('run.sh').read() == 'echo two'
+    assert home.join('.polyphemus/scripts/abc.rev').read().strip() == rev
+    assert not home.join('.polyphemus/scripts/abc.new').check()
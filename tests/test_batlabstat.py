@@ -0,0 +1,124 @@
+"""Tests for reading the statuses of BaTLab jobs from the submit node."""
+from __future__ import print_function
+
+from polyphemus import batlabstat
+from polyphemus.utils import RunControl, NotSpecified, PersistentCache
+from polyphemus.batlabbase import SECTION_MARKER
+from polyphemus.batlabstat import parse_status, parse_result, poll_statuses
+
+def test_parse_status_whole_words():
+    assert parse_status(['job is incomplete']) is None
+    assert parse_status(['0 failures so far']) is None
+    assert parse_status(['status: complete']) == 'finished'
+    assert parse_status(['status: RUNNING']) == 'pending'
+    assert parse_status(['job was removed']) == 'error'
+    assert parse_status([]) is None
+
+def test_parse_status_pending_before_finished():
+    assert parse_status(['tasks completed: 3', 'state: running']) == 'pending'
+
+def test_parse_result():
+    assert parse_result(['task a return value 0', 'task b return value 0']) == 'success'
+    assert parse_result(['task a return value 0', 'task b return value 2']) == 'failure'
+    assert parse_result(['no tasks ran']) is None
+
+class FakeStream(object):
+
+    def __init__(self, data):
+        self.data = data
+        self.channel = self
+
+    def read(self):
+        return self.data
+
+    def recv_exit_status(self):
+        return 0
+
+class FakeClient(object):
+
+    def __init__(self, outputs):
+        self.outputs = outputs
+        self.commands = []
+
+    def exec_command(self, script):
+        self.commands.append(script)
+        out = '\n'.join(SECTION_MARKER.format(gid) + '\n' + text
+                        for gid, text in self.outputs[len(self.commands) - 1])
+        return None, FakeStream(out.encode()), None
+
+def test_poll_statuses_fetches_results():
+    client = FakeClient([
+        [('g1', 'running'), ('g2', 'complete'), ('g3', 'complete')],
+        [('g2', 'x return value 0'), ('g3', 'x return value 1')],
+        ])
+    statuses = poll_statuses(client, 'nmi_status', ['g1', 'g2', 'g3'],
+                             result_cmd='nmi_log')
+    assert statuses == {'g1': 'pending', 'g2': 'success', 'g3': 'failure'}
+    assert len(client.commands) == 2
+    assert 'g1' not in client.commands[1]
+
+def test_poll_statuses_without_result_cmd():
+    client = FakeClient([[('g1', 'complete')]])
+    assert poll_statuses(client, 'nmi_status', ['g1']) == {'g1': None}
+    assert len(client.commands) == 1
+
+class ReplacingClient(FakeClient):
+    """Replaces the job in the cache while the status command runs, as a sync
+    would.
+    """
+
+    def __init__(self, outputs, jobs, job, info):
+        super(ReplacingClient, self).__init__(outputs)
+        self.jobs, self.job, self.info = jobs, job, info
+
+    def exec_command(self, script):
+        self.jobs[self.job] = self.info
+        return super(ReplacingClient, self).exec_command(script)
+
+class FakePool(object):
+
+    def __init__(self, client):
+        self._client = client
+
+    def client(self):
+        return self._client
+
+class FakeDispatcher(object):
+
+    def __init__(self):
+        self.events = []
+
+    def submit(self, event):
+        self.events.append(event)
+
+def make_rc(tmpdir):
+    return RunControl(batlab_jobs_cache=str(tmpdir.join('jobs.pkl')), 
+                      batlab_status_cmd='nmi_status', 
+                      batlab_result_cmd=NotSpecified, 
+                      dispatcher=FakeDispatcher())
+
+def test_poll_ignores_replaced_job(tmpdir, monkeypatch):
+    rc = make_rc(tmpdir)
+    job = ('o', 'r', 1)
+    jobs = PersistentCache(cachefile=rc.batlab_jobs_cache)
+    jobs[job] = {'gid': 'old', 'report_url': 'http://old', 'sha': 'a'}
+    newer = {'gid': 'new', 'report_url': 'http://new', 'sha': 'b'}
+    client = ReplacingClient([[('old', 'job was removed')]], jobs, job, newer)
+    monkeypatch.setattr(batlabstat, 'SSH_POOL', FakePool(client))
+    plugin = batlabstat.PolyphemusPlugin()
+    assert plugin._poll(rc) == (1, False)
+    assert rc.dispatcher.events == []
+    assert PersistentCache(cachefile=rc.batlab_jobs_cache)[job] == newer
+
+def test_poll_posts_for_job_sha(tmpdir, monkeypatch):
+    rc = make_rc(tmpdir)
+    job = ('o', 'r', 1)
+    jobs = PersistentCache(cachefile=rc.batlab_jobs_cache)
+    jobs[job] = {'gid': 'g1', 'report_url': 'http://g1', 'sha': 'a'}
+    client = FakeClient([[('g1', 'job was removed')]])
+    monkeypatch.setattr(batlabstat, 'SSH_POOL', FakePool(client))
+    plugin = batlabstat.PolyphemusPlugin()
+    assert plugin._poll(rc) == (1, True)
+    data = rc.dispatcher.events[0].data
+    assert (data['status'], data['sha'], data['number']) == ('error', 'a', 1)
+    assert job not in PersistentCache(cachefile=rc.batlab_jobs_cache)
@@ -0,0 +1,84 @@
+"""Tests for the in-memory model behind the dashboard."""
+from __future__ import print_function
+import threading
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+
+import polyphemus.dashboard
+from polyphemus.utils import RunControl
+from polyphemus.dashboard import DashboardModel, PullSummary, PolyphemusPlugin
+
+Head = namedtuple('Head', ['sha'])
+Pull = namedtuple('Pull', ['number', 'html_url', 'head'])
+
+def make_pull(number, sha):
+    return Pull(number, 'https://github.com/o/r/pull/{0}'.format(number), Head(sha))
+
+def test_new_pull_is_open():
+    model = DashboardModel('o', 'r')
+    model.update_pull(make_pull(1, 'a'))
+    opened, closed = model.rows()
+    assert [pr.number for pr, s in opened] == [1]
+    assert closed == []
+
+def test_closed_pull_stays_closed():
+    model = DashboardModel('o', 'r')
+    model._closed[2] = PullSummary(2, 'https://github.com/o/r/pull/2', 'b')
+    model.update_pull(make_pull(2, 'c'))  # e.g. a batlab-run from the dashboard
+    opened, closed = model.rows()
+    assert opened == []
+    assert [(pr.number, pr.sha) for pr, s in closed] == [(2, 'c')]
+    model.update_status('o', 'r', 'c', 'pending')
+    assert model.rows()[1][0][1].state == 'pending'
+
+class SlowRepository(object):
+    """Lets an event update the model while the pull requests are fetched."""
+
+    def __init__(self, model, pulls):
+        self.model = model
+        self.pulls = pulls
+
+    def iter_pulls(self, state='open', number=-1):
+        if state == 'closed':
+            return iter([])
+        self.model.update_pull(make_pull(2, 'b'))
+        self.model.update_status('o', 'r', 'b', 'pending')
+        return iter(self.pulls)
+
+class FakeGitHub(object):
+
+    def __init__(self, repo):
+        self.repo = repo
+
+    def repository(self, owner, repo):
+        return self.repo
+
+def test_reconcile_keeps_pulls_updated_while_fetching(monkeypatch):
+    monkeypatch.setattr(polyphemus.dashboard, 'get_pull_request_status', 
+                        lambda gh, r, pr: None)
+    model = DashboardModel('o', 'r')
+    gh = FakeGitHub(SlowRepository(model, [make_pull(1, 'a')]))
+    pool = ThreadPool(1)
+    try:
+        model.reconcile(gh, pool)
+    finally:
+        pool.close()
+    opened, closed = model.rows()
+    assert [(pr.number, pr.sha) for pr, s in opened] == [(1, 'a'), (2, 'b')]
+    assert opened[1][1].state == 'pending'
+
+def test_setup_seeds_in_background(monkeypatch):
+    started = threading.Event()
+    release = threading.Event()
+    def reconcile(self, rc):
+        started.set()
+        release.wait(5.0)
+    monkeypatch.setattr(PolyphemusPlugin, '_reconcile', reconcile)
+    rc = RunControl(dashboard_threads=1, dashboard_reconcile_interval=0.0,
+                    plugins=['polyphemus.githubhook'], github_repos=[('o', 'r')])
+    plugin = PolyphemusPlugin()
+    plugin.setup(rc)  # must not wait for the reconcile
+    assert started.wait(5.0)
+    assert ('o', 'r') in plugin.models
+    release.set()
+    plugin.teardown(rc)
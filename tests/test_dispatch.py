@@ -0,0 +1,118 @@
+"""Tests for dispatching events to the plugins in the background."""
+from __future__ import print_function
+import threading
+
+from polyphemus.event import Event
+from polyphemus.dispatch import Dispatcher
+
+PR = ('o', 'r', 1)
+
+class FakePlugins(object):
+    """Records the events that pass through the dispatcher."""
+
+    def __init__(self, priorities=None):
+        self.priorities = priorities or {}
+        self.executed = []
+        self.completed_events = []
+
+    def dispatched(self, event):
+        pass
+
+    def completed(self, event):
+        self.completed_events.append(event)
+
+    def priority(self, name):
+        return self.priorities.get(name, 'normal')
+
+    def batchable(self, name):
+        return False
+
+    def execute(self, event):
+        self.executed.append(event)
+
+def test_coalesce_held_events():
+    plugins = FakePlugins()
+    d = Dispatcher(plugins)
+    d.coalesce_window = 60.0
+    first = Event('github-pr-sync', PR)
+    second = Event('github-pr-sync', PR)
+    d.submit(first)
+    d.submit(second)
+    assert len(d) == 1
+    assert first.cancelled
+    assert first in plugins.completed_events
+    d.start(workers=0, coalesce_window=60.0)
+    assert plugins.executed == [second]
+
+def test_cancel_queued_event():
+    plugins = FakePlugins()
+    d = Dispatcher(plugins)
+    first = Event('github-pr-new', PR)
+    second = Event('github-pr-sync', PR)
+    d.submit(first)
+    d.submit(second)
+    d.start(workers=0)
+    assert first.cancelled
+    assert plugins.executed == [second]
+    assert plugins.completed_events == [first, second]
+
+def test_other_pull_requests_not_cancelled():
+    plugins = FakePlugins()
+    d = Dispatcher(plugins)
+    first = Event('github-pr-sync', PR)
+    second = Event('github-pr-sync', ('o', 'r', 2))
+    d.submit(first)
+    d.submit(second)
+    d.start(workers=0)
+    assert plugins.executed == [first, second]
+
+def test_batlab_run_does_not_cancel_sync():
+    plugins = FakePlugins()
+    d = Dispatcher(plugins)
+    sync = Event('github-pr-sync', PR)
+    run = Event('batlab-run', PR)
+    d.submit(sync)
+    d.submit(run)
+    d.start(workers=0)
+    assert not sync.cancelled
+    assert plugins.executed == [sync, run]
+
+class BlockingPlugins(FakePlugins):
+    """Holds every execution until released, recording the executing threads."""
+
+    def __init__(self):
+        super(BlockingPlugins, self).__init__()
+        self.release = threading.Event()
+        self.threads = set()
+
+    def execute(self, event):
+        self.release.wait(5.0)
+        self.threads.add(threading.current_thread().name)
+        super(BlockingPlugins, self).execute(event)
+
+def test_workers_execute_in_background():
+    plugins = BlockingPlugins()
+    d = Dispatcher(plugins)
+    d.start(workers=2)
+    events = [Event('github-pr-sync', ('o', 'r', n)) for n in range(4)]
+    for event in events:
+        d.submit(event)  # returns without waiting on the plugins
+    assert plugins.executed == []
+    plugins.release.set()
+    d.stop(wait=True)
+    assert sorted(e.data[2] for e in plugins.executed) == [0, 1, 2, 3]
+    assert sorted(plugins.completed_events, key=lambda e: e.data[2]) == events
+    assert threading.current_thread().name not in plugins.threads
+    assert all(name.startswith('polyphemus-dispatch-') for name in plugins.threads)
+
+def test_repositories_served_in_turn():
+    plugins = FakePlugins()
+    d = Dispatcher(plugins)
+    events = [Event('github-pr-sync', ('o', 'busy', n)) for n in range(3)] + \
+             [Event('github-pr-sync', ('o', 'quiet', 1))]
+    for event in events:
+        d.submit(event)
+    d.start(workers=1)
+    d.stop(wait=True)
+    assert [e.data[1:] for e in plugins.executed] == \
+        [('busy', 0), ('quiet', 1), ('busy', 1), ('busy', 2)]
@@ -0,0 +1,241 @@
+"""Tests for the GitHub helpers shared by the plugins."""
+from __future__ import print_function
+import time
+import pickle
+
+from requests import Request, Response
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+import polyphemus.githubbase
+from polyphemus.utils import RunControl, NotSpecified
+from polyphemus.githubbase import PullRequestInfo, github_client, HTTP_CACHE, \
+    ConditionalCache, RateLimit, RateLimited, low_priority, CommitStatus, \
+    get_pull_request_status
+
+def _repo(owner, name):
+    return {'owner': {'login': owner}, 'name': name, 
+            'clone_url': 'https://github.com/{0}/{1}.git'.format(owner, name),
+            'archive_url': 'https://api.github.com/repos/{0}/{1}/'
+                           '{{archive_format}}{{/ref}}'.format(owner, name)}
+
+PAYLOAD = {'number': 7, 'html_url': 'https://github.com/o/r/pull/7', 
+           'mergeable': None, 'title': 'ignored',
+           'head': {'sha': 'abc', 'ref': 'feature', 'label': 'fork:feature', 
+                    'repo': _repo('fork', 'r')},
+           'base': {'sha': 'def', 'ref': 'master', 'label': 'o:master', 
+                    'repo': _repo('o', 'r')}}
+
+class FakeGitHub(object):
+
+    def __init__(self):
+        self.fetched = []
+
+    def pull_request(self, owner, repo, number):
+        self.fetched.append((owner, repo, number))
+        return FakeFullPull()
+
+class FakeFullPull(object):
+    mergeable = True
+    title = 'from github'
+
+def test_pull_request_info_from_payload():
+    pr = PullRequestInfo(PAYLOAD)
+    assert (pr.number, pr.html_url) == (7, 'https://github.com/o/r/pull/7')
+    assert (pr.head.sha, pr.head.ref, pr.head.repo) == ('abc', 'feature', ('fork', 'r'))
+    assert pr.base.repo == ('o', 'r')
+    assert pr.head.clone_url == 'https://github.com/fork/r.git'
+    assert pr.head.archive('tarball') == \
+        'https://api.github.com/repos/fork/r/tarball/feature'
+
+def test_pull_request_info_fetches_lazily(monkeypatch):
+    gh = FakeGitHub()
+    monkeypatch.setattr(polyphemus.githubbase, 'github_client', 
+                        lambda user=None, credfile=None: gh)
+    pr = PullRequestInfo(PAYLOAD)
+    assert pr.head.sha == 'abc'
+    assert gh.fetched == []
+    assert pr.mergeable  # not yet computed by GitHub
+    assert pr.title == 'from github'
+    assert gh.fetched == [('o', 'r', 7)]
+
+def test_pull_request_info_pickles_without_full():
+    pr = PullRequestInfo(PAYLOAD)
+    pr._full = FakeFullPull()
+    pr = pickle.loads(pickle.dumps(pr))
+    assert pr._full is None
+    assert (pr.number, pr.head.sha, pr.head.clone_url) == \
+        (7, 'abc', 'https://github.com/fork/r.git')
+
+class FakeSession(object):
+
+    def __init__(self):
+        self.adapters = {}
+
+    def mount(self, prefix, adapter):
+        self.adapters[prefix] = adapter
+
+class FakeClient(object):
+
+    def __init__(self):
+        self._session = FakeSession()
+        self.logins = []
+
+    def login(self, username=None, token=None):
+        self.logins.append((username, token))
+
+def test_github_client_shared(tmpdir, monkeypatch):
+    monkeypatch.setattr(polyphemus.githubbase, 'GitHub', FakeClient)
+    monkeypatch.setattr(polyphemus.githubbase, '_clients', {})
+    credfile = tmpdir.join('gh.cred')
+    credfile.write('token\n1\n')
+    gh = github_client(user='me', credfile=str(credfile))
+    assert github_client(user='me', credfile=str(credfile)) is gh
+    assert gh.logins == [('me', 'token')]
+    assert gh._session.adapters['https://'] is HTTP_CACHE
+    assert github_client(user='you', credfile=str(credfile)) is not gh
+    # a new token is picked up by the same client
+    credfile.write('newtoken\n1\n')
+    credfile.setmtime(credfile.mtime() + 10)
+    assert github_client(user='me', credfile=str(credfile)) is gh
+    assert gh.logins == [('me', 'token'), ('me', 'newtoken')]
+
+class FakeServer(object):
+    """Stands in for HTTPAdapter.send(), answering with an ETag and then with
+    304 Not Modified when it is sent back.
+    """
+
+    def __init__(self):
+        self.requests = []
+
+    def send(self, adapter, prepared, **kwargs):
+        self.requests.append(dict(prepared.headers))
+        resp = Response()
+        resp.url = prepared.url
+        resp.headers = CaseInsensitiveDict({'X-RateLimit-Remaining': '4000', 
+            'X-RateLimit-Limit': '5000', 'X-RateLimit-Reset': str(time.time() + 60)})
+        if prepared.headers.get('If-None-Match') == '"v1"':
+            resp.status_code = 304
+            resp._content = b''
+        else:
+            resp.status_code = 200
+            resp.headers['ETag'] = '"v1"'
+            resp._content = b'{"number": 7}'
+        resp._content_consumed = True
+        return resp
+
+def get(url='https://api.github.com/repos/o/r/pulls/7'):
+    return Request('GET', url, headers={'Authorization': 'token t'}).prepare()
+
+def test_conditional_cache_revalidates(monkeypatch):
+    server = FakeServer()
+    monkeypatch.setattr(HTTPAdapter, 'send', 
+                        lambda adapter, prepared, **kw: server.send(adapter, prepared))
+    monkeypatch.setattr(polyphemus.githubbase, 'RATE_LIMIT', RateLimit())
+    cache = ConditionalCache()
+    first = cache.send(get())
+    second = cache.send(get())
+    assert 'If-None-Match' not in server.requests[0]
+    assert server.requests[1]['If-None-Match'] == '"v1"'
+    assert (second.status_code, second.content) == (200, b'{"number": 7}')
+    assert second.content == first.content
+    assert len(cache) == 1
+
+def test_conditional_cache_keys_by_credentials(monkeypatch):
+    server = FakeServer()
+    monkeypatch.setattr(HTTPAdapter, 'send', 
+                        lambda adapter, prepared, **kw: server.send(adapter, prepared))
+    monkeypatch.setattr(polyphemus.githubbase, 'RATE_LIMIT', RateLimit())
+    cache = ConditionalCache()
+    cache.send(get())
+    other = get()
+    other.headers['Authorization'] = 'token u'
+    cache.send(other)
+    assert 'If-None-Match' not in server.requests[1]
+    assert len(cache) == 2
+
+def test_rate_limit_reserve():
+    limit = RateLimit(reserve=10)
+    assert not limit.low() and limit.budget() is None
+    reset = time.time() + 60
+    limit.update({'X-RateLimit-Remaining': '11', 'X-RateLimit-Limit': '5000',
+                  'X-RateLimit-Reset': str(reset)})
+    assert not limit.low()
+    limit.update({'X-RateLimit-Remaining': '10', 'X-RateLimit-Reset': str(reset)})
+    assert limit.low() and not limit.exhausted()
+    limit.update({'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': str(reset)})
+    assert limit.exhausted()
+    limit.update({'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': '0'})
+    assert limit.budget() is None and not limit.low()  # the limit has been reset
+
+def test_low_priority_reads_spare_the_reserve(monkeypatch):
+    server = FakeServer()
+    monkeypatch.setattr(HTTPAdapter, 'send', 
+                        lambda adapter, prepared, **kw: server.send(adapter, prepared))
+    limit = RateLimit(reserve=5000)  # every response leaves the budget low
+    monkeypatch.setattr(polyphemus.githubbase, 'RATE_LIMIT', limit)
+    cache = ConditionalCache()
+    cache.send(get())
+    assert limit.low()
+    with low_priority():
+        stale = cache.send(get())  # served from the cache without a request
+        try:
+            cache.send(get('https://api.github.com/repos/o/r/pulls/8'))
+        except RateLimited as e:
+            assert e.reset == limit.reset
+        else:
+            assert False, "an uncached low priority read must be deferred"
+    assert len(server.requests) == 1
+    assert stale.content == b'{"number": 7}'
+    cache.send(get('https://api.github.com/repos/o/r/pulls/8'))  # normal priority
+    assert len(server.requests) == 2
+
+class FakeRepository(object):
+    """Answers the combined status endpoint."""
+
+    _api = 'https://api.github.com/repos/o/r'
+
+    def __init__(self, combined):
+        self.combined = combined
+        self.urls = []
+
+    def _build_url(self, *parts, **kwargs):
+        return '/'.join((kwargs['base_url'],) + parts)
+
+    def _get(self, url):
+        self.urls.append(url)
+        return url
+
+    def _json(self, resp, status_code):
+        return self.combined
+
+def test_pull_request_status_from_combined_status():
+    r = FakeRepository({'state': 'pending', 'statuses': [
+        {'state': 'pending', 'target_url': 'http://a', 'description': 'old', 
+         'updated_at': '2014-01-01T00:00:00Z'},
+        {'state': 'success', 'target_url': 'http://b', 'description': 'new', 
+         'updated_at': '2014-01-02T00:00:00Z'}]})
+    pr = PullRequestInfo(PAYLOAD)
+    status = get_pull_request_status(None, r, pr)
+    assert status == CommitStatus('success', 'http://b', 'new')
+    assert r.urls == ['https://api.github.com/repos/o/r/commits/abc/status']
+
+def test_pull_request_status_unknown():
+    gh = FakeGitHub()
+    gh.pull_request = lambda owner, repo, number: PullRequestInfo(PAYLOAD)
+    assert get_pull_request_status(gh, FakeRepository({'statuses': []}), 
+                                   ('o', 'r', 7)) is None
+    assert get_pull_request_status(gh, FakeRepository(None), ('o', 'r', 7)) is None
+
+def test_github_repos_parsed():
+    rc = RunControl(github_owner=NotSpecified, github_repo=NotSpecified,
+                    github_repos=['o/r', ('o', 's'), 'o/r'], github_cache_size=10,
+                    github_rate_reserve=100, github_cache_file=NotSpecified)
+    plugin = polyphemus.githubbase.PolyphemusPlugin()
+    try:
+        plugin.setup(rc)
+    finally:
+        HTTP_CACHE.maxsize = 1024
+        polyphemus.githubbase.RATE_LIMIT.reserve = 100
+    assert rc.github_repos == [('o', 'r'), ('o', 's')]
+    assert (rc.github_owner, rc.github_repo) == ('o', 'r')
@@ -0,0 +1,120 @@
+"""Tests for screening GitHub web hook deliveries."""
+from __future__ import print_function
+import json
+import hashlib
+
+from flask import Flask
+
+import polyphemus.githubhook
+from polyphemus.utils import RunControl
+from polyphemus.plugins import Plugins, wrap_response
+from polyphemus.dispatch import Dispatcher
+from polyphemus.githubhook import signature, hook_fingerprint
+
+SECRET = 's3cr3t'
+
+BODY = json.dumps({'action': 'closed', 'pull_request': {}, 
+                   'repository': {'owner': {'login': 'o'}, 'name': 'r'}}).encode()
+
+def _repo(owner, name):
+    return {'owner': {'login': owner}, 'name': name}
+
+PULL = {'number': 7, 'html_url': 'https://github.com/o/r/pull/7',
+        'head': {'sha': 'abc', 'ref': 'topic', 'repo': _repo('fork', 'r')},
+        'base': {'sha': 'def', 'ref': 'master', 'repo': _repo('o', 'r')}}
+
+def make_client():
+    plugins = Plugins(['polyphemus.githubhook'], loaddeps=False)
+    plugins.rc = RunControl(github_secret=SECRET, github_repos=[('o', 'r')], 
+                            github_user='u', github_credentials='gh.cred',
+                            dispatch_retry_after=5)
+    plugins.rc.dispatcher = Dispatcher(plugins)
+    dispatched = []
+    plugins.dispatch = dispatched.append
+    app = Flask(__name__)
+    app.add_url_rule('/githubhook', 'githubhook', 
+                     wrap_response(plugins, plugins.plugins[0]), methods=['POST'])
+    return app.test_client(), dispatched
+
+def test_bad_signature():
+    client, dispatched = make_client()
+    resp = client.post('/githubhook', data=BODY, headers={
+        'X-GitHub-Event': 'pull_request', 'X-Hub-Signature-256': 'sha256=00'})
+    assert resp.status_code == 403
+    assert dispatched == []
+
+def test_missing_signature():
+    client, dispatched = make_client()
+    resp = client.post('/githubhook', data=BODY, 
+                       headers={'X-GitHub-Event': 'pull_request'})
+    assert resp.status_code == 403
+    assert dispatched == []
+
+def test_wrong_event():
+    client, dispatched = make_client()
+    resp = client.post('/githubhook', data=b'not json', headers={
+        'X-GitHub-Event': 'push', 'X-Hub-Signature-256': signature(SECRET, BODY)})
+    assert resp.status_code == 200
+    assert dispatched == []
+
+def test_good_signature():
+    client, dispatched = make_client()
+    resp = client.post('/githubhook', data=BODY, headers={
+        'X-GitHub-Event': 'pull_request', 
+        'X-Hub-Signature-256': signature(SECRET, BODY)})
+    assert resp.status_code == 200
+    assert dispatched == []  # closed pull requests are ignored
+
+def test_repository_names_are_case_insensitive():
+    client, dispatched = make_client()
+    body = json.dumps({'action': 'opened', 'pull_request': PULL,
+                       'repository': {'owner': {'login': 'O'}, 'name': 'R'}}).encode()
+    resp = client.post('/githubhook', data=body, headers={
+        'X-GitHub-Event': 'pull_request',
+        'X-Hub-Signature-256': signature(SECRET, body)})
+    assert resp.status_code == 200
+    assert [e.name for e in dispatched] == ['github-pr-new']
+
+def test_fingerprint_hides_secret():
+    plain = hook_fingerprint('o', 'r', 'http://x', ['pull_request'])
+    keyed = hook_fingerprint('o', 'r', 'http://x', ['pull_request'], SECRET)
+    other = hook_fingerprint('o', 'r', 'http://x', ['pull_request'], 'other')
+    assert len(set([plain, keyed, other])) == 3
+    # the fingerprint of a known config can not be recomputed without the secret
+    config = ('o', 'r', 'http://x', ['pull_request'], 'json', SECRET)
+    assert keyed != hashlib.sha1(repr(config).encode('utf-8')).hexdigest()
+
+def setup_hook(tmpdir, events=('pull_request',), secret=SECRET):
+    rc = RunControl(github_hook_cache=str(tmpdir.join('hooks.cache')), 
+                    github_hook_verify_interval=0.0, github_secret=secret,
+                    server_url='http://example.com', port=80, verbose=False,
+                    github_repos=[('o', 'r'), ('o', 's')], 
+                    github_events=list(events), github_user='u', 
+                    github_credentials='gh.cred')
+    plugin = polyphemus.githubhook.PolyphemusPlugin()
+    plugin.setup(rc)
+    plugin.teardown(rc)
+
+def test_unchanged_hook_not_verified(tmpdir, monkeypatch):
+    verified = []
+    monkeypatch.setattr(polyphemus.githubhook, 'verify_hook', 
+                        lambda owner, repo, *args, **kwargs: verified.append(repo))
+    setup_hook(tmpdir)
+    assert verified == ['r', 's']
+    setup_hook(tmpdir)
+    assert verified == ['r', 's']
+    setup_hook(tmpdir, events=('pull_request', 'push'))
+    assert verified == ['r', 's', 'r', 's']
+    setup_hook(tmpdir, events=('pull_request', 'push'), secret='new')
+    assert verified == ['r', 's', 'r', 's', 'r', 's']
+
+def test_only_handled_repositories_dispatched():
+    client, dispatched = make_client()
+    for owner, name in [('o', 'r'), ('x', 'r'), ('o', 'other')]:
+        body = json.dumps({'action': 'synchronize', 'pull_request': PULL,
+                           'repository': _repo(owner, name)}).encode()
+        resp = client.post('/githubhook', data=body, headers={
+            'X-GitHub-Event': 'pull_request',
+            'X-Hub-Signature-256': signature(SECRET, body)})
+        assert resp.status_code == 200
+    assert [e.name for e in dispatched] == ['github-pr-sync']
@@ -0,0 +1,90 @@
+"""Tests for journaling dispatched events and replaying them after a restart."""
+from __future__ import print_function
+import warnings
+from collections import namedtuple
+
+import polyphemus.journal
+from polyphemus.utils import RunControl
+from polyphemus.event import Event
+from polyphemus.journal import PolyphemusPlugin
+
+Base = namedtuple('Base', ['repo'])
+Pull = namedtuple('Pull', ['head', 'base', 'number'])
+
+class FakeDispatcher(object):
+
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, event):
+        self.submitted.append(event)
+
+class FakeGitHub(object):
+
+    def __init__(self, pulls):
+        self.pulls = pulls
+
+    def pull_request(self, owner, repo, number):
+        return self.pulls.get((owner, repo, number))
+
+def start(tmpdir):
+    rc = RunControl(journal_file=str(tmpdir.join('journal.db')),
+                    journal_commit_interval=0.0, verbose=False,
+                    dispatcher=FakeDispatcher())
+    journal = PolyphemusPlugin()
+    journal.setup(rc)
+    return journal, rc
+
+def test_replay_uncompleted(tmpdir):
+    journal, rc = start(tmpdir)
+    done = Event('batlab-status', {'number': 1})
+    undone = Event('batlab-status', {'number': 2})
+    journal.dispatched(rc, done)
+    journal.dispatched(rc, undone)
+    journal.completed(rc, done)
+    journal.teardown(rc)
+
+    journal, rc = start(tmpdir)
+    assert rc.dispatcher.submitted == [undone]
+    replayed = rc.dispatcher.submitted[0]
+    assert replayed.journal_id == undone.journal_id
+    # replayed events are not journaled again
+    journal.dispatched(rc, replayed)
+    journal.completed(rc, replayed)
+    journal.teardown(rc)
+
+    journal, rc = start(tmpdir)
+    assert rc.dispatcher.submitted == []
+    journal.teardown(rc)
+
+def test_replay_pull_request(tmpdir, monkeypatch):
+    pr = Pull(head=None, base=Base(('o', 'r')), number=3)
+    gh = FakeGitHub({('o', 'r', 3): pr})
+    monkeypatch.setattr(polyphemus.journal, 'github_client', lambda **kw: gh)
+    journal, rc = start(tmpdir)
+    journal.dispatched(rc, Event('github-pr-sync', pr))
+    journal.teardown(rc)
+
+    journal, rc = start(tmpdir)
+    assert [e.data for e in rc.dispatcher.submitted] == [pr]
+    journal.teardown(rc)
+
+def test_missing_pull_request_not_replayed(tmpdir, monkeypatch):
+    gh = FakeGitHub({})
+    monkeypatch.setattr(polyphemus.journal, 'github_client', lambda **kw: gh)
+    pr = Pull(head=None, base=Base(('o', 'r')), number=4)
+    journal, rc = start(tmpdir)
+    journal.dispatched(rc, Event('github-pr-sync', pr))
+    journal.teardown(rc)
+
+    with warnings.catch_warnings(record=True) as w:
+        warnings.simplefilter('always')
+        journal, rc = start(tmpdir)
+        journal.teardown(rc)
+    assert rc.dispatcher.submitted == []
+    assert any('could not replay' in str(x.message) for x in w)
+
+    # the record was marked as completed, and is not tried again
+    journal, rc = start(tmpdir)
+    assert rc.dispatcher.submitted == []
+    journal.teardown(rc)
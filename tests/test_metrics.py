@@ -0,0 +1,45 @@
+"""Tests for exporting metrics in the Prometheus text format."""
+from __future__ import print_function
+
+from polyphemus.metrics import Registry
+
+def test_render_counter_and_gauge():
+    registry = Registry()
+    events = registry.counter('events_total', 'Events seen.', labels=('event',))
+    events.inc('b')
+    events.inc('a', amount=2)
+    registry.gauge('depth', 'Queue depth.', func=lambda: 3)
+    assert registry.render() == (
+        '# HELP depth Queue depth.\n'
+        '# TYPE depth gauge\n'
+        'depth 3\n'
+        '# HELP events_total Events seen.\n'
+        '# TYPE events_total counter\n'
+        'events_total{event="a"} 2\n'
+        'events_total{event="b"} 1\n')
+
+def test_render_histogram():
+    registry = Registry()
+    seconds = registry.histogram('seconds', 'Time taken.', labels=('route',),
+                                 buckets=(0.1, 1.0, float('inf')))
+    seconds.observe(0.05, '/hook')
+    seconds.observe(0.5, '/hook')
+    seconds.observe(5.0, '/hook')
+    assert registry.render().splitlines() == [
+        '# HELP seconds Time taken.',
+        '# TYPE seconds histogram',
+        'seconds_bucket{route="/hook",le="0.1"} 1',
+        'seconds_bucket{route="/hook",le="1.0"} 2',
+        'seconds_bucket{route="/hook",le="+Inf"} 3',
+        'seconds_sum{route="/hook"} 5.55',
+        'seconds_count{route="/hook"} 3',
+        ]
+
+def test_escape_label_values():
+    registry = Registry()
+    registry.counter('c', 'Multi\nline.', labels=('x',)).inc('a "b"\\')
+    assert registry.render().splitlines() == [
+        '# HELP c Multi line.',
+        '# TYPE c counter',
+        r'c{x="a \"b\"\\"} 1',
+        ]
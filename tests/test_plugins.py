@@ -0,0 +1,80 @@
+"""Tests for routing events to the plugins that handle them."""
+from __future__ import print_function
+import threading
+
+from polyphemus.utils import RunControl
+from polyphemus.event import Event, runfor
+from polyphemus.plugins import Plugin, Plugins
+
+class BuildPlugin(Plugin):
+
+    @runfor('batlab-run')
+    def execute(self, rc):
+        pass
+
+class StatusPlugin(Plugin):
+
+    @runfor('batlab-status', 'batlab-run')
+    def execute(self, rc):
+        pass
+
+class AnyPlugin(Plugin):
+
+    def execute(self, rc):
+        pass
+
+class IdlePlugin(Plugin):
+    pass
+
+def test_routes():
+    plugins = Plugins([])
+    plugins.plugins = [StatusPlugin(), IdlePlugin(), BuildPlugin()]
+    plugins.build_routes()
+    assert plugins.routes == {'batlab-run': [0, 2], 'batlab-status': [0]}
+
+def test_routes_include_plugins_for_any_event():
+    plugins = Plugins([])
+    plugins.plugins = [AnyPlugin(), BuildPlugin()]
+    plugins.build_routes()
+    assert plugins.routes == {'batlab-run': [0, 1]}
+
+class TagPlugin(Plugin):
+    """Sets per-event state on the run control, waiting for the other event so
+    that both are executing at once.
+    """
+
+    def __init__(self, barrier):
+        self.barrier = barrier
+
+    @runfor('github-pr-sync')
+    def execute(self, rc):
+        rc.number = rc.event.data
+        self.barrier.wait(5.0)
+        rc.event = Event('batlab-status', rc.number)
+
+class RecordPlugin(Plugin):
+
+    def __init__(self):
+        self.seen = []
+
+    @runfor('batlab-status')
+    def execute(self, rc):
+        self.seen.append((rc.event.data, rc.number))
+
+def test_concurrent_events_have_their_own_run_control():
+    record = RecordPlugin()
+    plugins = Plugins([])
+    plugins.plugins = [TagPlugin(threading.Barrier(2)), record]
+    plugins.build_routes()
+    event = Event('github-pr-new', None)
+    plugins.rc = RunControl(event=event, number=0)
+    threads = [threading.Thread(target=plugins.execute, 
+                                args=(Event('github-pr-sync', n),))
+               for n in (1, 2)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sorted(record.seen) == [(1, 1), (2, 2)]
+    assert plugins.rc.event is event
+    assert plugins.rc.number == 0
@@ -0,0 +1,59 @@
+"""Tests for scheduling events by priority class."""
+from __future__ import print_function
+
+from polyphemus.event import Event, runfor
+from polyphemus.plugins import Plugin, Plugins
+from polyphemus.dispatch import Dispatcher
+
+class FakePlugins(object):
+    """Records the order that events are executed in."""
+
+    def __init__(self, priorities):
+        self.priorities = priorities
+        self.executed = []
+
+    def dispatched(self, event):
+        pass
+
+    def completed(self, event):
+        pass
+
+    def priority(self, name):
+        return self.priorities.get(name, 'normal')
+
+    def batchable(self, name):
+        return False
+
+    def execute(self, event):
+        self.executed.append(event)
+
+class BuildPlugin(Plugin):
+
+    @runfor('batlab-run', priority='build')
+    def execute(self, rc):
+        pass
+
+class StatusPlugin(Plugin):
+
+    @runfor('batlab-status', 'batlab-run', priority='status')
+    def execute(self, rc):
+        pass
+
+def test_event_priority_is_heaviest_plugin():
+    plugins = Plugins([])
+    plugins.plugins = [StatusPlugin(), BuildPlugin()]
+    plugins.build_routes()
+    assert plugins.priority('batlab-run') == 'build'
+    assert plugins.priority('batlab-status') == 'status'
+    assert plugins.priority('swc-status') == 'normal'
+
+def test_priority_order():
+    plugins = FakePlugins({'batlab-run': 'build', 'batlab-status': 'status'})
+    d = Dispatcher(plugins)
+    build = Event('batlab-run', ('o', 'r', 1))
+    normal = Event('swc-status', {'owner': 'o', 'repo': 'r'})
+    status = Event('batlab-status', {'owner': 'o', 'repo': 'r', 'number': 1})
+    for event in (build, normal, status):
+        d.submit(event)
+    d.start(workers=0)
+    assert plugins.executed == [status, normal, build]
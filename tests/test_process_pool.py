@@ -0,0 +1,50 @@
+"""Tests for executing plugins in the process pool.  This module is itself the
+plugin which the worker processes import.
+"""
+from __future__ import print_function
+import os
+
+from polyphemus.utils import RunControl
+from polyphemus.event import Event, runfor
+from polyphemus.plugins import Plugin, Plugins
+
+class PolyphemusPlugin(Plugin):
+    """Runs in a worker process."""
+
+    process_pool = True
+
+    @runfor('batlab-run')
+    def execute(self, rc):
+        rc.answer = rc.question * 2
+        rc.event = Event('batlab-status', (os.getpid(), rc.event.data))
+
+class RecordPlugin(Plugin):
+
+    def __init__(self):
+        self.seen = []
+
+    @runfor('batlab-status')
+    def execute(self, rc):
+        self.seen.append((rc.event.data, rc.answer))
+
+def test_isolated_round_trip():
+    record = RecordPlugin()
+    plugins = Plugins([])
+    plugins.plugins = [PolyphemusPlugin(), record]
+    plugins.modnames = [__name__, None]
+    plugins.build_routes()
+    plugins.rc = RunControl(event=None, question=21, process_pool_size=1, 
+                            unpicklable=lambda: None)
+    try:
+        plugins.execute(Event('batlab-run', 'pr'))
+        plugins.execute(Event('batlab-run', 'pr2'))
+    finally:
+        plugins.process_pool().close()
+        plugins.process_pool().join()
+    assert [(data, answer) for (pid, data), answer in record.seen] == \
+        [('pr', 42), ('pr2', 42)]
+    pids = set(pid for (pid, data), answer in record.seen)
+    assert len(pids) == 1  # the plugin is reused by the worker
+    assert os.getpid() not in pids
+    assert 'unpicklable' in plugins._unpicklable
+    assert 'answer' not in plugins.rc
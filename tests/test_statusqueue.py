@@ -0,0 +1,105 @@
+"""Tests for posting commit statuses through the write-behind queue."""
+from __future__ import print_function
+
+from polyphemus.githubbase import StatusQueue
+
+SHA = 'abc123'
+
+class FakeRepository(object):
+
+    def __init__(self):
+        self.posted = []
+
+    def create_status(self, sha, state, target_url='', description='', **kwargs):
+        self.posted.append((sha, state))
+
+class FakeHead(object):
+    sha = SHA
+
+class FakePull(object):
+    head = FakeHead()
+
+class FakeGitHub(object):
+
+    def __init__(self):
+        self.repo = FakeRepository()
+
+    def pull_request(self, owner, repo, number):
+        return FakePull()
+
+    def repository(self, owner, repo):
+        return self.repo
+
+def make_queue():
+    q = StatusQueue()
+    q._thread = object()  # post by hand rather than in the background
+    return q
+
+class CountingGitHub(FakeGitHub):
+
+    def __init__(self):
+        super(CountingGitHub, self).__init__()
+        self.lookups = 0
+
+    def pull_request(self, owner, repo, number):
+        self.lookups += 1
+        return super(CountingGitHub, self).pull_request(owner, repo, number)
+
+def test_put_does_not_resolve_number():
+    q = make_queue()
+    gh = CountingGitHub()
+    q.put(gh, 'o', 'r', 1, 'pending')
+    assert gh.lookups == 0
+    key, item = q._next()
+    assert q._post(key, item) == 'posted'
+    assert gh.lookups == 1
+    assert gh.repo.posted == [(SHA, 'pending')]
+
+def test_number_superseded_by_newer_sha():
+    q = make_queue()
+    gh = FakeGitHub()
+    q.put(gh, 'o', 'r', 1, 'pending')
+    q.put(gh, 'o', 'r', SHA, 'success')
+    results = []
+    while len(q) > 0:
+        key, item = q._next()
+        results.append(q._post(key, item))
+        q._busy = False
+    assert sorted(results) == ['posted', 'superseded']
+    assert gh.repo.posted == [(SHA, 'success')]
+
+def test_newer_number_posted_after_sha():
+    q = make_queue()
+    gh = FakeGitHub()
+    q.put(gh, 'o', 'r', SHA, 'pending')
+    q.put(gh, 'o', 'r', 1, 'success')
+    results = []
+    while len(q) > 0:
+        key, item = q._next()
+        results.append(q._post(key, item))
+        q._busy = False
+    assert results == ['posted', 'posted']
+    assert gh.repo.posted == [(SHA, 'pending'), (SHA, 'success')]
+
+def test_stale_retry_dropped():
+    q = make_queue()
+    gh = FakeGitHub()
+    q.put(gh, 'o', 'r', SHA, 'pending')
+    key, stale = q._next()
+    q._busy = False
+    q.put(gh, 'o', 'r', SHA, 'success')
+    key, item = q._next()
+    assert q._post(key, item) == 'posted'
+    # the older post failed, and must not overwrite the newer status
+    assert q._retry(key, stale, RuntimeError('boom')) == 'superseded'
+    assert len(q) == 0
+    assert q._post(key, stale) == 'superseded'
+    assert gh.repo.posted == [(SHA, 'success')]
+
+def test_failed_post_retried():
+    q = make_queue()
+    gh = FakeGitHub()
+    q.put(gh, 'o', 'r', SHA, 'pending')
+    key, item = q._next()
+    assert q._retry(key, item, RuntimeError('boom')) == 'retried'
+    assert q._pending[key][2] == 1
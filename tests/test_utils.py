@@ -0,0 +1,33 @@
+"""Tests for the persistent cache shared between threads and processes."""
+from __future__ import print_function
+import os
+import multiprocessing
+
+from polyphemus.utils import PersistentCache
+
+def _write_keys(cachefile, prefix, n):
+    cache = PersistentCache(cachefile)
+    for i in range(n):
+        cache['{0}{1}'.format(prefix, i)] = i
+
+def test_concurrent_writers_keep_updates(tmpdir):
+    cachefile = str(tmpdir.join('cache.pkl'))
+    procs = [multiprocessing.Process(target=_write_keys, args=(cachefile, p, 20))
+             for p in 'abc']
+    for proc in procs:
+        proc.start()
+    _write_keys(cachefile, 'd', 20)
+    for proc in procs:
+        proc.join()
+    cache = PersistentCache(cachefile)
+    assert len(cache) == 80
+    assert sorted(f for f in os.listdir(str(tmpdir)) if f.endswith('.tmp')) == []
+
+def test_write_reads_newer_file(tmpdir):
+    cachefile = str(tmpdir.join('cache.pkl'))
+    first = PersistentCache(cachefile)
+    second = PersistentCache(cachefile)
+    first['a'] = 1
+    second['b'] = 2
+    first['c'] = 3
+    assert dict(PersistentCache(cachefile)) == {'a': 1, 'b': 2, 'c': 3}